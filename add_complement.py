@@ -3,9 +3,13 @@
 """Add or remove complement sites."""
 
 import argparse
+import numpy as np
 import signal
 import sys
 
+from compressed import FileType
+from sitecodec import get_complements
+
 
 _ADD = 0
 _REVERSE = 1
@@ -13,20 +17,18 @@ _WATSON = 2
 _CRICK = 3
 _ISPAL = 4
 
-COMPLS = {
-    "A": "T", "T": "A", "C": "G", "G": "C",
-    "B": "V", "V": "B", "D": "H", "H": "D", "N": "N",
-    "M": "K", "K": "M", "R": "Y", "Y": "R", "W": "W", "S": "S"
-}
-
 
-def get_site_versions(site):
-    """Get all versions of double-stranded site."""
-    rsite = "".join([COMPLS.get(nucl, "?") for nucl in site[::-1]])
-    watson = min(site, rsite)
-    crick = max(site, rsite)
-    ispal = watson == crick
-    return site, rsite, watson, crick, ispal
+def get_site_versions(sites):
+    """Get all versions of double-stranded sites, by columns."""
+    sites = np.array(sites, dtype=str)
+    rsites = np.array(get_complements(sites), dtype=str)
+    is_watson = sites <= rsites
+    return (
+        sites.tolist(), rsites.tolist(),
+        np.where(is_watson, sites, rsites).tolist(),
+        np.where(is_watson, rsites, sites).tolist(),
+        (sites == rsites).tolist()
+    )
 
 
 def transform_tsv(intsv, action, sort=True, keep_repeats=False,
@@ -34,27 +36,26 @@ def transform_tsv(intsv, action, sort=True, keep_repeats=False,
     """Read and transform site list from file-like object."""
     if has_title:
         title = intsv.readline()
+    split_num = max(site_index, id_index) + 1
+    rows = [line.strip().split("\t", split_num) for line in intsv]
+    versions = zip(*get_site_versions([vals[site_index] for vals in rows]))
     lines = []
     uniqs = set()
-    split_num = max(site_index, id_index) + 1
-    for line in intsv:
-        vals = line.strip().split("\t", split_num)
-        site = vals[site_index]
-        versions = get_site_versions(site)
+    for vals, site_versions in zip(rows, versions):
         if id_index is None:
             uid = tuple(vals[:site_index] + vals[site_index+1:])
         else:
             uid = vals[id_index]
-        uids = (versions[_WATSON], uid)
+        uids = (site_versions[_WATSON], uid)
         if not keep_repeats:
             if uids in uniqs:
                 continue
             uniqs.add(uids)
-        vals[site_index] = versions[action]
+        vals[site_index] = site_versions[action]
         lines.append(vals)
-        if action == _ADD and not versions[_ISPAL]:
+        if action == _ADD and not site_versions[_ISPAL]:
             rvals = vals[:]
-            rvals[site_index] = versions[_REVERSE]
+            rvals[site_index] = site_versions[_REVERSE]
             lines.append(rvals)
     if sort:
         lines = sorted(lines, key=lambda x: x[site_index])
@@ -70,12 +71,12 @@ def main(argv=None):
         description="Add or remove complement sites."
     )
     parser.add_argument(
-        "intsv", metavar="FILE", type=argparse.FileType("r"),
+        "intsv", metavar="FILE", type=FileType("r"),
         help="input table with sites, use '-' for STDIN"
     )
     out_group = parser.add_mutually_exclusive_group(required=False)
     out_group.add_argument(
-        "-o", dest="outsv", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="outsv", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output site list, default is STDOUT"
     )
     out_group.add_argument(
@@ -0,0 +1,973 @@
+#! /usr/bin/env python2
+
+"""Read compositional bias tables into typed arrays.
+
+A table is read by large chunks of lines, every chunk is converted into
+arrays of integer-coded sequence IDs and sites and float64 observed and
+expected numbers, so the tools could process the table column-wise
+instead of parsing it line by line.
+"""
+
+from collections import namedtuple
+import json
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from compressed import is_compressed, open_file
+from sitecodec import (MAX_LENGTH, decode_sites, encode_sites, get_codable,
+                       get_complement, reverse_complement)
+
+
+CHUNK_SIZE = 1 << 24 # approximate chunk size in bytes
+CACHE_CHUNK_ROWS = 1 << 20 # chunk size in rows for cached tables
+
+CACHE_SUFFIX = ".cbc"
+CACHE_VERSION = 1
+
+SPILL_PARTITIONS = 64 # number of temporary files to spill rows to
+SPILL_KEY = "_key"
+SPILL_HASH = np.uint64(0x9E3779B97F4A7C15) # Fibonacci hashing multiplier
+
+ID, SITE, FLOAT, INT = ("id", "site", "float", "int")
+
+DTYPES = {ID: np.int32, SITE: np.int32, FLOAT: np.float64, INT: np.int64}
+
+STANDARD_LAYOUTS = { # ID, Site, Observed, Expected, Ratio, Total
+    6: [(0, ID), (1, SITE), (2, FLOAT), (3, FLOAT), (4, FLOAT), (5, INT)],
+    5: [(0, SITE), (1, FLOAT), (2, FLOAT), (3, FLOAT), (4, INT)]
+}
+
+CBChunk = namedtuple("CBChunk", ["ids", "sites", "obs", "exp", "totals"])
+
+# titles of the group column of cutoff tables, see GroupCutoffs
+GROUP_TITLES = {ID: "Sequence ID", SITE: "Site"}
+
+# CB groups: NaN, unreliable, zero, under-represented, over-represented,
+# less than 1, greater than 1, and equal to 1
+NAN, UNR, ZERO, UNDER, OVER, LESS, MORE, ONE = (0, 1, 2, 3, 4, 5, 6, 7)
+
+
+def classify_value(obs, exp, cutoffs):
+    """Get CB group of a single pair of observed and expected numbers.
+
+    This is the reference for CBClassifier, cutoffs are expected number,
+    zero, under- and over-representation cutoffs.
+    """
+    exp_cutoff, zero_cutoff, under_cutoff, over_cutoff = cutoffs
+    group = ONE
+    if math.isnan(exp) or math.isinf(exp) or exp == 0:
+        group = NAN
+    elif exp <= exp_cutoff:
+        group = UNR
+    else:
+        ratio = obs / exp
+        if ratio < 1.0:
+            group = LESS
+            if ratio <= under_cutoff:
+                group = UNDER if ratio > zero_cutoff else ZERO
+        elif ratio > 1.0:
+            group = MORE if ratio < over_cutoff else OVER
+    return group
+
+
+class CBClassifier(object):
+    """Classify arrays of observed and expected numbers by CB groups.
+
+    Cutoffs are the same as for classify_value(), the results match:
+
+    >>> cutoffs = (5.0, 0.1, 0.8, 1.2)
+    >>> obs = np.array([0, 1, 6, 9, 10, 11, 13, 3, np.nan, 2, 2, 1e3])
+    >>> exp = np.array([10, 10, 10, 10, 10, 10, 10, 3, 10, 0, np.nan, 1e3])
+    >>> groups = CBClassifier(cutoffs)(obs, exp)
+    >>> groups.tolist() == [
+    ...     classify_value(*(values + (cutoffs,))) for values in zip(obs, exp)
+    ... ]
+    True
+    """
+
+    def __init__(self, cutoffs, group_cutoffs=None):
+        exp_cutoff, zero_cutoff, under_cutoff, over_cutoff = cutoffs
+        self.exp_cutoff = exp_cutoff
+        self.zero_cutoff = zero_cutoff
+        self.under_cutoff = under_cutoff
+        self.over_cutoff = over_cutoff
+        self.group_cutoffs = group_cutoffs
+
+    def __call__(self, obs, exp, cutoffs=None):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.classify(obs / exp, exp, cutoffs)
+
+    def classify(self, ratios, exp, cutoffs=None):
+        """Classify rows by precomputed ratios.
+
+        Under- and over-representation cutoffs could be given as a pair
+        of arrays with the cutoffs of every row.
+        """
+        under_cutoff, over_cutoff = self.under_cutoff, self.over_cutoff
+        if cutoffs is not None:
+            under_cutoff, over_cutoff = cutoffs
+        with np.errstate(invalid="ignore"):
+            less = ratios < 1.0
+            under = less & (ratios <= under_cutoff)
+            more = ratios > 1.0
+            return np.select(
+                [
+                    np.isnan(exp) | np.isinf(exp) | (exp == 0),
+                    exp <= self.exp_cutoff,
+                    under & (ratios <= self.zero_cutoff), under, less,
+                    more & (ratios >= over_cutoff), more
+                ],
+                [NAN, UNR, ZERO, UNDER, LESS, OVER, MORE], ONE
+            )
+
+    def classify_chunk(self, chunk, reader):
+        """Classify rows of a chunk, with the group cutoffs if any."""
+        cutoffs = None
+        if self.group_cutoffs is not None:
+            cutoffs = self.group_cutoffs.get_cutoffs(chunk, reader)
+        return self(chunk.obs, chunk.exp, cutoffs)
+
+
+class GroupCutoffs(object):
+    """Under- and over-representation cutoffs of sites or sequence IDs.
+
+    The cutoffs are a dict of (under cutoff, over cutoff) pairs by site
+    or ID strings (kind is SITE or ID), the default pair is used for the
+    groups missing in it.
+    """
+
+    def __init__(self, kind, cutoffs, default):
+        self.kind = kind
+        self.cutoffs = cutoffs
+        self.default = default
+        self.coder = None
+        self.table = np.zeros((0, 2))
+
+    def get_cutoffs(self, chunk, reader):
+        """Get arrays of under and over cutoffs of the chunk rows."""
+        if self.kind == ID:
+            coder, codes = reader.id_coder, chunk.ids
+            if codes is None:
+                raise ValueError("cutoffs by sequence IDs need IDs")
+        else:
+            coder, codes = reader.site_coder, chunk.sites
+        if coder is not self.coder: # codes of another table
+            self.coder = coder
+            self.table = np.zeros((0, 2))
+        values = coder.values
+        if len(self.table) < len(values):
+            self.table = np.concatenate([self.table, np.array([
+                self.cutoffs.get(value, self.default)
+                for value in values[len(self.table):]
+            ], dtype=np.float64).reshape(-1, 2)])
+        table = self.table[codes]
+        return table[:, 0], table[:, 1]
+
+    def to_arrays(self):
+        """Get arrays to save the cutoffs with np.savez()."""
+        names = sorted(self.cutoffs)
+        return {
+            "group_kind": self.kind,
+            "group_names": np.array(names, dtype=str),
+            "group_cutoffs": np.array(
+                [self.cutoffs[name] for name in names], dtype=np.float64
+            ).reshape(-1, 2),
+            "group_default": np.array(self.default, dtype=np.float64),
+        }
+
+
+def read_group_cutoffs(intsv, default):
+    """Read a table of cutoffs by sites or IDs written by get_cutoff.py.
+
+    The first column is the site or ID, other columns are 'Under cutoff'
+    and 'Over cutoff', missing ones are taken from the default pair.
+    Return a GroupCutoffs instance.
+    """
+    titles = None
+    cutoffs = dict()
+    for line in intsv:
+        if line.startswith("#"):
+            if line.startswith("#:") and titles is None:
+                titles = line[2:].rstrip("\r\n").split("\t")
+            continue
+        if titles is None:
+            raise ValueError("%s: no title line" % intsv.name)
+        vals = line.rstrip("\r\n").split("\t")
+        if len(vals) != len(titles):
+            raise ValueError(
+                "%s: inconsistent number of columns near line: %r" % (
+                    intsv.name, line
+                )
+            )
+        cutoff_pair = list(default)
+        for index, title in enumerate(["Under cutoff", "Over cutoff"]):
+            if title in titles:
+                cutoff_pair[index] = float(vals[titles.index(title)])
+        cutoffs[vals[0]] = tuple(cutoff_pair)
+    kinds = dict((title, kind) for kind, title in GROUP_TITLES.items())
+    if titles is None or titles[0] not in kinds:
+        raise ValueError(
+            "%s: not a table of cutoffs by sites or sequence IDs" %
+            intsv.name
+        )
+    if "Level" in titles:
+        raise ValueError(
+            "%s: the table has cutoffs of several levels" % intsv.name
+        )
+    return GroupCutoffs(kinds[titles[0]], cutoffs, tuple(default))
+
+
+class Coder(object):
+    """Map string values to consecutive integer codes."""
+
+    def __init__(self):
+        self.codes = dict()
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        """Encode an array of strings, return an array of codes."""
+        uniqs, inverse = np.unique(values, return_inverse=True)
+        codes = np.array([self.add(value) for value in uniqs.tolist()],
+                         dtype=np.int64)
+        return codes[inverse]
+
+    def decode(self, codes):
+        """Decode an array of codes, return a list of strings."""
+        values = self.values
+        return [values[code] for code in codes.tolist()]
+
+
+class CodeFilter(object):
+    """Check whether coded values belong to a set of strings."""
+
+    def __init__(self, coder, values):
+        self.coder = coder
+        self.values = values
+        self.mask = np.zeros(0, dtype=bool)
+
+    def __call__(self, codes):
+        values = self.coder.values
+        if len(self.mask) < len(values):
+            self.mask = np.append(self.mask, [
+                value in self.values for value in values[len(self.mask):]
+            ])
+        return self.mask[codes]
+
+
+class CodeMapper(object):
+    """Map codes of one coder to codes of another one, -1 if missing.
+
+    Values are looked up only, the target coder is left as it is.
+    """
+
+    def __init__(self, coder, target):
+        self.coder = coder
+        self.target = target
+        self.table = np.zeros(0, dtype=np.int64)
+
+    def __call__(self, codes):
+        values = self.coder.values
+        if len(self.table) < len(values):
+            target_codes = self.target.codes
+            self.table = np.append(self.table, np.array([
+                target_codes.get(value, -1)
+                for value in values[len(self.table):]
+            ], dtype=np.int64))
+        return self.table[codes]
+
+
+class SiteCoder(Coder):
+    """Coder for sites, keeps track of complementary sites.
+
+    Complementary sites are found with the packed site codes (see
+    sitecodec) and added to the coder if missing. Sites the codec could
+    not encode are complemented as strings, unknown letters become '?'.
+    """
+
+    def __init__(self):
+        Coder.__init__(self)
+        self._tables = None
+
+    def add(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = Coder.add(self, value)
+            self._tables = None
+        return code
+
+    def get_tables(self):
+        """Get complement, Watson site and palindrome lookup tables."""
+        if self._tables is None:
+            values = np.array(self.values, dtype=str)
+            is_codable = get_codable(values)
+            coded = np.flatnonzero(is_codable)
+            sites = encode_sites(values[coded].astype("S%d" % MAX_LENGTH))
+            compls = reverse_complement(sites)
+            missing = np.setdiff1d(compls, sites)
+            coded = np.append(coded, np.arange(
+                len(self.values), len(self.values) + len(missing)
+            ))
+            for value in decode_sites(missing):
+                Coder.add(self, value)
+            sites = np.append(sites, missing)
+            compls = np.append(compls, reverse_complement(missing))
+            order = np.argsort(sites)
+            # other sites are complemented as strings, like before the
+            # codec; a new complementary site gets the site as complement
+            uncoded_compls = dict()
+            for code in np.flatnonzero(~is_codable).tolist():
+                value = get_complement(self.values[code])
+                compl_code = self.codes.get(value)
+                if compl_code is None:
+                    compl_code = Coder.add(self, value)
+                    uncoded_compls[compl_code] = code
+                uncoded_compls[code] = compl_code
+            compl_codes = np.zeros(len(self.values), dtype=np.int64)
+            compl_codes[coded] = coded[
+                order[np.searchsorted(sites, compls, sorter=order)]
+            ]
+            uncoded = np.array(sorted(uncoded_compls), dtype=np.int64)
+            compl_codes[uncoded] = [
+                uncoded_compls[code] for code in uncoded.tolist()
+            ]
+            values = np.array(self.values, dtype=str)
+            codes = np.arange(len(values))
+            watsons = np.where(
+                values <= values[compl_codes], codes, compl_codes
+            )
+            self._tables = (compl_codes, watsons, compl_codes == codes)
+        return self._tables
+
+    def get_watsons(self, codes):
+        """Get Watson site codes and palindrome flags for site codes."""
+        _compls, watsons, palindromes = self.get_tables()
+        return watsons[codes], palindromes[codes]
+
+
+def normalize_index(index, columns):
+    if index is None or index >= 0:
+        return index
+    return index + columns
+
+
+def get_layout(indices, total_index, columns):
+    """Get (index, kind) column keys for ID, site, obs, exp and total."""
+    id_index, site_index, obs_index, exp_index = (
+        normalize_index(index, columns) for index in indices
+    )
+    return [
+        None if id_index is None else (id_index, ID),
+        None if site_index is None else (site_index, SITE),
+        (obs_index, FLOAT), (exp_index, FLOAT),
+        None if total_index is None else (
+            normalize_index(total_index, columns), INT
+        )
+    ]
+
+
+class CBTableReader(object):
+    """Read a TSV table of compositional bias values by chunks.
+
+    Iteration yields CBChunk instances with arrays of ID and site codes
+    (None when the index is None), float64 observed and expected numbers,
+    and int64 totals (None when total_index is None). Lines starting with
+    '#' are skipped, metadata lines ('##') are collected to the metadata
+    list. If cache_path is given, the binary cache of the table is
+    written there as soon as the table is read through.
+    """
+
+    def __init__(self, intsv, indices, total_index=None, has_title=True,
+                 chunk_size=CHUNK_SIZE, cache_path=None):
+        self.intsv = intsv
+        self.indices = indices
+        self.total_index = total_index
+        self.has_title = has_title
+        self.chunk_size = chunk_size
+        self.cache_path = cache_path
+        self.id_coder = Coder()
+        self.site_coder = SiteCoder()
+        self.title = None
+        self.first_line = None
+        self.metadata = []
+        self.rows = 0
+        self.columns = None
+        self.layout = None
+        self.extra_keys = []
+
+    def __iter__(self):
+        intsv = self.intsv
+        if self.has_title:
+            self.title = self.first_line = intsv.readline()
+        cache = None
+        if self.cache_path:
+            cache = CacheWriter(self.cache_path)
+        while True:
+            lines = intsv.readlines(self.chunk_size)
+            if not lines:
+                break
+            if self.first_line is None:
+                self.first_line = lines[0]
+            arrays = self.parse_lines(lines)
+            if arrays is None:
+                continue
+            if cache is not None:
+                cache.write(arrays)
+            yield CBChunk(*(
+                None if key is None else arrays[key] for key in self.layout
+            ))
+        if cache is not None:
+            cache.close(self)
+
+    def get_keys(self, columns):
+        if self.columns is None:
+            self.columns = columns
+            self.layout = get_layout(
+                self.indices, self.total_index, columns
+            )
+            if self.cache_path:
+                self.extra_keys = [
+                    key for key in STANDARD_LAYOUTS.get(columns, [])
+                    if key not in self.layout
+                ]
+        elif columns != self.columns:
+            raise ValueError("inconsistent number of columns")
+        return [key for key in self.layout if key] + self.extra_keys
+
+    def parse_lines(self, lines):
+        text = "".join(lines)
+        if "#" in text:
+            self.metadata.extend(
+                line for line in lines if line.startswith("##")
+            )
+            lines = [line for line in lines if not line.startswith("#")]
+            if not lines:
+                return None
+            text = "".join(lines)
+        columns = lines[0].rstrip("\r\n").count("\t") + 1
+        fields = text.replace("\r", "").replace("\n", "\t").split("\t")
+        if not fields[-1]:
+            fields.pop()
+        if len(fields) != len(lines) * columns:
+            raise ValueError(
+                "inconsistent number of columns near line: %r" % lines[0]
+            )
+        arrays = dict()
+        for key in self.get_keys(columns):
+            index, kind = key
+            values = fields[index::columns]
+            try:
+                if kind == ID:
+                    arrays[key] = self.id_coder.encode(np.array(values))
+                elif kind == SITE:
+                    arrays[key] = self.site_coder.encode(np.array(values))
+                else:
+                    arrays[key] = np.array(values, dtype=DTYPES[kind])
+            except ValueError:
+                if key not in self.extra_keys:
+                    raise
+                self.extra_keys.remove(key) # not a standard column
+        self.rows += len(lines)
+        return arrays
+
+
+class CacheWriter(object):
+    """Write binary cache of a table, column by column."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = "%s.tmp%d" % (path, os.getpid())
+        self.files = dict()
+        try:
+            os.mkdir(self.tmp_path)
+        except OSError:
+            self.tmp_path = None # no write access, no caching
+
+    def write(self, arrays):
+        if self.tmp_path is None:
+            return
+        try:
+            for key, array in arrays.items():
+                if key not in self.files:
+                    self.files[key] = open(os.path.join(
+                        self.tmp_path, get_array_name(key)
+                    ), "wb")
+                array.astype(DTYPES[key[1]]).tofile(self.files[key])
+        except (IOError, OSError):
+            self.abort()
+
+    def close(self, reader):
+        if self.tmp_path is None:
+            return
+        if reader.columns is None: # no rows, the layout is unknown
+            self.abort()
+            return
+        for outbin in self.files.values():
+            outbin.close()
+        arrays = [
+            key for key in self.files
+            if key in reader.extra_keys or key in reader.layout
+        ]
+        source = os.stat(reader.intsv.name)
+        header = {
+            "version": CACHE_VERSION,
+            "source_size": source.st_size, "source_mtime": source.st_mtime,
+            "has_title": reader.has_title, "first_line": reader.first_line,
+            "title": reader.title, "metadata": reader.metadata,
+            "rows": reader.rows, "columns": reader.columns,
+            "arrays": sorted(arrays)
+        }
+        try:
+            for kind, coder in [(ID, reader.id_coder),
+                                (SITE, reader.site_coder)]:
+                with open(os.path.join(self.tmp_path, kind), "w") as oucdr:
+                    oucdr.writelines(value + "\n" for value in coder.values)
+            with open(os.path.join(self.tmp_path, "header"), "w") as ouhdr:
+                json.dump(header, ouhdr)
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.rename(self.tmp_path, self.path)
+        except (IOError, OSError):
+            self.abort()
+
+    def abort(self):
+        for outbin in self.files.values():
+            outbin.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path = None
+
+
+def get_array_name(key):
+    return "%d.%s" % key
+
+
+def load_cache_header(path, source_path):
+    """Load cache header, return None if the cache is missing or stale."""
+    try:
+        with open(os.path.join(path, "header")) as inhdr:
+            header = json.load(inhdr)
+        source = os.stat(source_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (header.get("version") != CACHE_VERSION
+            or header["source_size"] != source.st_size
+            or header["source_mtime"] != source.st_mtime):
+        return None
+    return header
+
+
+class CachedCBTable(object):
+    """Read a table from its binary cache, memory-mapped.
+
+    The interface is the same as the one of CBTableReader. If row_range
+    is given, only rows from the range are read.
+    """
+
+    def __init__(self, path, header, indices, total_index=None,
+                 chunk_rows=CACHE_CHUNK_ROWS, row_range=None):
+        self.path = path
+        self.total_rows = header["rows"]
+        self.row_range = row_range or (0, self.total_rows)
+        self.rows = self.row_range[1] - self.row_range[0]
+        self.chunk_rows = chunk_rows
+        self.title = header["title"] and str(header["title"])
+        self.metadata = [str(line) for line in header["metadata"]]
+        self.layout = get_layout(indices, total_index, header["columns"])
+        self.id_coder = self.load_coder(ID, Coder())
+        self.site_coder = self.load_coder(SITE, SiteCoder())
+
+    def load_coder(self, kind, coder):
+        with open(os.path.join(self.path, kind)) as incdr:
+            for line in incdr:
+                coder.add(line.rstrip("\n"))
+        return coder
+
+    def load_array(self, key):
+        dtype = DTYPES[key[1]]
+        if not self.total_rows: # empty files could not be mapped
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.path, get_array_name(key)),
+            dtype=dtype, mode="r"
+        )
+
+    def __iter__(self):
+        arrays = [
+            None if key is None else self.load_array(key)
+            for key in self.layout
+        ]
+        first_row, last_row = self.row_range
+        for start in range(first_row, last_row, self.chunk_rows):
+            end = min(start + self.chunk_rows, last_row)
+            yield CBChunk(*(
+                None if array is None else array[start:end]
+                for array in arrays
+            ))
+
+
+class FileRange(object):
+    """Read lines from a byte range of a file.
+
+    The range boundaries should be line starts.
+    """
+
+    def __init__(self, path, start, end):
+        self.name = path
+        self.file = open(path)
+        self.file.seek(start)
+        self.end = end
+
+    def readline(self):
+        if self.file.tell() >= self.end:
+            return ""
+        return self.file.readline()
+
+    def readlines(self, size):
+        left = self.end - self.file.tell()
+        if left <= 0:
+            return []
+        data = self.file.read(min(size, left))
+        if not data.endswith("\n"):
+            data += self.file.readline()
+        return data.splitlines(True)
+
+
+def split_table(path, parts, indices, total_index=None, has_title=True,
+                use_cache=True):
+    """Split the table file into parts to read with open_table_part().
+
+    Parts are row ranges of the binary cache if it is usable, or byte
+    ranges of the table otherwise. A compressed table without the cache
+    could not be split, it is one part.
+    """
+    cache_path = path + CACHE_SUFFIX
+    header = use_cache and load_cache_header(cache_path, path)
+    if header and is_cache_usable(header, indices, total_index, has_title):
+        bounds = np.linspace(0, header["rows"], parts + 1).astype(int)
+        return [
+            ("cache", cache_path, header, (start, end))
+            for start, end in zip(bounds[:-1], bounds[1:]) if start < end
+        ]
+    if is_compressed(path):
+        return [("compressed", path, has_title)]
+    with open(path) as intsv:
+        if has_title:
+            intsv.readline()
+        first = intsv.tell()
+        size = os.fstat(intsv.fileno()).st_size
+        bounds = [first]
+        for part in range(1, parts):
+            intsv.seek(max(first + (size - first) * part // parts, first))
+            if intsv.tell() > first:
+                intsv.seek(intsv.tell() - 1)
+                intsv.readline() # go to the next line start
+            bounds.append(max(intsv.tell(), bounds[-1]))
+        bounds.append(size)
+    return [
+        ("tsv", path, (start, end))
+        for start, end in zip(bounds[:-1], bounds[1:]) if start < end
+    ]
+
+
+def open_table_part(part, indices, total_index=None):
+    """Get a reader of the table part made by split_table()."""
+    if part[0] == "cache":
+        _kind, cache_path, header, row_range = part
+        return CachedCBTable(
+            cache_path, header, indices, total_index, row_range=row_range
+        )
+    if part[0] == "compressed":
+        _kind, path, has_title = part
+        return CBTableReader(
+            open_file(path), indices, total_index, has_title=has_title
+        )
+    _kind, path, (start, end) = part
+    return CBTableReader(
+        FileRange(path, start, end), indices, total_index, has_title=False
+    )
+
+
+def is_cache_usable(header, indices, total_index, has_title):
+    if (header["has_title"] != has_title
+            and not (header["first_line"] or "#").startswith("#")):
+        return False
+    arrays = set(tuple(key) for key in header["arrays"])
+    layout = get_layout(indices, total_index, header["columns"])
+    return all(key in arrays for key in layout if key)
+
+
+def open_cbtable(intsv, indices, total_index=None, has_title=True,
+                 use_cache=True):
+    """Get a reader of the table, use or write the binary cache.
+
+    The cache is a sidecar directory next to the table file, it is
+    rewritten when the table changes (by size or modification time)
+    or when it lacks some of the columns requested.
+    """
+    path = getattr(intsv, "name", None)
+    if not (use_cache and path and os.path.isfile(path)):
+        return CBTableReader(intsv, indices, total_index, has_title)
+    cache_path = path + CACHE_SUFFIX
+    header = load_cache_header(cache_path, path)
+    if header and is_cache_usable(header, indices, total_index, has_title):
+        return CachedCBTable(cache_path, header, indices, total_index)
+    return CBTableReader(
+        intsv, indices, total_index, has_title, cache_path=cache_path
+    )
+
+
+def get_pair_keys(ids, sites):
+    """Combine ID and site codes into int64 keys of (ID, site) pairs."""
+    if ids is None:
+        return sites.astype(np.int64)
+    return (ids.astype(np.int64) << 32) | sites
+
+
+def take_columns(columns, index):
+    return dict((name, column[index]) for name, column in columns.items())
+
+
+def concat_columns(columns1, columns2):
+    return dict(
+        (name, np.concatenate((column, columns2[name])))
+        for name, column in columns1.items()
+    )
+
+
+class StrandPairer(object):
+    """Pair rows of complementary sites of the same sequence.
+
+    Rows are passed by chunks as pair keys (see get_pair_keys, with
+    Watson site codes), palindrome flags and a dict of column arrays.
+    Rows of palindromes are returned at once, rows of asymmetric sites
+    wait for the complementary rows; the pairs are matched in the order
+    of appearance, exactly like with a dict of waiting rows. The waiting
+    rows are kept sorted by keys, so only a chunk is sorted to be merged
+    into them.
+
+    If grouped is set, the rows should be grouped by sequence IDs, and
+    the waiting rows of previous sequences are moved to incomplete ones
+    after every chunk (see pop_incomplete), so only the rows of the last
+    sequence are kept. ValueError is raised if a sequence reappears.
+    """
+
+    def __init__(self, grouped=False):
+        self.waits = None
+        self.rows = 0
+        self.grouped = grouped
+        self.incomplete = None
+        self.last_id = None
+        self.seen_ids = np.zeros(0, dtype=bool)
+
+    def __call__(self, keys, is_pal, columns):
+        """Return palindromic rows, earlier and later rows of pairs."""
+        if self.grouped and len(keys):
+            self.check_groups(keys >> 32)
+        pals = take_columns(columns, is_pal)
+        is_npl = ~is_pal
+        keys = keys[is_npl]
+        columns = take_columns(columns, is_npl)
+        seqs = np.arange(self.rows, self.rows + len(keys))
+        self.rows += len(keys)
+        if self.waits is None:
+            nothing = np.zeros(0, dtype=np.intp)
+            self.waits = (keys[nothing], seqs[nothing],
+                          take_columns(columns, nothing))
+        # waiting rows are sorted by their unique keys, only the ones with
+        # the keys of the chunk are taken to be paired
+        wait_keys, wait_seqs, wait_columns = self.waits
+        positions = np.searchsorted(wait_keys, keys)
+        is_inside = positions < len(wait_keys)
+        positions = positions[is_inside]
+        positions = positions[wait_keys[positions] == keys[is_inside]]
+        is_taken = np.zeros(len(wait_keys), dtype=bool)
+        is_taken[positions] = True
+        keys = np.concatenate((wait_keys[is_taken], keys))
+        seqs = np.concatenate((wait_seqs[is_taken], seqs))
+        columns = concat_columns(take_columns(wait_columns, is_taken), columns)
+        order = np.argsort(keys, kind="mergesort")
+        sorted_keys = keys[order]
+        is_start = np.ones(len(keys), dtype=bool)
+        is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        starts = np.flatnonzero(is_start)
+        lengths = np.diff(np.append(starts, len(keys)))
+        run_index = np.cumsum(is_start) - 1
+        positions = np.arange(len(keys)) - starts[run_index]
+        is_even = positions % 2 == 0
+        is_first = is_even & (positions + 1 < lengths[run_index])
+        is_wait = is_even & ~is_first
+        firsts = np.flatnonzero(is_first)
+        # new waiting rows are sorted by keys, the keys are not waiting
+        waits = order[is_wait]
+        is_left = ~is_taken
+        wait_keys = wait_keys[is_left]
+        positions = np.searchsorted(wait_keys, keys[waits])
+        wait_keys = np.insert(wait_keys, positions, keys[waits])
+        wait_seqs = np.insert(wait_seqs[is_left], positions, seqs[waits])
+        wait_columns = dict(
+            (name, np.insert(column[is_left], positions, columns[name][waits]))
+            for name, column in wait_columns.items()
+        )
+        if self.grouped:
+            is_done = (wait_keys >> 32) != self.last_id
+            done = np.flatnonzero(is_done)
+            done = done[np.argsort(wait_seqs[done], kind="mergesort")]
+            self.incomplete = take_columns(wait_columns, done)
+            is_left = ~is_done
+            wait_keys = wait_keys[is_left]
+            wait_seqs = wait_seqs[is_left]
+            wait_columns = take_columns(wait_columns, is_left)
+        self.waits = (wait_keys, wait_seqs, wait_columns)
+        return (pals, take_columns(columns, order[firsts]),
+                take_columns(columns, order[firsts + 1]))
+
+    def check_groups(self, ids):
+        is_start = np.ones(len(ids), dtype=bool)
+        is_start[1:] = ids[1:] != ids[:-1]
+        group_ids = ids[is_start]
+        new_ids = group_ids
+        if group_ids[0] == self.last_id:
+            new_ids = group_ids[1:]
+        seen_ids = self.seen_ids
+        if len(np.unique(new_ids)) != len(new_ids) or seen_ids[
+                new_ids[new_ids < len(seen_ids)]].any():
+            raise ValueError("the table is not grouped by sequence IDs")
+        if len(new_ids):
+            size = max(len(seen_ids), new_ids.max() + 1)
+            self.seen_ids = np.zeros(size, dtype=bool)
+            self.seen_ids[:len(seen_ids)] = seen_ids
+            self.seen_ids[new_ids] = True
+        self.last_id = group_ids[-1]
+
+    def pop_incomplete(self):
+        """Return rows known to be left without complementary ones."""
+        incomplete, self.incomplete = self.incomplete, None
+        return incomplete
+
+    def drain(self):
+        """Iterate over pairs kept aside, see SpillingStrandPairer."""
+        return iter([])
+
+    def finish(self):
+        """Return rows left without complementary rows, or None."""
+        if self.waits is None:
+            return None
+        _keys, seqs, columns = self.waits
+        self.waits = None
+        # in the order of appearance
+        return take_columns(columns, np.argsort(seqs, kind="mergesort"))
+
+
+class SpillingStrandPairer(object):
+    """Pair rows of complementary sites through temporary files.
+
+    The interface is the same as the one of StrandPairer, but rows of
+    asymmetric sites are not paired as they come. They are spilled to
+    partition files by hashes of their pair keys, and drain() pairs the
+    partitions one by one, so only a partition is kept in memory. Rows
+    with the same key get to the same partition in the order of
+    appearance, so the pairs are the same, only their order differs.
+    """
+
+    def __init__(self, tmp_dir=None, partitions=SPILL_PARTITIONS):
+        self.tmp_dir = tmp_dir
+        self.partitions = partitions
+        self.path = None
+        self.files = None
+        self.dtypes = None
+        self.incomplete = None
+
+    def __call__(self, keys, is_pal, columns):
+        """Return palindromic rows and no pairs, spill the other rows."""
+        pals = take_columns(columns, is_pal)
+        nothing = take_columns(columns, np.zeros(0, dtype=np.intp))
+        columns = take_columns(columns, ~is_pal)
+        columns[SPILL_KEY] = keys[~is_pal]
+        if self.files is None:
+            self.open(columns)
+        hashes = columns[SPILL_KEY].astype(np.uint64) * SPILL_HASH
+        parts = (hashes >> np.uint64(32)) % np.uint64(self.partitions)
+        order = np.argsort(parts, kind="mergesort")
+        bounds = np.cumsum(np.bincount(
+            parts.astype(np.intp), minlength=self.partitions
+        ))
+        start = 0
+        for part, end in enumerate(bounds.tolist()):
+            if start < end:
+                for name, column in columns.items():
+                    column[order[start:end]].tofile(self.files[part][name])
+            start = end
+        return pals, nothing, nothing.copy()
+
+    def open(self, columns):
+        self.path = tempfile.mkdtemp(prefix="cbpairs", dir=self.tmp_dir)
+        self.dtypes = dict(
+            (name, column.dtype) for name, column in columns.items()
+        )
+        self.files = [
+            dict(
+                (name, open(self.get_file_name(part, name), "wb"))
+                for name in columns
+            ) for part in range(self.partitions)
+        ]
+
+    def get_file_name(self, part, name):
+        return os.path.join(self.path, "%d.%s" % (part, name))
+
+    def pop_incomplete(self):
+        """Return rows of the last drained partition left unpaired."""
+        incomplete, self.incomplete = self.incomplete, None
+        return incomplete
+
+    def drain(self):
+        """Pair spilled rows, yield pairs of every partition in turn.
+
+        Rows of a partition left unpaired are returned by pop_incomplete()
+        after its pairs. The temporary files are removed at the end.
+        """
+        if self.files is None:
+            return
+        try:
+            for files in self.files:
+                for spill in files.values():
+                    spill.close()
+            for part in range(self.partitions):
+                columns = dict(
+                    (name, np.fromfile(self.get_file_name(part, name), dtype))
+                    for name, dtype in self.dtypes.items()
+                )
+                keys = columns.pop(SPILL_KEY)
+                pairer = StrandPairer()
+                pairs = pairer(keys, np.zeros(len(keys), dtype=bool), columns)
+                self.incomplete = pairer.finish()
+                yield pairs
+        finally:
+            self.files = None
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def finish(self):
+        """Return None, all the rows are paired by drain()."""
+        return None
+
+
+def get_pairer(sorted_by_id=False, spill_dir=None):
+    """Get a strand pairer for the table processing mode."""
+    if sorted_by_id:
+        return StrandPairer(grouped=True)
+    if spill_dir is not None:
+        return SpillingStrandPairer(spill_dir)
+    return StrandPairer()
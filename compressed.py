@@ -0,0 +1,121 @@
+#! /usr/bin/env python2
+
+"""Open files compressed with gzip, bzip2 or xz by their extensions.
+
+Compressed files are read and written through gzip, bzip2 or xz
+processes, so (de)compression runs in parallel with the tool and feeds
+a large pipe buffer. Without the program, gzip and bz2 modules are used
+instead.
+"""
+
+import argparse
+import bz2
+import errno
+import gzip
+import os
+import signal
+import subprocess
+
+
+PROGRAMS = {".gz": "gzip", ".bz2": "bzip2", ".xz": "xz"}
+
+MODULE_OPENERS = {"gzip": gzip.open, "bzip2": bz2.BZ2File}
+
+PIPE_BUFFER = 1 << 20
+
+
+def restore_sigpipe():
+    """Let a child process be killed by SIGPIPE, Python ignores it."""
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def get_program(path):
+    """Get the compression program of the file by its extension."""
+    return PROGRAMS.get(os.path.splitext(path)[1].lower())
+
+
+def is_compressed(path):
+    return get_program(path) is not None
+
+
+class CompressedFile(object):
+    """File object reading or writing a compressed file.
+
+    The data go through a pipe of the (de)compression process, or
+    through a module file object if the process is None.
+    """
+
+    def __init__(self, path, mode, stream, process=None):
+        self.name = path
+        self.mode = mode
+        self.stream = stream
+        self.process = process
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        if self.stream.closed:
+            return
+        self.stream.close()
+        if self.process is None:
+            return
+        code = self.process.wait()
+        # negative codes are signals, e.g. SIGPIPE on an early close
+        if code > 0:
+            raise IOError("%s: %s exited with code %d" % (
+                self.name, get_program(self.name), code
+            ))
+
+
+def open_file(path, mode="r", bufsize=-1):
+    """Open a file, compressed or not, like the built-in open()."""
+    program = get_program(path)
+    if program is None:
+        return open(path, mode, bufsize)
+    reading = "r" in mode
+    # the process gets a copy of the descriptor, so this one is closed
+    with open(path, "rb" if reading else mode.replace("b", "") + "b") as fd:
+        try:
+            if reading:
+                process = subprocess.Popen(
+                    [program, "-dc"], stdin=fd, stdout=subprocess.PIPE,
+                    bufsize=PIPE_BUFFER, preexec_fn=(
+                        restore_sigpipe if hasattr(signal, "SIGPIPE")
+                        else None
+                    )
+                )
+                return CompressedFile(path, mode, process.stdout, process)
+            process = subprocess.Popen(
+                [program, "-c"], stdin=subprocess.PIPE, stdout=fd,
+                bufsize=PIPE_BUFFER
+            )
+            return CompressedFile(path, mode, process.stdin, process)
+        except OSError as error:
+            if error.errno != errno.ENOENT or program not in MODULE_OPENERS:
+                raise
+    opener = MODULE_OPENERS[program]
+    return CompressedFile(path, mode, opener(path, mode.replace("b", "")))
+
+
+class FileType(argparse.FileType):
+    """argparse.FileType opening compressed files by their extensions."""
+
+    def __call__(self, string):
+        if string == "-" or not is_compressed(string):
+            return argparse.FileType.__call__(self, string)
+        try:
+            return open_file(string, self._mode, self._bufsize)
+        except (IOError, OSError) as error:
+            raise argparse.ArgumentTypeError(
+                "can't open '%s': %s" % (string, error)
+            )
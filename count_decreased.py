@@ -3,44 +3,75 @@
 """Calculate numbers of absent and under-represented sites."""
 
 import argparse
-from collections import Counter
-import math
+import numpy as np
 import signal
 import sys
 
+import cbtable
+from cbtable import CBClassifier, CodeFilter, open_cbtable
+from compressed import FileType
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-class LineParser(object):
-    def __init__(self, indices, cutoffs):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
+
+BAD, UNDER, LESS, OTHER = (0, 1, 2, 3)
+
+STATUSES = ["bad", "under", "less", "other"]
+
+# statuses of CB groups; ZERO and UNDER are both under-represented,
+# as the zero cutoff is applied to observed numbers here
+GROUP_STATUSES = np.full(cbtable.ONE + 1, OTHER, dtype=np.int64)
+GROUP_STATUSES[[cbtable.NAN, cbtable.UNR]] = BAD
+GROUP_STATUSES[[cbtable.ZERO, cbtable.UNDER]] = UNDER
+GROUP_STATUSES[cbtable.LESS] = LESS
+
+
+class Classifier(object):
+    def __init__(self, cutoffs):
         exp_cutoff, zero_cutoff, under_cutoff = cutoffs
-        self.exp_cutoff = exp_cutoff
         self.zero_cutoff = zero_cutoff
-        self.under_cutoff = under_cutoff
-
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        site = vals[self.site_index]
-        sid = None
-        if self.id_index is not None:
-            sid = vals[self.id_index]
-        obs = float(vals[self.obs_index])
-        exp = float(vals[self.exp_index])
-        is_zero = obs <= self.zero_cutoff
-        status = "bad"
-        if not (math.isnan(exp) or math.isinf(exp)
-                or exp <= self.exp_cutoff):
-            ratio = obs / exp
-            if ratio <= self.under_cutoff:
-                status = "under"
-            elif ratio < 1.0:
-                status = "less"
-            else:
-                status = "other"
-        return sid, site, is_zero, status
+        self.classifier = CBClassifier(
+            (exp_cutoff, -np.inf, under_cutoff, np.inf)
+        )
+
+    def __call__(self, obs, exp):
+        statuses = GROUP_STATUSES[self.classifier(obs, exp)]
+        return obs <= self.zero_cutoff, statuses
+
+
+class GroupCounter(object):
+    """Count site statuses by groups (sequence IDs or sites)."""
+
+    def __init__(self):
+        self.names = ["total", "zeros", "missed_zeros"] + STATUSES
+        self.counts = dict(
+            (name, np.zeros(0, dtype=np.int64)) for name in self.names
+        )
+
+    def update(self, keys, is_zero, statuses):
+        if not len(keys):
+            return
+        masks = [None, is_zero, is_zero & (statuses == BAD)]
+        masks.extend(statuses == status for status in range(len(STATUSES)))
+        size = max(len(self.counts["total"]), keys.max() + 1)
+        for name, mask in zip(self.names, masks):
+            counts = np.bincount(
+                keys if mask is None else keys[mask], minlength=size
+            )
+            counts[:len(self.counts[name])] += self.counts[name]
+            self.counts[name] = counts
+
+    def get_keys(self):
+        return np.flatnonzero(self.counts["total"])
+
+    def get_counts(self, key=None):
+        if key is None:
+            return dict(
+                (name, int(counts.sum()))
+                for name, counts in self.counts.items()
+            )
+        return dict(
+            (name, int(counts[key])) for name, counts in self.counts.items()
+        )
 
 
 def load_list(inlist):
@@ -67,18 +98,19 @@ def normalize_counts(counts, total):
     )
 
 
-def main(argv=None):
+def parse_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description="Get numbers of absent and under-represented sites.",
         add_help=False
     )
     io_group = parser.add_argument_group("Input/output arguments")
     io_group.add_argument(
-        "intsv", metavar="FILE", type=argparse.FileType("r"),
+        "intsv", metavar="FILE", type=FileType("r"),
         help="input file with compositional bias values"
     )
     io_group.add_argument(
-        "-o", dest="outsv", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="outsv", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output file name"
     )
     io_group.add_argument(
@@ -89,13 +121,18 @@ def main(argv=None):
         "-c", "--summarize", action="store_true",
         help="calculate grand total"
     )
+    io_group.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (FILE.cbc directory next to it)"""
+    )
     filter_group = parser.add_argument_group("Filters")
     filter_group.add_argument(
-        "-s", dest="instl", metavar="LIST", type=argparse.FileType("r"),
+        "-s", dest="instl", metavar="LIST", type=FileType("r"),
         help="input list of sites to filter by"
     )
     filter_group.add_argument(
-        "-a", dest="inacv", metavar="LIST", type=argparse.FileType("r"),
+        "-a", dest="inacv", metavar="LIST", type=FileType("r"),
         help="input list of sequence IDs to filter by"
     )
     cutoff_group = parser.add_argument_group("Cutoffs")
@@ -128,100 +165,129 @@ def main(argv=None):
         "-E", "--exp-index", metavar="N", type=int, default=-3,
         help="expected number column index, default -3"
     )
+    add_profile_arguments(parser.add_argument_group("Profiling"))
     parser.add_argument(
         "-h", "-?", "-help", "--help", action="help",
         help=argparse.SUPPRESS
     )
     args = parser.parse_args(argv)
-    group_by_id = args.group_by == "id"
-    summarize = args.summarize
-    metadata = [
-        "##### %s\n"
-        "##\n"
-        "## Count excluded/underrepresented sites, and sites\n"
-        "## with decreased frequencies.\n"
-        "##\n"
-        "## --- Main parameters ---\n"
-        "## Source file name: %s\n"
-        "## Group by: %s\n"
-        "## With summary: %s\n"
-        "##\n" % (parser.prog, args.intsv.name, args.group_by, summarize)
-    ]
-    indices = (args.id_index, args.site_index,
-               args.obs_index, args.exp_index)
-    metadata.append((
-        "## --- Column indices ---\n"
-        "## Sequence ID: %d\n"
-        "## Site: %d\n"
-        "## Observed: %d\n"
-        "## Expected: %d\n"
-        "##\n"
-    ) % indices)
-    sids = load_list(args.inacv)
-    sites = load_list(args.instl)
-    metadata.append((
-        "## --- Line filters ---\n"
-        "## Sequence ID filter: %s\n"
-        "## Site filter: %s\n"
-        "##\n"
-    ) % (
-        args.inacv.name if sids else None,
-        args.instl.name if sites else None
-    ))
-    cutoffs = (args.exp_cutoff, args.zero_cutoff, args.under_cutoff)
-    metadata.append((
-        "## --- Site groups ---\n"
-        "## Reliable: expected > %.1f\n"
-        "## Excluded: observed <= %d\n"
-        "## Avoided: CB <= %.2f\n"
-        "## Decreased: CB < 1.0\n"
-        "##\n"
-        "#####\n"
-    ) % cutoffs)
-    line_parser = LineParser(indices, cutoffs)
-    values = dict()
-    totals = Counter()
+    args.prog = parser.prog
+    return args
+
+
+def get_indices(args):
+    return (args.id_index, args.site_index, args.obs_index, args.exp_index)
+
+
+class DecreasedReport(object):
+    """Count site statuses of the table by chunks and write the output."""
+
+    def __init__(self, args, reader, profiler=None):
+        self.args = args
+        self.reader = reader
+        self.profiler = profiler = profiler or Profiler()
+        self.group_by_id = args.group_by == "id"
+        self.metadata = [
+            "##### %s\n"
+            "##\n"
+            "## Count excluded/underrepresented sites, and sites\n"
+            "## with decreased frequencies.\n"
+            "##\n"
+            "## --- Main parameters ---\n"
+            "## Source file name: %s\n"
+            "## Group by: %s\n"
+            "## With summary: %s\n"
+            "##\n" % (
+                args.prog, args.intsv.name, args.group_by, args.summarize
+            )
+        ]
+        self.metadata.append((
+            "## --- Column indices ---\n"
+            "## Sequence ID: %d\n"
+            "## Site: %d\n"
+            "## Observed: %d\n"
+            "## Expected: %d\n"
+            "##\n"
+        ) % get_indices(args))
+        sids = load_list(args.inacv)
+        sites = load_list(args.instl)
+        self.metadata.append((
+            "## --- Line filters ---\n"
+            "## Sequence ID filter: %s\n"
+            "## Site filter: %s\n"
+            "##\n"
+        ) % (
+            args.inacv.name if sids else None,
+            args.instl.name if sites else None
+        ))
+        cutoffs = (args.exp_cutoff, args.zero_cutoff, args.under_cutoff)
+        self.metadata.append((
+            "## --- Site groups ---\n"
+            "## Reliable: expected > %.1f\n"
+            "## Excluded: observed <= %d\n"
+            "## Avoided: CB <= %.2f\n"
+            "## Decreased: CB < 1.0\n"
+            "##\n"
+            "#####\n"
+        ) % cutoffs)
+        self.classifier = profiler.timed(Classifier(cutoffs), "classify")
+        self.counter = GroupCounter()
+        self.sid_filter = sids and CodeFilter(reader.id_coder, sids)
+        self.site_filter = sites and CodeFilter(reader.site_coder, sites)
+
+    def update(self, chunk):
+        with self.profiler.phase("aggregate"):
+            is_zero, statuses = self.classifier(chunk.obs, chunk.exp)
+            keys = chunk.ids if self.group_by_id else chunk.sites
+            mask = np.ones(len(keys), dtype=bool)
+            if self.sid_filter:
+                mask &= self.sid_filter(chunk.ids)
+            if self.site_filter:
+                mask &= self.site_filter(chunk.sites)
+            self.counter.update(keys[mask], is_zero[mask], statuses[mask])
+
+    def finish(self):
+        group_by_id = self.group_by_id
+        reader = self.reader
+        coder = reader.id_coder if group_by_id else reader.site_coder
+        counter = self.counter
+        with self.profiler.phase("write"), self.args.outsv as outsv:
+            outsv.writelines(self.metadata + reader.metadata)
+            outsv.write("#:Sequence ID\t" if group_by_id else "#:Site\t")
+            outsv.write(
+                "Total\tExcluded\tExcluded, %\tReliable\tReliable, %\t"
+                "Excluded reliable\tExcluded reliable, %\t"
+                "Avoided\tAvoided, %\tDecreased\tDecreased, %\n"
+            )
+            ouline = "%s\t%d" + "\t%d\t%.1f" * 5 + "\n"
+            keys = counter.get_keys()
+            for key, code in sorted(zip(coder.decode(keys), keys.tolist())):
+                counts = counter.get_counts(code)
+                total = counts["total"]
+                outsv.write(ouline % (
+                    (key, total) + normalize_counts(counts, total)
+                ))
+            if self.args.summarize:
+                total_counts = counter.get_counts()
+                total = total_counts["total"]
+                outsv.write(ouline % (
+                    ("Total:", total) + normalize_counts(total_counts, total)
+                ))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = get_profiler(args)
     with args.intsv as intsv:
-        for line in intsv:
-            if line.startswith("#"):
-                if line.startswith("##"):
-                    metadata.append(line)
-                continue
-            sid, site, is_zero, status = line_parser(line)
-            if sids and sid not in sids:
-                continue
-            if sites and site not in sites:
-                continue
-            key = sid if group_by_id else site
-            counts = values.setdefault(key, Counter())
-            totals[key] += 1
-            counts[status] += 1
-            if is_zero:
-                counts["zeros"] += 1
-                if status == "bad":
-                    counts["missed_zeros"] += 1
-    with args.outsv as outsv:
-        outsv.writelines(metadata)
-        outsv.write("#:Sequence ID\t" if group_by_id else "#:Site\t")
-        outsv.write(
-            "Total\tExcluded\tExcluded, %\tReliable\tReliable, %\t"
-            "Excluded reliable\tExcluded reliable, %\t"
-            "Avoided\tAvoided, %\tDecreased\tDecreased, %\n"
+        reader = open_cbtable(
+            intsv, get_indices(args), has_title=False,
+            use_cache=args.use_cache
         )
-        ouline = "%s\t%d" + "\t%d\t%.1f" * 5 + "\n"
-        for key in sorted(values):
-            total = totals[key]
-            outsv.write(ouline % (
-                (key, total) + normalize_counts(values[key], total)
-            ))
-        if summarize:
-            total_counts = Counter()
-            for counts in values.values():
-                total_counts.update(counts)
-            total = sum(totals.values())
-            outsv.write(ouline % (
-                ("Total:", total) + normalize_counts(total_counts, total)
-            ))
+        report = DecreasedReport(args, reader, profiler)
+        for chunk in profiler.chunks(reader):
+            report.update(chunk)
+    report.finish()
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -230,4 +296,3 @@ if __name__ == "__main__":
     except AttributeError:
         pass # no signal.SIGPIPE on Windows
     sys.exit(main())
-
@@ -6,18 +6,20 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Convert HMMER domtblout into TSV."
     )
     parser.add_argument(
-        "infile", metavar="DOMTBL", type=argparse.FileType("r"),
+        "infile", metavar="DOMTBL", type=FileType("r"),
         help="HMMER domtbl output"
     )
     parser.add_argument(
         "-o", "--out", dest="outsv", metavar="TSV",
-        type=argparse.FileType("w"), default=sys.stdout,
+        type=FileType("w"), default=sys.stdout,
         help="output file, default STDOUT"
     )
     args = parser.parse_args(argv)
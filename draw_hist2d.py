@@ -8,6 +8,8 @@ from matplotlib.colors import LogNorm
 from os.path import basename, splitext
 import sys
 
+from compressed import FileType
+
 
 def load_hst2d(inhst):
     """Load histogram from .h2d file"""
@@ -31,7 +33,7 @@ def main(argv=None):
         description="Draw 2D-histrogram obtained with make_hist2d."
     )
     parser.add_argument(
-        "inhst", metavar="HIST", type=argparse.FileType("r"),
+        "inhst", metavar="HIST", type=FileType("r"),
         help="a histogram to draw"
     )
     parser.add_argument(
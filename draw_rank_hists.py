@@ -7,6 +7,8 @@ from matplotlib import pyplot
 from os.path import basename, splitext
 import sys
 
+from compressed import FileType
+
 
 def load_hst(inhst):
     """Load histogram from .hst file"""
@@ -26,7 +28,7 @@ def main(argv=None):
         description="Draw histrograms obtained by make_rank_hist."
     )
     parser.add_argument(
-        "inhst", metavar="HIST", type=argparse.FileType("r"), nargs="+",
+        "inhst", metavar="HIST", type=FileType("r"), nargs="+",
         help="a histogram to draw"
     )
     parser.add_argument(
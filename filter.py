@@ -4,6 +4,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 _FILTER_NONE = 0
 _FILTER_DIRECT = 1
@@ -51,7 +53,7 @@ def main(argv=None):
         by set(s) of SIDs, sites or pairs."""
     )
     parser.add_argument(
-        "infile", metavar="FILE", type=argparse.FileType("r"),
+        "infile", metavar="FILE", type=FileType("r"),
         help="input .prs (default) or .tsv file"
     )
     parser.add_argument(
@@ -59,32 +61,32 @@ def main(argv=None):
         help="treat input file as .tsv (with title line)"
     )
     parser.add_argument(
-        "-a", "--sids", type=argparse.FileType("r"), metavar="SET",
+        "-a", "--sids", type=FileType("r"), metavar="SET",
         help="filter by the SET of sids"
     )
     parser.add_argument(
-        "-A", "--nosids", type=argparse.FileType("r"), metavar="SET",
+        "-A", "--nosids", type=FileType("r"), metavar="SET",
         help="filter by the reversed SET of sids"
     )
     parser.add_argument(
-        "-s", "--sites", type=argparse.FileType("r"), metavar="SET",
+        "-s", "--sites", type=FileType("r"), metavar="SET",
         help="filter by the SET of sites"
     )
     parser.add_argument(
-        "-S", "--nosites", type=argparse.FileType("r"), metavar="SET",
+        "-S", "--nosites", type=FileType("r"), metavar="SET",
         help="filter by the reversed SET of sites"
     )
     parser.add_argument(
-        "-p", "--pairs", type=argparse.FileType("r"), metavar="SET",
+        "-p", "--pairs", type=FileType("r"), metavar="SET",
         help="filter by the SET of pairs"
     )
     parser.add_argument(
-        "-P", "--nopairs", type=argparse.FileType("r"), metavar="SET",
+        "-P", "--nopairs", type=FileType("r"), metavar="SET",
         help="filter by the reversed SET of pairs"
     )
     parser.add_argument(
         "-o", "--out", dest="oufile", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
+        type=FileType("w"), default=sys.stdout,
         help="output file, default STDOUT"
     )
     args = parser.parse_args(argv)
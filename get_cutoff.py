@@ -1,33 +1,52 @@
 #! /usr/bin/env python2
 
-"""Calculate cutoff for the given level of significance."""
+"""Calculate cutoffs for the given levels of significance."""
 
 import argparse
-import math
+import numpy as np
 import signal
 import sys
 
+from cbtable import GROUP_TITLES, ID, SITE, open_cbtable
+from compressed import FileType
+from profiling import Profiler, add_profile_arguments, get_profiler
+from quantiles import QuantileSketch, get_k
 
-def main(argv=None):
+
+UNDER = "under"
+OVER = "over"
+
+
+def parse_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description="Calculate cutoff for the given significance level.",
+        prog=prog,
+        description="""Calculate cutoff for the given significance
+        level. With several levels, both cutoffs or cutoffs by groups, a
+        TSV table of the cutoffs is written.""",
     )
     parser.add_argument(
-        "intsv", metavar="INPUT", type=argparse.FileType("r"),
-        help="input file with observed and expected numbers"
+        "intsv", metavar="INPUT", type=FileType("r"), nargs="?",
+        help="""input file with observed and expected numbers, could be
+        omitted with --state"""
     )
     parser.add_argument(
-        "-l", "--level", dest="sig_level", metavar="F", default="5%",
-        help="level of significance, default 5%%"
+        "-l", "--level", dest="sig_levels", metavar="F[,F...]",
+        action="append", help="""level of significance, default 5%%;
+        could be a comma separated list and could be repeated"""
     )
     cutoff_group = parser.add_mutually_exclusive_group()
     cutoff_group.add_argument(
-        "-u", "--under-cutoff", dest="under_cutoff", action="store_true",
-        default=True, help="return under-representation cutoff, default"
+        "-u", "--under-cutoff", dest="directions", action="store_const",
+        const=[UNDER], default=[UNDER],
+        help="return under-representation cutoff, default"
     )
     cutoff_group.add_argument(
-        "-o", "--over-cutoff", dest="under_cutoff", action="store_false",
-        help="return over-representation cutoff"
+        "-o", "--over-cutoff", dest="directions", action="store_const",
+        const=[OVER], help="return over-representation cutoff"
+    )
+    cutoff_group.add_argument(
+        "-b", "--both-cutoffs", dest="directions", action="store_const",
+        const=[UNDER, OVER], help="return both cutoffs"
     )
     parser.add_argument(
         "-e", "--exp-cutoff", metavar="F", type=float, default=15.0,
@@ -37,54 +56,306 @@ def main(argv=None):
         "-E", "--exp-index", metavar="N", type=int, default=-3,
         help="expected number column index, default -3"
     )
+    parser.add_argument(
+        "-S", "--site-index", metavar="N", type=int,
+        help="""site column index for --group-by site, default 1 (0 with
+        --no-id)"""
+    )
+    parser.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (INPUT.cbc directory next to it)"""
+    )
     index_group = parser.add_mutually_exclusive_group()
     index_group.add_argument(
-        "-O", "--obs-index", metavar="N", type=int, default=2,
+        "-O", "--obs-index", metavar="N", type=int,
         help="observed number column index, default 2"
     )
     index_group.add_argument(
-        "--no-id", dest="obs_index", action="store_const", const=1,
-        help="""input table has no ID column, set the default observed
-        number column index to 1"""
+        "--no-id", action="store_true", help="""input table has no ID
+        column, set the default observed number column index to 1 and
+        the site column index to 0"""
+    )
+    parser.add_argument(
+        "-g", "--group-by", choices=[SITE, ID], help="""calculate the
+        cutoffs of every site (the column given by -S) or sequence ID
+        (the first column) in one pass; the table of them with a single
+        level could be given to get_group.py and get_stat.py as
+        --cutoff-table"""
+    )
+    sketch_group = parser.add_argument_group(
+        "sketch arguments", description="""Approximate cutoffs could be
+        found with a quantile sketch in bounded memory. Sketches of table
+        parts could be saved and merged."""
     )
+    sketch_group.add_argument(
+        "--sketch", action="store_true", help="""use the quantile sketch
+        instead of keeping all the ratios"""
+    )
+    sketch_group.add_argument(
+        "--sketch-error", metavar="F", type=float, default=0.001,
+        help="""relative rank error of the sketch, default 0.001; the
+        sketch keeps up to 3k ratios besides the input chunk, where
+        k = (2.296/F)^(1/0.9723), about 8600 ratios for the default"""
+    )
+    sketch_group.add_argument(
+        "--state", dest="states", metavar="FILE", action="append",
+        type=FileType("rb"), help="""sketch saved with --save-state to
+        merge the input with; could be repeated, implies --sketch"""
+    )
+    sketch_group.add_argument(
+        "--save-state", metavar="FILE", type=FileType("wb"),
+        help="""save the sketch of the states and the input to merge it
+        later, implies --sketch"""
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args(argv)
-    under_cutoff = args.under_cutoff
-    level_str = args.sig_level
-    multiplier = 1
-    if level_str.endswith("%"):
-        multiplier = 0.01
-    try:
-        sig_level = float(level_str.rstrip("%")) * multiplier
-    except ValueError:
-        parser.error(
-            "bad significance level value!\n"
-            "Valid examples: 1.5%, 0.005, .01, 1e-5, .5E-1%"
-        )
-    if sig_level < 0 or sig_level > 1:
-        parser.error(
-            "bad significance level value!\n"
-            "It should be in range [0; 1]"
+    if args.intsv is None and not args.states:
+        parser.error("no input table or states")
+    args.sketch = bool(args.sketch or args.states or args.save_state)
+    if args.group_by and args.sketch:
+        parser.error("cutoffs by groups could not be found with sketches")
+    if args.group_by == ID and args.no_id:
+        parser.error("cutoffs by sequence IDs need the ID column")
+    if args.obs_index is None:
+        args.obs_index = 2 - int(args.no_id)
+    if args.site_index is None:
+        args.site_index = 1 - int(args.no_id)
+    if not 0 < args.sketch_error < 1:
+        parser.error("the sketch error should be in range (0; 1)")
+    args.sig_levels = [
+        level_str for levels_str in args.sig_levels or ["5%"]
+        for level_str in levels_str.split(",")
+    ]
+    for index, level_str in enumerate(args.sig_levels):
+        multiplier = 1
+        if level_str.endswith("%"):
+            multiplier = 0.01
+        try:
+            level = float(level_str.rstrip("%")) * multiplier
+        except ValueError:
+            parser.error(
+                "bad significance level value!\n"
+                "Valid examples: 1.5%, 0.005, .01, 1e-5, .5E-1%"
+            )
+        if level < 0 or level > 1:
+            parser.error(
+                "bad significance level value!\n"
+                "It should be in range [0; 1]"
+            )
+        args.sig_levels[index] = level
+    return args
+
+
+def get_positions(size, levels, directions):
+    """Get positions of the cutoffs among sorted ratios.
+
+    Return a dict of positions by (direction, level) pairs.
+    The size could be an array of group sizes, the positions are arrays
+    in this case.
+    """
+    positions = dict()
+    for level in levels:
+        index = np.floor(level * np.asarray(size)).astype(np.int64)
+        for direction in directions:
+            if direction == UNDER:
+                positions[(direction, level)] = np.maximum(0, index - 1)
+            else:
+                positions[(direction, level)] = size - np.maximum(1, index)
+    return positions
+
+
+def select_cutoffs(ratios, levels, directions):
+    """Get the cutoffs by partial sorting of the ratios.
+
+    Return a dict of cutoffs by (direction, level) pairs, NaN cutoffs
+    for no ratios. The ratios array is partitioned in place.
+    """
+    positions = get_positions(len(ratios), levels, directions)
+    if not len(ratios):
+        return dict((key, np.nan) for key in positions)
+    ratios.partition(sorted(set(positions.values())))
+    return dict(
+        (key, ratios[position]) for key, position in positions.items()
+    )
+
+
+def select_group_cutoffs(ratios, codes, groups, levels, directions):
+    """Get the cutoffs of every group by sorting the ratios by groups.
+
+    Codes are group codes of the ratios, from 0 to groups - 1. Return a
+    dict of cutoff arrays (indexed by group codes) by (direction, level)
+    pairs, cutoffs of groups without ratios are NaN.
+    """
+    ratios = ratios[np.lexsort((ratios, codes))]
+    sizes = np.bincount(codes, minlength=groups)
+    starts = np.cumsum(sizes) - sizes
+    has_ratios = sizes > 0
+    cutoffs = dict()
+    positions = get_positions(sizes, levels, directions)
+    for key, group_positions in positions.items():
+        values = np.full(groups, np.nan)
+        values[has_ratios] = ratios[(starts + group_positions)[has_ratios]]
+        cutoffs[key] = values
+    return cutoffs
+
+
+def get_sketch_cutoffs(sketch, levels, directions):
+    """Get approximate cutoffs from the quantile sketch of the ratios."""
+    positions = get_positions(sketch.count, levels, directions)
+    if not sketch.count:
+        return dict((key, np.nan) for key in positions)
+    keys = positions.keys()
+    values = sketch.get_values([positions[key] for key in keys])
+    return dict(zip(keys, values.tolist()))
+
+
+def save_state(oustate, sketch, exp_cutoff):
+    """Save the sketch of ratios to be merged later."""
+    np.savez(oustate, exp_cutoff=exp_cutoff, **sketch.to_arrays())
+
+
+def load_state(instate, exp_cutoff):
+    """Load the sketch saved by save_state() with the same cutoff."""
+    arrays = np.load(instate)
+    if float(arrays["exp_cutoff"]) != exp_cutoff:
+        raise ValueError(
+            "%s: the state was saved with other expected number cutoff: "
+            "%g" % (instate.name, arrays["exp_cutoff"])
         )
-    obs_index = args.obs_index
-    exp_index = args.exp_index
-    exp_cutoff = args.exp_cutoff
-    ratios = []
-    with args.intsv as intsv:
-        _title = intsv.readline()
-        for line in intsv:
-            vals = line.strip().split("\t")
-            obs = float(vals[obs_index])
-            exp = float(vals[exp_index])
-            if math.isnan(exp) or math.isinf(exp) or exp <= exp_cutoff:
-                continue
-            ratios.append(obs / exp)
-    ratios.sort()
-    index = int(sig_level * len(ratios))
-    if under_cutoff:
-        index = max(0, index-1)
+    return QuantileSketch.from_arrays(arrays)
+
+
+def get_indices(args):
+    id_index = 0 if args.group_by == ID else None
+    site_index = args.site_index if args.group_by == SITE else None
+    return (id_index, site_index, args.obs_index, args.exp_index)
+
+
+class CutoffReport(object):
+    """Collect reliable ratios of the table by chunks, print the cutoff."""
+
+    def __init__(self, args, reader, profiler=None):
+        self.args = args
+        self.reader = reader
+        self.profiler = profiler or Profiler()
+        self.ratio_chunks = []
+        self.code_chunks = [] # group codes of the ratios
+        self.group_chunks = [] # group codes met in the table
+        self.sketch = None
+        if args.sketch:
+            self.sketch = QuantileSketch(get_k(args.sketch_error))
+
+    def update(self, chunk):
+        exp = chunk.exp
+        exp_cutoff = self.args.exp_cutoff
+        with self.profiler.phase("aggregate"):
+            with np.errstate(invalid="ignore"):
+                mask = ~(np.isnan(exp) | np.isinf(exp) | (exp <= exp_cutoff))
+            ratios = chunk.obs[mask] / exp[mask]
+            if self.args.group_by:
+                codes = chunk.ids if self.args.group_by == ID else chunk.sites
+                self.code_chunks.append(codes[mask])
+                self.group_chunks.append(np.unique(codes))
+            if self.sketch is None:
+                self.ratio_chunks.append(ratios)
+            else:
+                self.sketch.update(ratios)
+
+    def finish(self):
+        if self.args.group_by:
+            self.finish_groups()
+            return
+        levels = self.args.sig_levels
+        directions = self.args.directions
+        if self.sketch is None:
+            with self.profiler.phase("aggregate"):
+                cutoffs = select_cutoffs(
+                    np.concatenate(self.ratio_chunks or [np.zeros(0)]),
+                    levels, directions
+                )
+        else:
+            cutoffs = self.finish_sketch()
+        with self.profiler.phase("write"):
+            if len(cutoffs) == 1:
+                print "%.2f" % cutoffs.values()[0]
+                return
+            print "#:Level\t" + "\t".join(
+                "%s cutoff" % direction.capitalize()
+                for direction in directions
+            )
+            for level in levels:
+                print "%g%%\t" % (level * 100) + "\t".join(
+                    "%.2f" % cutoffs[(direction, level)]
+                    for direction in directions
+                )
+
+    def finish_groups(self):
+        levels = self.args.sig_levels
+        directions = self.args.directions
+        coder = self.reader.site_coder
+        if self.args.group_by == ID:
+            coder = self.reader.id_coder
+        empty = [np.zeros(0, dtype=np.int64)]
+        with self.profiler.phase("aggregate"):
+            cutoffs = select_group_cutoffs(
+                np.concatenate(self.ratio_chunks or [np.zeros(0)]),
+                np.concatenate(self.code_chunks or empty), len(coder),
+                levels, directions
+            )
+            groups = np.unique(np.concatenate(self.group_chunks or empty))
+        with self.profiler.phase("write"):
+            level_title = "\tLevel" if len(levels) > 1 else ""
+            print "#:%s%s\t" % (
+                GROUP_TITLES[self.args.group_by], level_title
+            ) + "\t".join(
+                "%s cutoff" % direction.capitalize()
+                for direction in directions
+            )
+            for code, name in zip(groups.tolist(), coder.decode(groups)):
+                for level in levels:
+                    level_str = ""
+                    if level_title:
+                        level_str = "\t%g%%" % (level * 100)
+                    print name + level_str + "\t" + "\t".join(
+                        "%.2f" % cutoffs[(direction, level)][code]
+                        for direction in directions
+                    )
+
+    def finish_sketch(self):
+        args = self.args
+        sketch = self.sketch
+        with self.profiler.phase("aggregate"):
+            for instate in args.states or []:
+                with instate:
+                    sketch.merge(load_state(instate, args.exp_cutoff))
+        if args.save_state:
+            with self.profiler.phase("write"), args.save_state as oustate:
+                save_state(oustate, sketch, args.exp_cutoff)
+        with self.profiler.phase("aggregate"):
+            return get_sketch_cutoffs(
+                sketch, args.sig_levels, args.directions
+            )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = get_profiler(args)
+    if args.intsv is None:
+        report = CutoffReport(args, None, profiler)
     else:
-        index = min(-1, -index)
-    print "%.2f" % ratios[index]
+        with args.intsv as intsv:
+            reader = open_cbtable(
+                intsv, get_indices(args), use_cache=args.use_cache
+            )
+            report = CutoffReport(args, reader, profiler)
+            for chunk in profiler.chunks(reader):
+                report.update(chunk)
+    try:
+        report.finish()
+    except ValueError as error:
+        sys.exit("get_cutoff.py: error: %s" % error)
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -93,4 +364,3 @@ if __name__ == "__main__":
     except AttributeError:
         pass # no signal.SIGPIPE on Windows
     sys.exit(main())
-
@@ -3,18 +3,21 @@
 """Extract CBStat groups from TSV table."""
 
 import argparse
-import math
+import numpy as np
 import signal
 import sys
 
+from cbtable import (ID, NAN, UNR, ZERO, UNDER, OVER, LESS, MORE, ONE,
+                     CBClassifier, StrandPairer, concat_columns,
+                     get_pair_keys, get_pairer, open_cbtable,
+                     read_group_cutoffs, take_columns)
+from compressed import FileType, open_file
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-NAN, UNR, ZERO, UNDER, OVER, LESS, MORE, ONE = (0, 1, 2, 3, 4, 5, 6, 7)
 
-COMPLS = {
-    "A": "T", "T": "A", "C": "G", "G": "C",
-    "B": "V", "V": "B", "D": "H", "H": "D", "N": "N",
-    "M": "K", "K": "M", "R": "Y", "Y": "R", "W": "W", "S": "S"
-}
+PAL, SYM, DIF, INC = (0, 1, 2, 3)
+
+OUTPUT_BUFFER = 1 << 20 # buffer size of group output files
 
 SITE_ABBRS = {
     "*": "ALL", "a": "ALL", "A": "ALLC", "n": "NPL", "N": "NPLC",
@@ -29,9 +32,9 @@ CB_ABBRS = {
 }
 
 SITE_GROUPS = {
-    "ALL": ["PAL", "SYM", "DIF", "INC"], "ALLC": ["PAL", "SYM", "DIF"],
-    "NPL": ["SYM", "DIF", "INC"], "NPLC": ["SYM", "DIF"],
-    "PAL": ["PAL"], "SYM": ["SYM"], "DIF": ["DIF"], "INC": ["INC"]
+    "ALL": [PAL, SYM, DIF, INC], "ALLC": [PAL, SYM, DIF],
+    "NPL": [SYM, DIF, INC], "NPLC": [SYM, DIF],
+    "PAL": [PAL], "SYM": [SYM], "DIF": [DIF], "INC": [INC]
 }
 
 CB_GROUPS = {
@@ -45,73 +48,69 @@ CB_GROUPS = {
 }
 
 
-class LineParser(object):
-    def __init__(self, indices, cutoffs):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
-        exp_cutoff, zero_cutoff, under_cutoff, over_cutoff = cutoffs
-        self.exp_cutoff = exp_cutoff
-        self.zero_cutoff = zero_cutoff
-        self.under_cutoff = under_cutoff
-        self.over_cutoff = over_cutoff
-
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        site = vals[self.site_index]
-        rsite = "".join(COMPLS.get(nucl, "?") for nucl in site[::-1])
-        watson = site if site < rsite else rsite
-        is_pal = site == rsite
-        if self.id_index is None:
-            pair = (site,)
-            pair_id = (watson,)
-        else:
-            sid = vals[self.id_index]
-            pair = (sid, site)
-            pair_id = (sid, watson)
-        obs = float(vals[self.obs_index])
-        exp = float(vals[self.exp_index])
-        group = ONE
-        if math.isnan(exp) or math.isinf(exp) or exp == 0:
-            group = NAN
-        elif exp <= self.exp_cutoff:
-            group = UNR
-        else:
-            ratio = obs / exp
-            if ratio < 1.0:
-                group = LESS
-                if ratio <= self.under_cutoff:
-                    group = UNDER if ratio > self.zero_cutoff else ZERO
-            elif ratio > 1.0:
-                group = MORE if ratio < self.over_cutoff else OVER
-        return pair, pair_id, is_pal, group
+class DoubleStrandedGroups(object):
+    """Classify rows of CB table by site and CB groups.
 
+    Iteration yields dicts of column arrays ('sgroup' for site groups,
+    'group' for CB groups, 'id', 'site' and 'pos' for row numbers) for
+    every chunk of the table. Rows are ordered as if they were yielded
+    one by one as soon as their site groups are known, incomplete rows
+    are the last (unless the pairer returns them earlier, or keeps pairs
+    aside, see cbtable.get_pairer). Chunks could also be passed to
+    update() one by one, followed by finish().
+    """
 
-class DoubleStrandedGroups(object):
-    def __init__(self, lines, line_parser, join_strands=False):
-        self.lines = lines
-        self.line_parser = line_parser
-        self.join_strands = join_strands
-        self.waits = dict()
+    def __init__(self, reader, classifier, pairer=None):
+        self.reader = reader
+        self.classifier = classifier
+        self.pairer = pairer or StrandPairer()
+        self.offset = 0
 
     def __iter__(self):
-        waits = self.waits
-        for line in self.lines:
-            pair, pair_id, is_pal, group = self.line_parser(line)
-            if is_pal:
-                yield ("PAL", group), pair
-            else:
-                if pair_id in waits:
-                    cpair, cgroup = waits.pop(pair_id)
-                    site_group = "SYM" if cgroup == group else "DIF"
-                    yield (site_group, group), pair
-                    yield (site_group, cgroup), cpair
-                else:
-                    waits[pair_id] = (pair, group)
-        for pair, group in waits.values():
-            yield ("INC", group), pair
+        for chunk in self.reader:
+            yield self.update(chunk)
+        for rows in self.finish():
+            yield rows
+
+    def update(self, chunk):
+        """Return rows of the chunk and earlier ones completed by it."""
+        groups = self.classifier.classify_chunk(chunk, self.reader)
+        watsons, is_pal = self.reader.site_coder.get_watsons(chunk.sites)
+        offset = self.offset
+        columns = {
+            "group": groups, "site": chunk.sites,
+            "pos": np.arange(offset, offset + len(groups))
+        }
+        if chunk.ids is not None:
+            columns["id"] = chunk.ids
+        self.offset += len(groups)
+        return self.get_rows(self.pairer(
+            get_pair_keys(chunk.ids, watsons), is_pal, columns
+        ))
+
+    def get_rows(self, parts):
+        pals, cpairs, pairs = parts
+        pals["sgroup"] = np.full(len(pals["pos"]), PAL)
+        pairs["sgroup"] = np.where(
+            pairs["group"] == cpairs["group"], SYM, DIF
+        )
+        cpairs["sgroup"] = pairs["sgroup"]
+        cpairs["pos"] = pairs["pos"] + 0.5 # right after the pair
+        rows = concat_columns(concat_columns(pals, pairs), cpairs)
+        incomplete = self.pairer.pop_incomplete()
+        if incomplete is not None:
+            incomplete["sgroup"] = np.full(len(incomplete["pos"]), INC)
+            rows = concat_columns(rows, incomplete)
+        return take_columns(rows, np.argsort(rows["pos"], kind="mergesort"))
+
+    def finish(self):
+        """Iterate over the rows left, incomplete ones are the last."""
+        for parts in self.pairer.drain():
+            yield self.get_rows(parts)
+        waits = self.pairer.finish()
+        if waits is not None:
+            waits["sgroup"] = np.full(len(waits["pos"]), INC)
+            yield waits
 
 
 def get_groups(group_desc):
@@ -128,7 +127,7 @@ def get_groups(group_desc):
     return groups
 
 
-def main(argv=None):
+def parse_args(argv=None, prog=None):
     group_designation_help = (
         "Group designation can be either (COL,ROW) or CR. COL and ROW\n"
         "values are case insensitive, while C and R values are not.\n\n"
@@ -149,25 +148,44 @@ def main(argv=None):
         "  over/o (over-represented).\n"
     )
     parser = argparse.ArgumentParser(
-        description="Extract CBStat groups from TSV table.",
+        prog=prog, description="Extract CBStat groups from TSV table.",
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog=group_designation_help
     )
     io_group = parser.add_argument_group("input/output arguments")
     io_group.add_argument(
-        "intsv", metavar="INPUT", type=argparse.FileType("r"),
+        "intsv", metavar="INPUT", type=FileType("r"),
         help="input file with observed and expected numbers"
     )
     io_group.add_argument(
-        "-o", "--out", metavar="OUTPUT", type=argparse.FileType("w"),
+        "-o", "--out", metavar="OUTPUT", type=FileType("w"),
         default=sys.stdout, help="""output file with extracted pairs,
         default STDOUT"""
     )
     io_group.add_argument(
-        "-g", "--group", dest="groups", metavar="(C,R) or CR",
+        "-g", "--group", dest="groups", metavar="(C,R)[:FILE] or CR[:FILE]",
         action="append", help="""designation of group to return
         pairs for, possible designations are listed below;
-        default is 'a+'"""
+        default is 'a+'; with FILE, the pairs are written to FILE instead
+        of OUTPUT, so many groups could be extracted in one pass"""
+    )
+    io_group.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (INPUT.cbc directory next to it)"""
+    )
+    pairing_group = io_group.add_mutually_exclusive_group()
+    pairing_group.add_argument(
+        "--sorted-by-id", action="store_true", help="""input rows are
+        grouped by sequence IDs, keep only the rows of the current
+        sequence waiting for complementary ones; incomplete rows are
+        written as soon as their sequence ends"""
+    )
+    pairing_group.add_argument(
+        "--spill-dir", metavar="DIR", help="""keep the rows waiting for
+        complementary ones in temporary files in DIR instead of memory,
+        for large unsorted tables; pairs are written after palindromes,
+        in no particular order"""
     )
     cutoff_group = parser.add_argument_group("cutoff arguments")
     cutoff_group.add_argument(
@@ -188,6 +206,12 @@ def main(argv=None):
         help="""over-representation cutoff (greater or equal),
         default 1.23"""
     )
+    cutoff_group.add_argument(
+        "--cutoff-table", metavar="FILE", type=FileType("r"),
+        help="""table of under- and over-representation cutoffs by sites
+        or sequence IDs, made by get_cutoff.py --group-by; the cutoffs
+        above are used for the sites or IDs missing in it"""
+    )
     index_group_desc = (
         "All column indices are counted from 0 and could be negative\n"
         "(-1 means the last column)."
@@ -215,29 +239,136 @@ def main(argv=None):
         "--no-id", action="store_true", help="""input table has no ID
         column, shift default column indices"""
     )
+    add_profile_arguments(parser.add_argument_group("profiling arguments"))
     args = parser.parse_args(argv)
-    # indices
+    if args.sorted_by_id and (args.no_id and args.id_index is None):
+        parser.error("--sorted-by-id needs the sequence ID column")
+    args.group_cutoffs = None
+    if args.cutoff_table is not None:
+        with args.cutoff_table as intsv:
+            try:
+                args.group_cutoffs = read_group_cutoffs(
+                    intsv, (args.under_cutoff, args.over_cutoff)
+                )
+            except ValueError as error:
+                parser.error(str(error))
+        if args.group_cutoffs.kind == ID and get_indices(args)[0] is None:
+            parser.error("cutoffs by sequence IDs need the ID column")
+    return args
+
+
+def get_indices(args):
     no_id = int(args.no_id)
     apply_default = lambda x, default: default if x is None else x
     id_index = apply_default(args.id_index, None if no_id else 0)
     site_index = apply_default(args.site_index, 1-no_id)
     obs_index = apply_default(args.obs_index, 2-no_id)
     exp_index = apply_default(args.exp_index, -3)
-    indices = (id_index, site_index, obs_index, exp_index)
-    # cutoffs
-    cutoffs = (
-        args.exp_cutoff, args.zero_cutoff,
-        args.under_cutoff, args.over_cutoff
-    )
-    line_parser = LineParser(indices, cutoffs)
+    return (id_index, site_index, obs_index, exp_index)
+
+
+def get_outputs(group_desc):
+    """Split GROUP[:FILE] designations by output files.
+
+    Return a list of (file name, designations) pairs in the order of
+    appearance, file name is None for designations without it.
+    """
+    outputs = []
+    for desc in group_desc:
+        desc, _sep, path = desc.partition(":")
+        path = path or None
+        for out_path, descs in outputs:
+            if out_path == path:
+                descs.append(desc)
+                break
+        else:
+            outputs.append((path, [desc]))
+    return outputs
+
+
+class GroupReport(object):
+    """Write rows of the selected groups as soon as they are known.
+
+    Every output gets the rows of its own groups, rows are decoded
+    once for all the outputs.
+    """
+
+    def __init__(self, args, reader, profiler=None):
+        cutoffs = (
+            args.exp_cutoff, args.zero_cutoff,
+            args.under_cutoff, args.over_cutoff
+        )
+        self.reader = reader
+        self.profiler = profiler = profiler or Profiler()
+        self.ds_groups = DoubleStrandedGroups(
+            reader, profiler.time_method(
+                CBClassifier(cutoffs, args.group_cutoffs), "classify"
+            ),
+            get_pairer(args.sorted_by_id, args.spill_dir)
+        )
+        self.outputs = []
+        self.default_out = args.out
+        for path, group_desc in get_outputs(args.groups or ["a+"]):
+            selected = np.zeros((INC + 1, ONE + 1), dtype=bool)
+            for site_group, cb_group in get_groups(group_desc):
+                selected[site_group, cb_group] = True
+            ouprs = args.out
+            if path is not None:
+                ouprs = open_file(path, "w", OUTPUT_BUFFER)
+            self.outputs.append((selected, ouprs))
+        self.selected = np.any([sel for sel, _ouprs in self.outputs], axis=0)
+
+    def update(self, chunk):
+        with self.profiler.phase("aggregate"):
+            rows = self.ds_groups.update(chunk)
+        self.write_rows(rows)
+
+    def finish(self):
+        for rows in self.profiler.iterate(self.ds_groups.finish(),
+                                          "aggregate"):
+            self.write_rows(rows)
+        with self.profiler.phase("write"):
+            for _selected, ouprs in self.outputs:
+                ouprs.close()
+            self.default_out.close()
+
+    def write_rows(self, rows):
+        with self.profiler.phase("format"):
+            index = self.selected[rows["sgroup"], rows["group"]]
+            sites = self.reader.site_coder.decode(rows["site"][index])
+            if "id" in rows:
+                ids = self.reader.id_coder.decode(rows["id"][index])
+                lines = ["%s\t%s\n" % pair for pair in zip(ids, sites)]
+            else:
+                lines = [site + "\n" for site in sites]
+        if len(self.outputs) == 1:
+            with self.profiler.phase("write"):
+                self.outputs[0][1].writelines(lines)
+            return
+        with self.profiler.phase("format"):
+            lines = np.array(lines, dtype=object)
+            sgroups = rows["sgroup"][index]
+            groups = rows["group"][index]
+        with self.profiler.phase("write"):
+            for selected, ouprs in self.outputs:
+                ouprs.writelines(lines[selected[sgroups, groups]])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = get_profiler(args)
     with args.intsv as intsv:
-        _title = intsv.readline()
-        ds_groups = DoubleStrandedGroups(intsv, line_parser)
-        groups = get_groups(args.groups or ["a+"])
-        with args.out as ouprs:
-            for group, pair in ds_groups:
-                if group in groups:
-                    ouprs.write("\t".join(pair) + "\n")
+        reader = open_cbtable(
+            intsv, get_indices(args), use_cache=args.use_cache
+        )
+        report = GroupReport(args, reader, profiler)
+        try:
+            for chunk in profiler.chunks(reader):
+                report.update(chunk)
+            report.finish()
+        except ValueError as error: # e.g. the table is not grouped by IDs
+            sys.exit("get_group.py: error: %s" % error)
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -246,4 +377,3 @@ if __name__ == "__main__":
     except AttributeError:
         pass # no signal.SIGPIPE on Windows
     sys.exit(main())
-
@@ -3,30 +3,282 @@
 """Get site ranks for selected pairs in control dataset."""
 
 import argparse
-from collections import Counter
-import math
+import json
+import numpy as np
+import os
+import shutil
 import sys
 
+from cbtable import ID, SITE, CodeMapper, Coder, get_pair_keys, open_cbtable
+from compressed import FileType
+from make_rank_hist import RankHistogram, get_rank_scale
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-class LineParser(object):
-    def __init__(self, indices, exp_cutoff):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
-        self.exp_cutoff = exp_cutoff
 
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        sid = vals[self.id_index]
-        site = vals[self.site_index]
-        obs = float(vals[self.obs_index])
-        exp = float(vals[self.exp_index])
-        if math.isnan(exp) or math.isinf(exp) or exp <= self.exp_cutoff:
-            return sid, site, None
-        else:
-            return sid, site, obs / exp
+INDEX_VERSION = 1
+
+SITE_MASK = (1 << 32) - 1 # site codes in the low bits of pair keys
+
+RANKS_TITLE = "Normalized ranks, %"
+
+
+def get_ratios(obs, exp, exp_cutoff):
+    """Get ratios of reliable values and the mask of the values."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mask = ~(np.isnan(exp) | np.isinf(exp) | (exp <= exp_cutoff))
+        return obs[mask] / exp[mask], mask
+
+
+def get_mid_ranks(groups, values):
+    """Get ranks of values within groups, ties get their average rank.
+
+    Values should be sorted by groups and then by values themselves,
+    ranks start from 1 in every group.
+
+    >>> groups = np.array([0, 0, 0, 0, 1, 1])
+    >>> values = np.array([0.5, 1.0, 1.0, 1.0, 2.0, 2.0])
+    >>> get_mid_ranks(groups, values).tolist()
+    [1.0, 3.0, 3.0, 3.0, 1.5, 1.5]
+    """
+    size = len(values)
+    new_group = np.ones(size, dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    new_run = new_group.copy()
+    new_run[1:] |= values[1:] != values[:-1]
+    group_starts = np.flatnonzero(new_group)
+    run_starts = np.flatnonzero(new_run)
+    run_sizes = np.diff(np.append(run_starts, size))
+    run_groups = np.cumsum(new_group)[run_starts] - 1
+    run_ranks = (
+        run_starts - group_starts[run_groups] + (run_sizes + 1) / 2.0
+    )
+    return np.repeat(run_ranks, run_sizes)
+
+
+def pair_list(text):
+    """Parse LIST[:FILE] argument, return opened list and output files."""
+    list_path, _sep, out_path = text.partition(":")
+    inprs = FileType("r")(list_path)
+    outsv = FileType("w")(out_path) if out_path else None
+    return inprs, outsv
+
+
+def read_pairs(inprs):
+    pairs = []
+    for line in inprs:
+        if line.startswith("#"):
+            continue
+        pair = line.strip().split("\t")
+        if len(pair) == 2:
+            pairs.append(pair)
+    return pairs
+
+
+def rank_pairs(reader, pair_lists, exp_cutoff, profiler=None):
+    """Rank pairs of every list among the ratios of their sites.
+
+    The table is read once for all the lists. Return a list of dicts of
+    (total, sorted ranks array) by site names, one for every pair list.
+    """
+    profiler = profiler or Profiler()
+    site_chunks = []
+    ratio_chunks = []
+    selected_chunks = [[] for _pairs in pair_lists]
+    # pairs get their own codes, the table coders (and so its cache)
+    # should not get values of the lists
+    id_coder = Coder()
+    site_coder = Coder()
+    pair_keys = []
+    for pairs in pair_lists:
+        pairs = np.array(pairs, dtype=str).reshape(-1, 2)
+        pair_keys.append(get_pair_keys(
+            id_coder.encode(pairs[:, 0]), site_coder.encode(pairs[:, 1])
+        ))
+    map_ids = CodeMapper(reader.id_coder, id_coder)
+    map_sites = CodeMapper(reader.site_coder, site_coder)
+    for chunk in profiler.chunks(reader):
+        with profiler.phase("aggregate"):
+            ratios, mask = get_ratios(chunk.obs, chunk.exp, exp_cutoff)
+            # only sites of the pairs are ranked
+            sites = map_sites(chunk.sites[mask])
+            kept = sites >= 0
+            sites = sites[kept]
+            # IDs out of the lists get negative keys matching no pair
+            keys = get_pair_keys(map_ids(chunk.ids[mask][kept]), sites)
+            site_chunks.append(sites)
+            ratio_chunks.append(ratios[kept])
+            for chunks, list_keys in zip(selected_chunks, pair_keys):
+                chunks.append(np.in1d(keys, list_keys))
+    with profiler.phase("rank"):
+        sites = np.concatenate(site_chunks or [np.zeros(0, dtype=np.int64)])
+        ratios = np.concatenate(ratio_chunks or [np.zeros(0)])
+        order = np.lexsort((ratios, sites))
+        sites = sites[order]
+        ranks = get_mid_ranks(sites, ratios[order])
+        site_codes, totals = np.unique(sites, return_counts=True)
+        site_names = site_coder.decode(site_codes)
+        list_ranks = []
+        for chunks in selected_chunks:
+            selected = np.concatenate(chunks or [np.zeros(0, dtype=bool)])
+            selected = selected[order]
+            # selected ranks are sorted within sites as the ratios are
+            selected_ranks = ranks[selected]
+            bounds = np.searchsorted(sites[selected], site_codes)
+            bounds = np.append(bounds, len(selected_ranks))
+            list_ranks.append(dict(
+                (site, (total, selected_ranks[start:end]))
+                for site, total, start, end in zip(
+                    site_names, totals.tolist(), bounds[:-1], bounds[1:]
+                ) if end > start
+            ))
+        return list_ranks
+
+
+def build_index(path, reader, exp_cutoff, profiler=None):
+    """Write the rank index of the table to the path directory.
+
+    The index keeps reliable ratios sorted by sites and ratios with the
+    bounds of every site, and the ratios by sorted (ID, site) keys, as
+    .npy files to be memory-mapped, with the ID and site coders.
+    """
+    profiler = profiler or Profiler()
+    id_chunks = []
+    site_chunks = []
+    ratio_chunks = []
+    for chunk in profiler.chunks(reader):
+        with profiler.phase("aggregate"):
+            ratios, mask = get_ratios(chunk.obs, chunk.exp, exp_cutoff)
+            id_chunks.append(chunk.ids[mask])
+            site_chunks.append(chunk.sites[mask])
+            ratio_chunks.append(ratios)
+    empty = [np.zeros(0, dtype=np.int64)]
+    with profiler.phase("rank"):
+        ids = np.concatenate(id_chunks or empty)
+        sites = np.concatenate(site_chunks or empty)
+        ratios = np.concatenate(ratio_chunks or [np.zeros(0)])
+        order = np.lexsort((ratios, sites))
+        keys = get_pair_keys(ids, sites)
+        key_order = np.argsort(keys, kind="mergesort")
+        arrays = {
+            "ratios": ratios[order],
+            "site_bounds": np.searchsorted(
+                sites[order], np.arange(len(reader.site_coder) + 1)
+            ),
+            "keys": keys[key_order], "key_ratios": ratios[key_order],
+        }
+    header = {
+        "version": INDEX_VERSION, "exp_cutoff": exp_cutoff,
+        "rows": len(ratios)
+    }
+    with profiler.phase("write"):
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        os.mkdir(tmp_path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, name + ".npy"), array)
+            for kind, coder in [(ID, reader.id_coder),
+                                (SITE, reader.site_coder)]:
+                with open(os.path.join(tmp_path, kind), "w") as oucdr:
+                    oucdr.writelines(value + "\n" for value in coder.values)
+            with open(os.path.join(tmp_path, "header"), "w") as ouhdr:
+                json.dump(header, ouhdr)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+
+class RankIndex(object):
+    """Rank index written by build_index(), with memory-mapped arrays."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, "header")) as inhdr:
+                header = json.load(inhdr)
+        except (IOError, OSError, ValueError):
+            raise ValueError("%s: not a rank index" % path)
+        if header.get("version") != INDEX_VERSION:
+            raise ValueError("%s: unsupported index version" % path)
+        self.exp_cutoff = header["exp_cutoff"]
+        self.id_coder = self.load_coder(ID)
+        self.site_coder = self.load_coder(SITE)
+        self.arrays = dict()
+        for name in ["ratios", "site_bounds", "keys", "key_ratios"]:
+            array_path = os.path.join(path, name + ".npy")
+            # empty arrays could not be mapped
+            mmap_mode = "r" if header["rows"] else None
+            self.arrays[name] = np.load(array_path, mmap_mode=mmap_mode)
+
+    def load_coder(self, kind):
+        coder = Coder()
+        with open(os.path.join(self.path, kind)) as incdr:
+            for line in incdr:
+                coder.add(line.rstrip("\n"))
+        return coder
+
+    def rank_pairs(self, pairs):
+        """Rank the pairs by binary search, like rank_pairs() does."""
+        id_codes = self.id_coder.codes
+        site_codes = self.site_coder.codes
+        pairs = [
+            (id_codes[seq_id], site_codes[site]) for seq_id, site in pairs
+            if seq_id in id_codes and site in site_codes
+        ]
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        pair_keys = np.unique(get_pair_keys(pairs[:, 0], pairs[:, 1]))
+        keys = self.arrays["keys"]
+        starts = np.searchsorted(keys, pair_keys, side="left")
+        counts = np.searchsorted(keys, pair_keys, side="right") - starts
+        # rows of all the found keys, duplicated keys included
+        rows = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        rows += np.arange(len(rows))
+        ratios = self.arrays["key_ratios"][rows]
+        sites = keys[rows] & SITE_MASK
+        site_bounds = self.arrays["site_bounds"]
+        site_ranks = dict()
+        for site_code in np.unique(sites).tolist():
+            start, end = site_bounds[site_code:site_code+2]
+            site_ratios = self.arrays["ratios"][start:end]
+            selected = np.sort(ratios[sites == site_code])
+            lower = np.searchsorted(site_ratios, selected, side="left")
+            upper = np.searchsorted(site_ratios, selected, side="right")
+            site_ranks[self.site_coder.values[site_code]] = (
+                end - start, lower + (upper - lower + 1) / 2.0
+            )
+        return site_ranks
+
+
+def format_normed_ranks(total, ranks):
+    """Format normalized ranks as percents rounded to 0.1%."""
+    normed_ranks = (ranks - 0.5) * 100.0 / total
+    return ["%.1f" % item for item in normed_ranks.tolist()]
+
+
+def make_rank_hist(site_ranks, bins, cutoff):
+    """Bin rounded normalized ranks like make_rank_hist.py does."""
+    hist = RankHistogram(bins, cutoff)
+    scale = get_rank_scale(RANKS_TITLE)
+    for total, ranks in site_ranks.values():
+        hist.update(total, [
+            float(item) * scale for item in format_normed_ranks(total, ranks)
+        ])
+    return hist
+
+
+def write_ranks(outsv, site_ranks):
+    outsv.write("#:Site\tTotal\tRanks\t%s\n" % RANKS_TITLE)
+    for site in sorted(site_ranks):
+        total, ranks = site_ranks[site]
+        outsv.write("%s\t%d\t%s\t%s\n" % (
+            site, total,
+            ",".join((
+                "%d" if item.is_integer() else "%.1f"
+            ) % item for item in ranks.tolist()),
+            ",".join(format_normed_ranks(total, ranks))
+        ))
 
 
 def main(argv=None):
@@ -34,22 +286,56 @@ def main(argv=None):
         description="Get site ranks for selected pairs in control dataset"
     )
     parser.add_argument(
-        "intsv", metavar="TSV", type=argparse.FileType("r"),
-        help="input control dataset"
+        "intsv", metavar="TSV", type=FileType("r"), nargs="?",
+        help="input control dataset, could be omitted with --index"
     )
     parser.add_argument(
-        "-p", "--pairs", metavar="LIST", type=argparse.FileType("r"),
-        help="input list of pairs to calculate ranks for"
+        "-p", "--pairs", dest="pair_lists", metavar="LIST[:FILE]",
+        type=pair_list, action="append", help="""input list of pairs to
+        calculate ranks for, with the output file; could be repeated,
+        all the lists are ranked with one reading of the control
+        dataset"""
     )
     parser.add_argument(
         "-o", "--out", dest="outsv", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
-        help="output file, default is STDOUT"
+        type=FileType("w"), help="""output file of the pair list without
+        its own one, default is STDOUT unless --hist is given"""
     )
     parser.add_argument(
         "--exp-cutoff", metavar="F", type=float, default=15.0,
         help="expected number cutoff, default 15.0"
     )
+    parser.add_argument(
+        "-x", "--index", metavar="DIR", help="""rank index of the
+        control dataset: with TSV, the index is built (or rebuilt) in
+        DIR, and nothing else is done without pair lists; without TSV,
+        the ranks are found in the index, the control dataset is not
+        read"""
+    )
+    parser.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (TSV.cbc directory next to it)"""
+    )
+    hist_group = parser.add_argument_group(
+        "histogram arguments", description="""The histogram of
+        normalized ranks of a single pair list could be made right away,
+        as make_rank_hist.py makes it from the output."""
+    )
+    hist_group.add_argument(
+        "--hist", dest="ouhst", metavar="FILE", type=FileType("w"),
+        help="""output histogram file; the ranks are written only to the
+        output files given"""
+    )
+    hist_group.add_argument(
+        "--bins", dest="bins_number", type=int, default=41,
+        help="number of histogram bins, default 41"
+    )
+    hist_group.add_argument(
+        "--cutoff", type=int, default=0,
+        help="total number cutoff of the histogram, default 0"
+    )
+    add_profile_arguments(parser)
     index_group_desc = (
         "All column indices are counted from 0 and could be negative\n"
         "(-1 means the last column)."
@@ -74,52 +360,76 @@ def main(argv=None):
         help="expected number column index, default -3"
     )
     args = parser.parse_args(argv)
+    if args.intsv is None and args.index is None:
+        parser.error("no control dataset or index")
+    profiler = get_profiler(args)
     indices = (args.id_index, args.site_index,
                args.obs_index, args.exp_index)
-    line_parser = LineParser(indices, args.exp_cutoff)
-    pairs = set()
-    if args.pairs:
-        with args.pairs as inprs:
-            for line in inprs:
-                if line.startswith("#"):
-                    continue
-                pairs.add(tuple(line.strip().split("\t")))
-    selected = dict()
-    ratios = dict()
-    with args.intsv as intsv:
-        _title = intsv.readline()
-        for line in intsv:
-            if line.startswith("#"):
+    if args.ouhst and len(args.pair_lists or []) > 1:
+        parser.error("--hist works with a single pair list")
+    # an index could be built alone, nothing is ranked then
+    build_only = args.index is not None and not args.pair_lists
+    if build_only and args.intsv is None:
+        parser.error("no pair lists to rank with the index")
+    if build_only and (args.outsv or args.ouhst):
+        parser.error("no pair lists to write the ranks of")
+    if args.outsv is None and not args.ouhst:
+        args.outsv = sys.stdout
+    outputs = [
+        outsv or args.outsv for _inprs, outsv in args.pair_lists or []
+    ] or [args.outsv]
+    names = [outsv.name for outsv in outputs if outsv is not None]
+    if len(set(names)) < len(names):
+        parser.error("several pair lists are written to the same file")
+    pair_lists = []
+    with profiler.phase("parse"):
+        for inprs, _outsv in args.pair_lists or [(None, None)]:
+            if inprs is None:
+                pair_lists.append([])
                 continue
-            sid, site, ratio = line_parser(line)
-            if ratio is None:
+            with inprs:
+                pair_lists.append(read_pairs(inprs))
+    if args.intsv is not None:
+        with args.intsv as intsv:
+            reader = open_cbtable(intsv, indices, use_cache=args.use_cache)
+            if args.index is None:
+                list_ranks = rank_pairs(
+                    reader, pair_lists, args.exp_cutoff, profiler
+                )
+            else:
+                build_index(args.index, reader, args.exp_cutoff, profiler)
+    if build_only:
+        profiler.report()
+        return
+    if args.index is not None:
+        with profiler.phase("rank"):
+            try:
+                index = RankIndex(args.index)
+            except ValueError as error:
+                parser.error(str(error))
+            if index.exp_cutoff != args.exp_cutoff:
+                parser.error(
+                    "the index was built with other expected number "
+                    "cutoff: %g" % index.exp_cutoff
+                )
+            list_ranks = [index.rank_pairs(pairs) for pairs in pair_lists]
+    with profiler.phase("write"):
+        for outsv, site_ranks in zip(outputs, list_ranks):
+            if outsv is None:
                 continue
-            ratios.setdefault(site, []).append(ratio)
-            if (sid, site) in pairs:
-                selected.setdefault(site, []).append(ratio)
-    with args.outsv as outsv:
-        outsv.write("#:Site\tTotal\tRanks\tNormalized ranks, %\n")
-        for site in sorted(selected.keys()):
-            ranks = dict()
-            counter = Counter(ratios[site])
-            rank = 0
-            for ratio, count in sorted(counter.items()):
-                ranks[ratio] = rank + (count + 1.0) / 2
-                rank += count
-            selected_ranks = []
-            for ratio in selected[site]:
-                selected_ranks.append(ranks[ratio])
-            selected_ranks.sort()
-            normed_ranks = [
-                (item - 0.5) * 100.0 / rank for item in selected_ranks
-            ]
-            outsv.write("%s\t%d\t%s\t%s\n" % (
-                site, rank,
-                ",".join((
-                    "%d" if item.is_integer() else "%.1f"
-                ) % item for item in selected_ranks),
-                ",".join("%.1f" % item for item in normed_ranks)
-            ))
+            with outsv:
+                write_ranks(outsv, site_ranks)
+        if args.ouhst:
+            source = args.index
+            if args.pair_lists:
+                source = args.pair_lists[0][0].name
+            elif args.intsv is not None:
+                source = args.intsv.name
+            with args.ouhst as ouhst:
+                make_rank_hist(
+                    list_ranks[0], args.bins_number, args.cutoff
+                ).write(ouhst, source)
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def load_dct(indct, value_type=str, default=None):
     vals = dict()
@@ -25,19 +27,19 @@ def main(argv=None):
         description="Keep the only representative of each group."
     )
     parser.add_argument(
-        "intsv", metavar="TSV", type=argparse.FileType("r"),
+        "intsv", metavar="TSV", type=FileType("r"),
         help="input .tsv file"
     )
     parser.add_argument(
-        "-g", "--groups", metavar="DICT", type=argparse.FileType("r"),
+        "-g", "--groups", metavar="DICT", type=FileType("r"),
         default=sys.stdin, help="group dictionary, default STDIN"
     )
     parser.add_argument(
-        "-o", dest="outsv", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="outsv", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output file, default STDOUT"
     )
     parser.add_argument(
-        "-v", "--values", metavar="DICT", type=argparse.FileType("r"),
+        "-v", "--values", metavar="DICT", type=FileType("r"),
         help="""dictionary of values (integer) to sort by, IDs with
         the same values are sorted alphabetically; default values are
         line indices"""
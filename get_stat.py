@@ -1,21 +1,25 @@
 #! /usr/bin/env python2
 
 import argparse
+import itertools
 import markdown
-import math
+import multiprocessing
+import numpy as np
+import os
 import sys
 
 from collections import Counter
 from markdown.extensions.tables import TableExtension
 from os.path import splitext
 
+from cbtable import (ID, CBClassifier, Coder, StrandPairer, get_pair_keys,
+                     get_pairer, open_cbtable, open_table_part,
+                     read_group_cutoffs, split_table)
+from compressed import FileType
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-NAN, UNR, ZERO, UNDER, OVER, LESS, MORE, ONE = (0, 1, 2, 3, 4, 5, 6, 7)
-ABBRS = ["nan", "low", "zer", "und", "ove", "les", "mor", "one"]
 
-COMPLS = {"A": "T", "T": "A", "C": "G", "G": "C",
-          "B": "V", "V": "B", "D": "H", "H": "D", "N": "N",
-          "M": "K", "K": "M", "R": "Y", "Y": "R", "W": "W", "S": "S"}
+ABBRS = ["nan", "low", "zer", "und", "ove", "les", "mor", "one"]
 
 CBCOLS = {
     "A": ("All", "all"), "P": ("Palindrome", "pal"),
@@ -229,75 +233,188 @@ class FormatManager(object):
         )
         return self.output_stub.format(**prepared_vals)
 
-class LineParser(object):
-    def __init__(self, indices, cutoffs):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
-        exp_cutoff, zero_cutoff, under_cutoff, over_cutoff = cutoffs
-        self.exp_cutoff = exp_cutoff
-        self.zero_cutoff = zero_cutoff
-        self.under_cutoff = under_cutoff
-        self.over_cutoff = over_cutoff
-
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        sid = None if self.id_index is None else vals[self.id_index]
-        site = vals[self.site_index]
-        rsite = "".join(COMPLS.get(nucl, "?") for nucl in site[::-1])
-        site_ds = (site, rsite) if site < rsite else (rsite, site)
-        obs = float(vals[self.obs_index])
-        exp = float(vals[self.exp_index])
-        group = ONE
-        if math.isnan(exp) or math.isinf(exp) or exp == 0:
-            group = NAN
-        elif exp <= self.exp_cutoff:
-            group = UNR
-        else:
-            ratio = obs / exp
-            if ratio < 1.0:
-                group = LESS
-                if ratio <= self.under_cutoff:
-                    group = UNDER if ratio > self.zero_cutoff else ZERO
-            elif ratio > 1.0:
-                group = MORE if ratio < self.over_cutoff else OVER
-        return sid, site_ds, group
-
-def collect_stat(intsv, line_parser):
-    cbstat_ss = {
-        "pal": [0] * len(ABBRS), # palindromes
-        "sam": [0] * len(ABBRS), # coinside
-        "dif": [0] * len(ABBRS), # differ
-        "inc": [0] * len(ABBRS), # incomplete
+def count_groups(groups):
+    return np.bincount(groups, minlength=len(ABBRS))
+
+def new_raw_stat():
+    empty = np.zeros(len(ABBRS), dtype=np.int64)
+    return {
+        "pal": empty.copy(), # palindromes
+        "sam": empty.copy(), # coinside
+        "dif": empty.copy(), # differ
+        "inc": empty.copy(), # incomplete
+        "jg": np.zeros(len(ABBRS) ** 2, dtype=np.int64), # joint groups
+    }
+
+def count_pairs(raw_stat, pals, cpairs, pairs):
+    raw_stat["pal"] += count_groups(pals["group"])
+    group = pairs["group"]
+    cgroup = cpairs["group"]
+    same = group == cgroup
+    raw_stat["sam"] += count_groups(group[same]) * 2
+    group = group[~same]
+    cgroup = cgroup[~same]
+    raw_stat["dif"] += count_groups(group) + count_groups(cgroup)
+    raw_stat["jg"] += np.bincount(
+        np.minimum(group, cgroup) * len(ABBRS) + np.maximum(group, cgroup),
+        minlength=len(raw_stat["jg"])
+    )
+
+class StatCollector(object):
+    """Collect raw statistics of a table or a part of it by chunks."""
+
+    def __init__(self, reader, classifier, pairer=None):
+        self.reader = reader
+        self.classifier = classifier
+        self.raw_stat = new_raw_stat()
+        self.pairer = pairer or StrandPairer()
+
+    def update(self, chunk):
+        groups = self.classifier.classify_chunk(chunk, self.reader)
+        watsons, is_pal = self.reader.site_coder.get_watsons(chunk.sites)
+        columns = {"group": groups, "site": watsons}
+        if chunk.ids is not None:
+            columns["id"] = chunk.ids
+        self.count(self.pairer(
+            get_pair_keys(chunk.ids, watsons), is_pal, columns
+        ))
+
+    def count(self, parts):
+        count_pairs(self.raw_stat, *parts)
+        incomplete = self.pairer.pop_incomplete()
+        if incomplete is not None:
+            self.raw_stat["inc"] += count_groups(incomplete["group"])
+
+    def finish(self):
+        """Return raw counts and the rows waiting for complementary ones.
+
+        Waiting rows are returned with decoded IDs and Watson sites, or
+        as None, to be merged by merge_raw_stats().
+        """
+        for parts in self.pairer.drain():
+            self.count(parts)
+        return self.raw_stat, decode_waits(
+            self.pairer.finish(), self.reader.id_coder,
+            self.reader.site_coder
+        )
+
+def decode_waits(waits, id_coder, site_coder):
+    if waits is None:
+        return None
+    ids = None
+    if "id" in waits:
+        ids = id_coder.decode(waits["id"])
+    return {
+        "id": ids, "site": site_coder.decode(waits["site"]),
+        "group": waits["group"]
     }
-    waits = dict()
+
+def collect_raw_stat(reader, classifier, pairer=None, profiler=None):
+    """Collect raw statistics of a table or a part of it.
+
+    Return raw counts and the rows waiting for complementary ones (with
+    decoded IDs and Watson sites, or None), to be merged by
+    merge_raw_stats().
+    """
+    profiler = profiler or Profiler()
+    collector = StatCollector(
+        reader, profiler.time_method(classifier, "classify"), pairer
+    )
+    for chunk in profiler.chunks(reader):
+        with profiler.phase("aggregate"):
+            collector.update(chunk)
+    with profiler.phase("aggregate"):
+        return collector.finish()
+
+class SweepCollector(object):
+    """Collect raw statistics for many cutoff sets in one pass.
+
+    Pairing of rows does not depend on cutoffs, so rows are paired once
+    with their ratios and expected numbers, and only classified for every
+    set of cutoffs.
+    """
+
+    def __init__(self, reader, classifiers, pairer=None):
+        self.reader = reader
+        self.classifiers = classifiers
+        self.raw_stats = [new_raw_stat() for _classifier in classifiers]
+        self.pairer = pairer or StrandPairer()
+
+    def update(self, chunk):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = chunk.obs / chunk.exp
+        watsons, is_pal = self.reader.site_coder.get_watsons(chunk.sites)
+        self.count(self.pairer(
+            get_pair_keys(chunk.ids, watsons), is_pal,
+            {"ratio": ratios, "exp": chunk.exp}
+        ))
+
+    def count(self, parts):
+        for classifier, raw_stat in zip(self.classifiers, self.raw_stats):
+            count_pairs(raw_stat, *[
+                {"group": classifier.classify(part["ratio"], part["exp"])}
+                for part in parts
+            ])
+        self.count_incomplete(self.pairer.pop_incomplete())
+
+    def count_incomplete(self, rows):
+        if rows is None:
+            return
+        for classifier, raw_stat in zip(self.classifiers, self.raw_stats):
+            raw_stat["inc"] += count_groups(
+                classifier.classify(rows["ratio"], rows["exp"])
+            )
+
+    def finish(self):
+        """Return raw counts for every set of cutoffs."""
+        for parts in self.pairer.drain():
+            self.count(parts)
+        self.count_incomplete(self.pairer.finish())
+        return self.raw_stats
+
+def merge_raw_stats(partial_stats, keep_waits=False):
+    """Merge raw statistics of table parts given in the table order.
+
+    Rows left waiting for complementary ones are counted as incomplete,
+    or returned with the counts, like by collect_raw_stat(), if
+    keep_waits is set.
+    """
+    raw_stat = new_raw_stat()
+    pairer = StrandPairer()
+    id_coder = Coder()
+    site_coder = Coder()
+    for partial_stat, waits in partial_stats:
+        for abbr, counts in partial_stat.items():
+            raw_stat[abbr] += counts
+        if waits is None:
+            continue
+        ids = waits["id"]
+        if ids is not None:
+            ids = id_coder.encode(np.array(ids))
+        sites = site_coder.encode(np.array(waits["site"]))
+        columns = {"group": waits["group"], "site": sites}
+        if ids is not None:
+            columns["id"] = ids
+        keys = get_pair_keys(ids, sites)
+        count_pairs(raw_stat, *pairer(
+            keys, np.zeros(len(keys), dtype=bool), columns
+        ))
+    waits = pairer.finish()
+    if keep_waits:
+        return raw_stat, decode_waits(waits, id_coder, site_coder)
+    if waits is not None:
+        raw_stat["inc"] += count_groups(waits["group"])
+    return raw_stat
+
+def get_cbstats(raw_stat):
+    cbstat_ss = dict(
+        (abbr, raw_stat[abbr].tolist())
+        for abbr in ["pal", "sam", "dif", "inc"]
+    )
     jgstat = Counter()
-    with intsv:
-        intsv.readline()
-        for line in intsv:
-            sid, site, group = line_parser(line)
-            wsite, csite = site
-            if wsite != csite:
-                pr = (sid, site)
-                if pr in waits:
-                    cgroup = waits.pop(pr)
-                    if cgroup == group:
-                        cbstat_ss["sam"][group] += 2
-                    else:
-                        cbstat_ss["dif"][group] += 1
-                        cbstat_ss["dif"][cgroup] += 1
-                        if group < cgroup:
-                            jgstat[(group, cgroup)] += 1
-                        else:
-                            jgstat[(cgroup, group)] += 1
-                else:
-                    waits[pr] = group
-            else:
-                cbstat_ss["pal"][group] += 1
-    for group in waits.values():
-        cbstat_ss["inc"][group] += 1
+    for index, count in enumerate(raw_stat["jg"].tolist()):
+        if count:
+            jgstat[divmod(index, len(ABBRS))] = count
     cbstat_ds = dict()
     cbstat_ds["pal"] = cbstat_ss["pal"]
     cbstat_ds["sam"] = [val//2 for val in cbstat_ss["sam"]]
@@ -307,6 +424,114 @@ def collect_stat(intsv, line_parser):
     cbstat_ds["dif"] = cbstat_ds_dif
     return cbstat_ss, cbstat_ds, jgstat
 
+def collect_stat(reader, classifier):
+    return get_cbstats(merge_raw_stats([
+        collect_raw_stat(reader, classifier)
+    ]))
+
+def collect_part_stat(task):
+    part, indices, cutoffs, group_cutoffs = task
+    return collect_raw_stat(
+        open_table_part(part, indices), CBClassifier(cutoffs, group_cutoffs)
+    )
+
+def collect_raw_stats_parallel(path, indices, cutoffs, jobs,
+                               use_cache=True, group_cutoffs=None):
+    """Collect raw statistics with worker processes, by table parts."""
+    parts = split_table(path, jobs, indices, use_cache=use_cache)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        partial_stats = pool.map(collect_part_stat, [
+            (part, indices, cutoffs, group_cutoffs) for part in parts
+        ])
+    finally:
+        pool.close()
+        pool.join()
+    return partial_stats
+
+def count_rows(state):
+    """Count rows of the table behind raw statistics."""
+    raw_stat, waits = state
+    rows = sum(
+        int(raw_stat[abbr].sum()) for abbr in ["pal", "sam", "dif", "inc"]
+    )
+    return rows + (0 if waits is None else len(waits["site"]))
+
+def save_state(oustate, state, cutoffs, group_cutoffs=None):
+    """Save raw statistics with waiting rows to be merged later."""
+    raw_stat, waits = state
+    arrays = dict(
+        ("stat_" + abbr, counts) for abbr, counts in raw_stat.items()
+    )
+    arrays["cutoffs"] = np.array(cutoffs, dtype=np.float64)
+    if group_cutoffs is not None:
+        arrays.update(group_cutoffs.to_arrays())
+    if waits is not None:
+        if waits["id"] is not None:
+            arrays["wait_id"] = np.array(waits["id"], dtype=str)
+        arrays["wait_site"] = np.array(waits["site"], dtype=str)
+        arrays["wait_group"] = waits["group"]
+    np.savez(oustate, **arrays)
+
+def is_same_group_cutoffs(arrays, group_cutoffs):
+    """Check cutoffs by groups saved by save_state(), NaNs are equal."""
+    expected = dict()
+    if group_cutoffs is not None:
+        expected = group_cutoffs.to_arrays()
+    saved_keys = [key for key in arrays.files if key.startswith("group_")]
+    if sorted(saved_keys) != sorted(expected):
+        return False
+    for key, value in expected.items():
+        saved = arrays[key]
+        value = np.asarray(value)
+        if value.dtype.kind != "f":
+            if saved.tolist() != value.tolist():
+                return False
+        elif not (np.array_equal(np.isnan(saved), np.isnan(value)) and
+                  np.array_equal(np.nan_to_num(saved), np.nan_to_num(value))):
+            return False
+    return True
+
+def load_state(instate, cutoffs, group_cutoffs=None):
+    """Load raw statistics saved by save_state() with the same cutoffs."""
+    try:
+        arrays = np.load(instate)
+    except (IOError, ValueError):
+        arrays = None
+    if "cutoffs" not in getattr(arrays, "files", []):
+        raise ValueError("%s: not a saved state" % instate.name)
+    if arrays["cutoffs"].tolist() != list(cutoffs):
+        raise ValueError(
+            "%s: the state was saved with other cutoffs: %s" % (
+                instate.name, ", ".join(map(str, arrays["cutoffs"]))
+            )
+        )
+    if not is_same_group_cutoffs(arrays, group_cutoffs):
+        raise ValueError(
+            "%s: the state was saved with other cutoffs by groups" %
+            instate.name
+        )
+    raw_stat = new_raw_stat()
+    for abbr in raw_stat:
+        raw_stat[abbr] += arrays["stat_" + abbr]
+    if "wait_site" not in arrays:
+        return raw_stat, None
+    ids = None
+    if "wait_id" in arrays:
+        ids = arrays["wait_id"].tolist()
+    return raw_stat, {
+        "id": ids, "site": arrays["wait_site"].tolist(),
+        "group": arrays["wait_group"]
+    }
+
+def load_states(args):
+    cutoffs = get_cutoffs(args)
+    states = []
+    for instate in args.states or []:
+        with instate:
+            states.append(load_state(instate, cutoffs, args.group_cutoffs))
+    return states
+
 def summarize_cbstat(cbstat, spacer="_"):
     vals = dict()
     clusters = dict()
@@ -356,17 +581,26 @@ def summarize_jgstat(jgstat, spacer="_"): # jgstat is a Counter instance
             vals[abbr1 + spacer + abbr2] = (value, group_total)
     return vals
 
-def main(argv=None):
+def float_list(text):
+    try:
+        return [float(value) for value in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "bad list of numbers: %r" % text
+        )
+
+def parse_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description="Get site compositional bias statistics."
+        prog=prog, description="Get site compositional bias statistics."
     )
     io_group = parser.add_argument_group("input/output arguments")
     io_group.add_argument(
-        "intsv", metavar="INPUT", type=argparse.FileType("r"),
-        help="input file with observed and expected numbers"
+        "intsv", metavar="INPUT", type=FileType("r"), nargs="*",
+        help="""input files with observed and expected numbers, read as
+        consecutive parts of one table"""
     )
     io_group.add_argument(
-        "-o", "--out", metavar="OUTPUT", type=argparse.FileType("w"),
+        "-o", "--out", metavar="OUTPUT", type=FileType("w"),
         default=sys.stdout, help="""output file, default stdout;
         note: .md and .html extensions will alter output format"""
     )
@@ -379,6 +613,39 @@ def main(argv=None):
         "--force-short-counts", dest="shorten", action="store_true",
         help="use short number format even in markdown and html"
     )
+    io_group.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (INPUT.cbc directory next to it)"""
+    )
+    io_group.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="""number of worker processes to split the input between,
+        default 1; the input should be a regular file with IDs"""
+    )
+    io_group.add_argument(
+        "--state", dest="states", metavar="FILE", action="append",
+        type=FileType("rb"), help="""raw statistics saved with
+        --save-state to merge the input with, as the preceding parts of
+        the table; could be repeated"""
+    )
+    io_group.add_argument(
+        "--save-state", metavar="FILE", type=FileType("wb"),
+        help="""save raw statistics of the states and the input, with
+        the rows waiting for complementary ones, to merge them later"""
+    )
+    pairing_group = io_group.add_mutually_exclusive_group()
+    pairing_group.add_argument(
+        "--sorted-by-id", action="store_true", help="""input rows are
+        grouped by sequence IDs, keep only the rows of the current
+        sequence waiting for complementary ones; not split between
+        jobs"""
+    )
+    pairing_group.add_argument(
+        "--spill-dir", metavar="DIR", help="""keep the rows waiting for
+        complementary ones in temporary files in DIR instead of memory,
+        for large unsorted tables; not split between jobs"""
+    )
     cutoff_group = parser.add_argument_group("cutoff arguments")
     cutoff_group.add_argument(
         "--exp-cutoff", metavar="F", type=float, default=15.0,
@@ -398,6 +665,33 @@ def main(argv=None):
         help="""over-representation cutoff (greater or equal),
         default 1.2"""
     )
+    cutoff_group.add_argument(
+        "--cutoff-table", metavar="FILE", type=FileType("r"),
+        help="""table of under- and over-representation cutoffs by sites
+        or sequence IDs, made by get_cutoff.py --group-by; the cutoffs
+        above are used for the sites or IDs missing in it"""
+    )
+    sweep_group = parser.add_argument_group(
+        "cutoff sweep arguments", description="""Comma-separated lists
+        of cutoffs to make statistics for every combination of them in
+        one pass; cutoffs without a list are taken from the arguments
+        above. The output is a single TSV table, with a line for every
+        cutoff combination, strands (ss/ds, see --cb-stat) and row (see
+        --rows), and counts in the columns (see --cols). The sweep is
+        not split between jobs."""
+    )
+    sweep_group.add_argument(
+        "--sweep-exp", metavar="F,F,...", type=float_list,
+        help="expected number cutoffs"
+    )
+    sweep_group.add_argument(
+        "--sweep-under", metavar="F,F,...", type=float_list,
+        help="under-representation cutoffs"
+    )
+    sweep_group.add_argument(
+        "--sweep-over", metavar="F,F,...", type=float_list,
+        help="over-representation cutoffs"
+    )
     index_group = parser.add_argument_group(
         "column index arguments", description="""All column
         indices are counted from 0 and could be negative
@@ -446,21 +740,55 @@ def main(argv=None):
         group, O - 'compare with 1' group, N - normal (zero, under, normal,
         over) group; default is TRON"""
     )
+    add_profile_arguments(parser.add_argument_group("profiling arguments"))
     args = parser.parse_args(argv)
-    # indices
+    if args.sorted_by_id and (args.no_id and args.id_index is None):
+        parser.error("--sorted-by-id needs the sequence ID column")
+    if not (args.intsv or args.states):
+        parser.error("no input tables or states")
+    if (is_sweep(args) or args.spill_dir) and (
+            len(args.intsv) != 1 or args.states or args.save_state):
+        parser.error(
+            "cutoff sweep and --spill-dir need a single input table "
+            "and no states"
+        )
+    if is_sweep(args) and args.cutoff_table:
+        parser.error("cutoff sweep does not work with --cutoff-table")
+    args.group_cutoffs = None
+    if args.cutoff_table is not None:
+        with args.cutoff_table as intsv:
+            try:
+                args.group_cutoffs = read_group_cutoffs(
+                    intsv, (args.under_cutoff, args.over_cutoff)
+                )
+            except ValueError as error:
+                parser.error(str(error))
+        if args.group_cutoffs.kind == ID and get_indices(args)[0] is None:
+            parser.error("cutoffs by sequence IDs need the ID column")
+    # states are checked against the cutoffs before the input is read
+    try:
+        args.partial_stats = load_states(args)
+    except ValueError as error:
+        parser.error(str(error))
+    return args
+
+def get_indices(args):
     no_id = int(args.no_id)
     apply_default = lambda x, default: default if x is None else x
     id_index = apply_default(args.id_index, None if no_id else 0)
     site_index = apply_default(args.site_index, 1-no_id)
     obs_index = apply_default(args.obs_index, 2-no_id)
     exp_index = apply_default(args.exp_index, -3)
-    indices = (id_index, site_index, obs_index, exp_index)
-    # cutoffs
-    cutoffs = (
+    return (id_index, site_index, obs_index, exp_index)
+
+def get_cutoffs(args):
+    return (
         args.exp_cutoff, args.zero_cutoff,
         args.under_cutoff, args.over_cutoff
     )
-    line_parser = LineParser(indices, cutoffs)
+
+def write_stat(args, cbstat_ss, cbstat_ds, jgstat, profiler=None):
+    profiler = profiler or Profiler()
     # output format
     out_format = args.format
     if not out_format:
@@ -480,14 +808,150 @@ def main(argv=None):
         cbsection=cbsection, jgsection=jgsection,
         cbcols=args.cbcols, cbrows=args.cbrows
     )
-    # collect stats
-    cbstat_ss, cbstat_ds, jgstat = collect_stat(args.intsv, line_parser)
-    cbvals = summarize_cbstat(cbstat_ss)
-    cbvals.update(summarize_cbstat(cbstat_ds, spacer="2"))
-    jgvals = summarize_jgstat(jgstat)
+    with profiler.phase("format"):
+        cbvals = summarize_cbstat(cbstat_ss)
+        cbvals.update(summarize_cbstat(cbstat_ds, spacer="2"))
+        jgvals = summarize_jgstat(jgstat)
+        output = format_manager.make_output(cbvals, jgvals)
+    with profiler.phase("write"), args.out as out:
+        out.write(output)
+
+def is_sweep(args):
+    return any((args.sweep_exp, args.sweep_under, args.sweep_over))
+
+def get_cutoff_sets(args):
+    return list(itertools.product(
+        args.sweep_exp or [args.exp_cutoff], [args.zero_cutoff],
+        args.sweep_under or [args.under_cutoff],
+        args.sweep_over or [args.over_cutoff]
+    ))
+
+def write_sweep(args, cutoff_sets, cbstats):
+    cbcols = [CBCOLS[abbr] for abbr in args.cbcols]
+    cbrows = [row for row in get_rows_by_abbrs(args.cbrows) if row]
+    sections = []
+    if args.cb_stat in ["ss", "both"]:
+        sections.append(("ss", "_", cbcols))
+    if args.cb_stat in ["ds", "both"]:
+        sections.append(
+            ("ds", "2", [col for col in cbcols if col[1] != "inc"])
+        )
     with args.out as out:
-        out.write(format_manager.make_output(cbvals, jgvals))
+        out.write("#Exp cutoff\tZero cutoff\tUnder cutoff\tOver cutoff")
+        out.write("\tStrands\tRow\t")
+        out.write("\t".join(name for name, _abbr in cbcols) + "\n")
+        for cutoffs, (cbstat_ss, cbstat_ds, _jgstat) in zip(cutoff_sets,
+                                                            cbstats):
+            cbvals = summarize_cbstat(cbstat_ss)
+            cbvals.update(summarize_cbstat(cbstat_ds, spacer="2"))
+            prefix = "%g\t%g\t%g\t%g\t" % cutoffs
+            for strands, spacer, columns in sections:
+                for name, row_abbr in cbrows:
+                    values = [
+                        str(cbvals[col_abbr + spacer + row_abbr][0])
+                        for _name, col_abbr in columns
+                    ]
+                    out.write("%s%s\t%s\t%s\n" % (
+                        prefix, strands, name, "\t".join(values)
+                    ))
+
+def write_stats(args, partial_stats, profiler=None):
+    """Merge raw statistics, save them if asked and write the output."""
+    profiler = profiler or Profiler()
+    if args.save_state:
+        with profiler.phase("aggregate"):
+            state = merge_raw_stats(partial_stats, keep_waits=True)
+        with profiler.phase("write"), args.save_state as oustate:
+            save_state(
+                oustate, state, get_cutoffs(args), args.group_cutoffs
+            )
+        partial_stats = [state]
+    with profiler.phase("aggregate"):
+        cbstats = get_cbstats(merge_raw_stats(partial_stats))
+    write_stat(args, *cbstats, profiler=profiler)
+
+class StatReport(object):
+    """Collect statistics of the table by chunks and write the output."""
+
+    def __init__(self, args, reader, profiler=None):
+        self.args = args
+        self.profiler = profiler = profiler or Profiler()
+        pairer = get_pairer(args.sorted_by_id, args.spill_dir)
+        if is_sweep(args):
+            self.cutoff_sets = get_cutoff_sets(args)
+            self.collector = SweepCollector(reader, [
+                profiler.time_method(CBClassifier(cutoffs), "classify")
+                for cutoffs in self.cutoff_sets
+            ], pairer)
+        else:
+            self.partial_stats = list(args.partial_stats)
+            self.collector = StatCollector(reader, profiler.time_method(
+                CBClassifier(get_cutoffs(args), args.group_cutoffs),
+                "classify"
+            ), pairer)
+
+    def update(self, chunk):
+        with self.profiler.phase("aggregate"):
+            self.collector.update(chunk)
+
+    def finish(self):
+        profiler = self.profiler
+        if is_sweep(self.args):
+            with profiler.phase("aggregate"):
+                cbstats = [
+                    get_cbstats(raw_stat)
+                    for raw_stat in self.collector.finish()
+                ]
+            with profiler.phase("format"):
+                write_sweep(self.args, self.cutoff_sets, cbstats)
+        else:
+            with profiler.phase("aggregate"):
+                self.partial_stats.append(self.collector.finish())
+            write_stats(self.args, self.partial_stats, profiler)
+
+def process_tables(args, profiler):
+    indices = get_indices(args)
+    if is_sweep(args) or args.spill_dir:
+        with args.intsv[0] as intsv:
+            reader = open_cbtable(intsv, indices, use_cache=args.use_cache)
+            report = StatReport(args, reader, profiler)
+            for chunk in profiler.chunks(reader):
+                report.update(chunk)
+            report.finish()
+        return
+    cutoffs = get_cutoffs(args)
+    partial_stats = list(args.partial_stats)
+    for intsv in args.intsv:
+        with intsv:
+            # without IDs, sites repeat and pairing depends on the order
+            if (args.jobs > 1 and indices[0] is not None
+                    and os.path.isfile(intsv.name)
+                    and not args.sorted_by_id):
+                with profiler.phase("collect"):
+                    part_stats = collect_raw_stats_parallel(
+                        intsv.name, indices, cutoffs, args.jobs,
+                        args.use_cache, args.group_cutoffs
+                    )
+                profiler.add_rows(sum(map(count_rows, part_stats)))
+                partial_stats.extend(part_stats)
+            else:
+                reader = open_cbtable(
+                    intsv, indices, use_cache=args.use_cache
+                )
+                partial_stats.append(collect_raw_stat(
+                    reader, CBClassifier(cutoffs, args.group_cutoffs),
+                    get_pairer(args.sorted_by_id), profiler
+                ))
+    write_stats(args, partial_stats, profiler)
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = get_profiler(args)
+    try:
+        process_tables(args, profiler)
+    except ValueError as error: # e.g. the table is not grouped by IDs
+        sys.exit("get_stat.py: error: %s" % error)
+    profiler.report()
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -14,6 +14,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(
@@ -24,17 +26,17 @@ def main(argv=None):
         help="path to .ns files, use {} placeholder for ACv (ID)."
     )
     parser.add_argument(
-        "-a", dest="inacv", metavar="IN.acv", type=argparse.FileType("r"),
+        "-a", dest="inacv", metavar="IN.acv", type=FileType("r"),
         default=sys.stdin, help="""input file with a list of ACvs (any ID)
         (.acv); default is STDIN"""
     )
     parser.add_argument(
-        "-s", dest="instl", metavar="IN.stl", type=argparse.FileType("r"),
+        "-s", dest="instl", metavar="IN.stl", type=FileType("r"),
         help="""input file with a list of sites (.stl); default is not
         to filter by sites"""
     )
     parser.add_argument(
-        "-o", dest="outsv", metavar="OUT.tsv", type=argparse.FileType("w"),
+        "-o", dest="outsv", metavar="OUT.tsv", type=FileType("w"),
         default=sys.stdout, help="output .tsv file, default STDOUT"
     )
     args = parser.parse_args(argv)
@@ -4,6 +4,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 class SymmetricDifference(object):
     def __init__(self):
@@ -44,7 +46,7 @@ def main(argv=None):
         intersection or difference."""
     )
     parser.add_argument(
-        "sets", metavar="FILE", type=argparse.FileType("r"), nargs="+",
+        "sets", metavar="FILE", type=FileType("r"), nargs="+",
         help="input ID-set file, one ID per line"
     )
     group = parser.add_mutually_exclusive_group(required=False)
@@ -69,7 +71,7 @@ def main(argv=None):
     )
     parser.add_argument(
         "-o", "--output", dest="oulist", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
+        type=FileType("w"), default=sys.stdout,
         help="output file, default STDOUT"
     )
     parser.add_argument(
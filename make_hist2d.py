@@ -3,55 +3,66 @@
 """Make 2D-histrogram of compositional bias values."""
 
 import argparse
-import math
+import numpy as np
 import sys
 
+from cbtable import CBTableReader, get_pair_keys
+from compressed import FileType
+from profiling import add_profile_arguments, get_profiler
+from sitecodec import get_complements
 
-COMPLS = {
-    "A": "T", "B": "V", "T": "A", "V": "B", "W": "W",
-    "C": "G", "D": "H", "G": "C", "H": "D", "S": "S",
-    "K": "M", "M": "K", "R": "Y", "Y": "R", "N": "N"
-}
 
+def get_ds_sites(sites):
+    sites = np.array(sites, dtype=str)
+    rsites = np.array(get_complements(sites), dtype=str)
+    is_watson = sites <= rsites
+    return zip(np.where(is_watson, sites, rsites).tolist(),
+               np.where(is_watson, rsites, sites).tolist())
 
-def get_ds_site(site):
-    rsite = "".join(COMPLS[nucl] for nucl in site[::-1])
-    dsite = (min(site, rsite), max(site, rsite))
-    return dsite
 
-
-class LineParser(object):
-    def __init__(self, indices):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
-
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        sid = vals[self.id_index]
-        site = get_ds_site(vals[self.site_index])
-        observed = float(vals[self.obs_index])
-        expected = float(vals[self.exp_index])
-        return (sid, site), observed, expected
-
-
-def load_ds_counts(intsv, line_parser, pairs, cutoff):
-    counts = dict()
+def load_ds_counts(intsv, indices, pairs, cutoff, profiler):
+    pairs = list(pairs)
+    key_chunks = []
+    observed_chunks = []
+    expected_chunks = []
     with intsv:
-        intsv.readline()
-        for line in intsv:
-            pair, observed, expected = line_parser(line)
-            if pair not in pairs:
-                continue
-            if math.isnan(expected) or expected <= cutoff:
-                observed, expected = (0, 0)
-            observed_, expected_ = counts.get(pair, (0, 0))
-            observed += observed_
-            expected += expected_
-            counts[pair] = (observed, expected)
-    return counts
+        reader = CBTableReader(intsv, indices)
+        site_coder = reader.site_coder
+        sids = np.array([sid for sid, _site in pairs], dtype=str)
+        sites = np.array([site[0] for _sid, site in pairs], dtype=str)
+        pair_keys = get_pair_keys(
+            reader.id_coder.encode(sids), site_coder.encode(sites)
+        )
+        for chunk in profiler.chunks(reader):
+            with profiler.phase("aggregate"):
+                watsons, _is_pal = site_coder.get_watsons(chunk.sites)
+                keys = get_pair_keys(chunk.ids, watsons)
+                mask = np.in1d(keys, pair_keys)
+                observed = chunk.obs[mask]
+                expected = chunk.exp[mask]
+                with np.errstate(invalid="ignore"):
+                    bad = np.isnan(expected) | (expected <= cutoff)
+                observed[bad] = 0
+                expected[bad] = 0
+                key_chunks.append(keys[mask])
+                observed_chunks.append(observed)
+                expected_chunks.append(expected)
+    with profiler.phase("aggregate"):
+        keys, inverse = np.unique(
+            np.concatenate(key_chunks or [np.zeros(0, dtype=np.int64)]),
+            return_inverse=True
+        )
+        sums = [
+            np.bincount(
+                inverse, np.concatenate(chunks or [np.zeros(0)]),
+                minlength=len(keys)
+            ).tolist() for chunks in [observed_chunks, expected_chunks]
+        ]
+        counts = dict(zip(keys.tolist(), zip(*sums)))
+    return dict(
+        (pair, counts[key]) for key, pair in zip(pair_keys.tolist(), pairs)
+        if key in counts
+    )
 
 
 class BinsManager(object):
@@ -80,21 +91,21 @@ def parse_args(argv):
     )
     io_group = parser.add_argument_group(title="Input/output agruments")
     io_group.add_argument(
-        "intab1", metavar="TSV1", type=argparse.FileType("r"),
+        "intab1", metavar="TSV1", type=FileType("r"),
         help="""first TSV file with compositional bias values, use '-'
         for STDIN"""
     )
     io_group.add_argument(
-        "intab2", metavar="TSV2", type=argparse.FileType("r"),
+        "intab2", metavar="TSV2", type=FileType("r"),
         help="""second TSV file with compositional bias values, use '-'
         for STDIN"""
     )
     io_group.add_argument(
-        "-i", dest="intrp", metavar="TRIOS", type=argparse.FileType("r"),
+        "-i", dest="intrp", metavar="TRIOS", type=FileType("r"),
         default=sys.stdin, help="input list of triples, default STDIN"
     )
     io_group.add_argument(
-        "-o", dest="ouhst", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="ouhst", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output file, default STDOUT"
     )
     parameter_group = parser.add_argument_group(
@@ -149,6 +160,7 @@ def parse_args(argv):
         "--obs2", "--observed2", dest="obs_index2", type=int,
         help=argparse.SUPPRESS
     )
+    add_profile_arguments(parser.add_argument_group(title="Profiling"))
     return parser.parse_args(argv)
 
 
@@ -166,27 +178,50 @@ def load_triples(intrp):
     pairs2 = set()
     triples = set()
     with intrp:
-        for line in intrp:
-            sid1, sid2, site = line.strip().split("\t")
-            site = get_ds_site(site)
-            triples.add(((sid1, site), (sid2, site)))
-            pairs1.add((sid1, site))
-            pairs2.add((sid2, site))
+        lines = [line.strip().split("\t") for line in intrp]
+    ds_sites = get_ds_sites([vals[-1] for vals in lines])
+    for vals, site in zip(lines, ds_sites):
+        sid1, sid2, _site = vals
+        triples.add(((sid1, site), (sid2, site)))
+        pairs1.add((sid1, site))
+        pairs2.add((sid2, site))
     return pairs1, pairs2, triples
 
 
+def count_triples(triples, counts1, counts2, bins_manager1,
+                  bins_manager2):
+    hist = []
+    total = 0
+    for _bin in range(bins_manager1.number + 1):
+        hist.append([0] * (bins_manager2.number + 1))
+    for pair1, pair2 in triples:
+        observed1, expected1 = counts1[pair1]
+        observed2, expected2 = counts2[pair2]
+        if expected1 == 0 or expected2 ==0:
+            continue
+        bin1 = bins_manager1.get_bin(observed1 / expected1)
+        bin2 = bins_manager2.get_bin(observed2 / expected2)
+        hist[bin1][bin2] += 1
+        total += 1
+    return hist, total
+
+
 def main(argv=None):
     args = parse_args(argv)
+    profiler = get_profiler(args)
     obs_index1, obs_index2 = get_arg("obs_index", args)
     exp_index1, exp_index2 = get_arg("exp_index", args)
     cutoff1, cutoff2 = get_arg("cutoff", args)
     bins_number1, bins_number2 = get_arg("bins_number", args)
     ou_meta = ["## Compositional bias histogram 2D\n"]
-    pairs1, pairs2, triples = load_triples(args.intrp)
+    with profiler.phase("parse"):
+        pairs1, pairs2, triples = load_triples(args.intrp)
     ou_meta.append("## Triples list: %s\n" % args.intrp.name)
 
-    line_parser1 = LineParser((0, 1, obs_index1, exp_index1))
-    counts1 = load_ds_counts(args.intab1, line_parser1, pairs1, cutoff1)
+    indices1 = (0, 1, obs_index1, exp_index1)
+    counts1 = load_ds_counts(
+        args.intab1, indices1, pairs1, cutoff1, profiler
+    )
     bins_manager1 = BinsManager(bins_number1)
     labs1 = bins_manager1.get_labels()
     ou_meta.extend([
@@ -195,8 +230,10 @@ def main(argv=None):
         "##   Expected cutoff: %.1f\n" % cutoff1,
     ])
 
-    line_parser2 = LineParser((0, 1, obs_index2, exp_index2))
-    counts2 = load_ds_counts(args.intab2, line_parser2, pairs2, cutoff2)
+    indices2 = (0, 1, obs_index2, exp_index2)
+    counts2 = load_ds_counts(
+        args.intab2, indices2, pairs2, cutoff2, profiler
+    )
     bins_manager2 = BinsManager(bins_number2)
     labs2 = bins_manager2.get_labels()
     ou_meta.extend([
@@ -204,22 +241,13 @@ def main(argv=None):
         "##   Bins number: (%d+1)\n" % bins_number2,
         "##   Expected cutoff: %.1f\n" % cutoff2,
     ])
-    hist = []
-    total = 0
-    for lab in labs1:
-        hist.append([0] * len(labs2))
-    for pair1, pair2 in triples:
-        observed1, expected1 = counts1[pair1]
-        observed2, expected2 = counts2[pair2]
-        if expected1 == 0 or expected2 ==0:
-            continue
-        bin1 = bins_manager1.get_bin(observed1 / expected1)
-        bin2 = bins_manager2.get_bin(observed2 / expected2)
-        hist[bin1][bin2] += 1
-        total += 1
+    with profiler.phase("aggregate"):
+        hist, total = count_triples(
+            triples, counts1, counts2, bins_manager1, bins_manager2
+        )
     sys.stderr.write("The histogram was build by %d values.\n" % total)
     ou_meta.append("## Total: %d\n" % total)
-    with args.ouhst as ouhst:
+    with profiler.phase("write"), args.ouhst as ouhst:
         ouhst.writelines(ou_meta)
         ouhst.write("#Bin")
         for lab in labs2:
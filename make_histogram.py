@@ -3,33 +3,56 @@
 """Make a histrogram of compositional bias values."""
 
 import argparse
-import math
+import numpy as np
 import sys
 
+from cbtable import get_pair_keys, open_cbtable
+from compressed import FileType
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-COMPLS = {
-    "A": "T", "B": "V", "T": "A", "V": "B", "W": "W",
-    "C": "G", "D": "H", "G": "C", "H": "D", "S": "S",
-    "K": "M", "M": "K", "R": "Y", "Y": "R", "N": "N"
-}
 
+DS_MODES = ["none", "summarize", "justify"]
 
-def get_ds_site(site):
-    rsite = "".join(COMPLS[nucl] for nucl in site[::-1])
-    return min(site, rsite), max(site, rsite)
 
+def count_bins(ratios, bins, span):
+    """Count ratios in bins, the last extra bin gets values over span."""
+    bin_indices = np.minimum((ratios * bins / span).astype(np.int64), bins)
+    return np.bincount(bin_indices, minlength=bins+1)
 
-def main(argv=None):
+
+def histogram_config(text):
+    """Parse [KEY=VALUE,...:]FILE argument, open the output file."""
+    spec, _sep, path = text.rpartition(":")
+    values = dict()
+    for item in spec.split(",") if spec else []:
+        key, _sep, value = item.partition("=")
+        try:
+            if key == "bins":
+                values[key] = int(value)
+            elif key == "cutoff":
+                values[key] = float(value)
+            elif key == "mode" and value in DS_MODES:
+                values[key] = value
+            else:
+                raise ValueError()
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "bad histogram configuration item: %r" % item
+            )
+    return values, FileType("w")(path)
+
+
+def parse_args(argv=None, prog=None):
     parser = argparse.ArgumentParser(
-        description="Make histrogram of compositional bias values."
+        prog=prog, description="Make histrogram of compositional bias values."
     )
     parser.add_argument(
-        "intab", metavar="IN.tsv", type=argparse.FileType("r"),
+        "intab", metavar="IN.tsv", type=FileType("r"),
         help="""input TSV file with compositional bias values, use '-'
         for STDIN"""
     )
     parser.add_argument(
-        "ouhst", metavar="OUT.hst", type=argparse.FileType("w"),
+        "ouhst", metavar="OUT.hst", type=FileType("w"),
         help="output file"
     )
     parser.add_argument(
@@ -49,7 +72,7 @@ def main(argv=None):
         help="index of observed number column, default 2"
     )
     parser.add_argument(
-        "-m", "--ds-mode", choices=["none", "summarize", "justify"],
+        "-m", "--ds-mode", choices=DS_MODES,
         default="summarize", help="""how to handle assymetric sites from
         different strands, possible options are 'none' (handle each site
         separately), 'summarize' (sum up expected and observed numbers
@@ -57,57 +80,157 @@ def main(argv=None):
         also consider every palindromic site twice to justify the
         contributions of assymetric and palindromic sites) """
     )
+    parser.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (IN.tsv.cbc directory next to it)"""
+    )
+    parser.add_argument(
+        "-c", "--config", dest="configs", metavar="[KEY=VALUE,...:]FILE",
+        type=histogram_config, action="append", help="""one more
+        histogram to make in the same pass, written to FILE; KEY is
+        'bins', 'cutoff' or 'mode' (see --ds-mode), missing values are
+        taken from the options above; could be repeated"""
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args(argv)
-    ds_mode = args.ds_mode
-    bins = args.bins_number
-    bins_total = bins + 1 # + '> 2.0'
-    exp_index = args.exp
-    obs_index = args.obs
-    hist = [0] * bins_total
-    span = 2.0 - 0.0
-    labs = ["%.2f" % ((i+0.5) * span / bins) for i in range(bins_total)]
-    waits = dict()
+    args.histograms = [
+        (args.bins_number, args.cutoff, args.ds_mode, args.ouhst)
+    ]
+    for values, ouhst in args.configs or []:
+        args.histograms.append((
+            values.get("bins", args.bins_number),
+            values.get("cutoff", args.cutoff),
+            values.get("mode", args.ds_mode), ouhst
+        ))
+    names = [ouhst.name for _bins, _cutoff, _mode, ouhst in args.histograms]
+    if len(set(names)) < len(names):
+        parser.error("several histograms are written to the same file")
+    return args
+
+
+def get_indices(args):
+    return (0, 1, args.obs, args.exp)
+
+
+class Histogram(object):
+    """Counts of ratios by bins with the configuration of a histogram."""
+
+    def __init__(self, bins, cutoff, ds_mode, ouhst):
+        self.bins = bins
+        self.cutoff = cutoff
+        self.ds_mode = ds_mode
+        self.ouhst = ouhst
+        self.counts = np.zeros(bins + 1, dtype=np.int64) # + '> 2.0'
+
+    def write(self, source, span):
+        bins = self.bins
+        labs = ["%.2f" % ((i+0.5) * span / bins) for i in range(bins + 1)]
+        hist = self.counts.tolist()
+        total = sum(hist)
+        sys.stderr.write("The histogram was build by %d values.\n" % total)
+        with self.ouhst as ouhst:
+            ouhst.write("## Compositional bias histogram\n")
+            ouhst.write("## Source: %s\n" % source)
+            ouhst.write("## Bins number: (%d+1)\n" % bins)
+            ouhst.write("## Expected cutoff: %.1f\n" % self.cutoff)
+            ouhst.write("## Assymetric handler: %s\n" % self.ds_mode)
+            ouhst.write("## Total: %d\n" % total)
+            ouhst.write("#Bin\tPercent\n")
+            if not total:
+                total = 1
+            for label, value in zip(labs, hist):
+                ouhst.write("%s\t%.2f\n" % (label, value * 100.0 / total))
+
+
+class HistogramReport(object):
+    """Count ratios of the table into bins by chunks, write the histograms.
+
+    Ratios are calculated once for all the histograms (see --config). In
+    the 'summarize' mode the numbers of asymmetric sites are collected
+    and summed up by (ID, Watson site) pairs at the end.
+    """
+
+    def __init__(self, args, reader, profiler=None):
+        self.args = args
+        self.reader = reader
+        self.profiler = profiler or Profiler()
+        self.span = 2.0 - 0.0
+        self.histograms = [Histogram(*config) for config in args.histograms]
+        self.sum_cutoffs = sorted(set(
+            hist.cutoff for hist in self.histograms
+            if hist.ds_mode == "summarize"
+        ))
+        self.waits = ([], [], []) # keys, observed and expected numbers
+
+    def update(self, chunk):
+        with self.profiler.phase("aggregate"):
+            self.count(chunk)
+
+    def count(self, chunk):
+        span = self.span
+        watsons, is_pal = self.reader.site_coder.get_watsons(chunk.sites)
+        expected = chunk.exp
+        observed = chunk.obs
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = observed / expected
+        masks = dict() # by cutoffs
+        for cutoff in set(hist.cutoff for hist in self.histograms):
+            with np.errstate(invalid="ignore"):
+                masks[cutoff] = ~(np.isnan(expected) | (expected <= cutoff))
+        if self.sum_cutoffs:
+            # waits of the lowest cutoff are filtered for the others later
+            npl = masks[self.sum_cutoffs[0]] & ~is_pal
+            for values, column in zip(self.waits, [
+                    get_pair_keys(chunk.ids[npl], watsons[npl]),
+                    observed[npl], expected[npl]
+            ]):
+                values.append(column)
+        for hist in self.histograms:
+            mask = masks[hist.cutoff]
+            if hist.ds_mode == "summarize":
+                mask = mask & is_pal
+            hist.counts += count_bins(ratios[mask], hist.bins, span)
+            if hist.ds_mode == "justify":
+                hist.counts += count_bins(
+                    ratios[mask & is_pal], hist.bins, span
+                )
+
+    def finish(self):
+        span = self.span
+        if self.waits[0]:
+            with self.profiler.phase("aggregate"):
+                keys, observed, expected = (
+                    np.concatenate(vals) for vals in self.waits
+                )
+                for cutoff in self.sum_cutoffs:
+                    mask = expected > cutoff
+                    _keys, inverse = np.unique(keys[mask], return_inverse=True)
+                    ratios = (
+                        np.bincount(inverse, observed[mask]) /
+                        np.bincount(inverse, expected[mask])
+                    )
+                    for hist in self.histograms:
+                        if (hist.ds_mode == "summarize"
+                                and hist.cutoff == cutoff):
+                            hist.counts += count_bins(ratios, hist.bins, span)
+        with self.profiler.phase("write"):
+            for hist in self.histograms:
+                hist.write(self.args.intab.name, span)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = get_profiler(args)
     with args.intab as intab:
-        intab.readline()
-        for line in intab:
-            vals = line.strip().split("\t")
-            sid = vals[0]
-            site = get_ds_site(vals[1])
-            ispal = site[0] == site[1]
-            pair = (sid, site)
-            expected = float(vals[exp_index])
-            observed = float(vals[obs_index])
-            if math.isnan(expected) or expected <= args.cutoff:
-                continue
-            if ds_mode == "summarize" and not ispal:
-                observed_, expected_ = waits.get(pair, (0, 0))
-                observed += observed_
-                expected += expected_
-                waits[pair] = (observed, expected)
-            else:
-                ratio = observed / expected
-                bin_index = min(int(ratio * bins / span), bins)
-                hist[bin_index] += 1
-                if ispal and ds_mode == "justify":
-                    hist[bin_index] += 1
-    for observed, expected in waits.values():
-        ratio = observed / expected
-        bin_index = min(int(ratio * bins / span), bins)
-        hist[bin_index] += 1
-    total = sum(hist)
-    sys.stderr.write("The histogram was build by %d values.\n" % total)
-    with args.ouhst as ouhst:
-        ouhst.write("## Compositional bias histogram\n")
-        ouhst.write("## Source: %s\n" % args.intab.name)
-        ouhst.write("## Bins number: (%d+1)\n" % args.bins_number)
-        ouhst.write("## Expected cutoff: %.1f\n" % args.cutoff)
-        ouhst.write("## Assymetric handler: %s\n" % ds_mode)
-        ouhst.write("## Total: %d\n" % total)
-        ouhst.write("#Bin\tPercent\n")
-        if not total:
-            total = 1
-        for label, value in zip(labs, hist):
-            ouhst.write("%s\t%.2f\n" % (label, value * 100.0 / total))
+        reader = open_cbtable(
+            intab, get_indices(args), use_cache=args.use_cache
+        )
+        report = HistogramReport(args, reader, profiler)
+        for chunk in profiler.chunks(reader):
+            report.update(chunk)
+    report.finish()
+    profiler.report()
 
 
 if __name__ == "__main__":
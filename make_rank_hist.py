@@ -3,21 +3,81 @@
 """Make a histrogram of compositional bias ranks."""
 
 import argparse
-import math
+import numpy as np
 import sys
 
+from compressed import FileType
+from profiling import add_profile_arguments, get_profiler
+
+
+SPAN = 1.0 - 0.0 # range of normalized ranks
+
+
+class RankHistogram(object):
+    """Histogram of normalized ranks (from 0 to 1) of the sites.
+
+    Ranks of a site are counted if its total number of ranks is over the
+    cutoff.
+    """
+
+    def __init__(self, bins, cutoff=0):
+        self.bins = bins
+        self.cutoff = cutoff
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, total, ranks):
+        if total <= self.cutoff:
+            return
+        indices = (np.asarray(ranks, dtype=np.float64) * self.bins / SPAN)
+        indices = np.minimum(indices.astype(np.int64), self.bins - 1)
+        self.counts += np.bincount(indices, minlength=self.bins)
+
+    def write(self, ouhst, source):
+        bins = self.bins
+        total = int(self.counts.sum())
+        sys.stderr.write("The histogram was build by %d values.\n" % total)
+        labs = ["%.2f" % ((i+0.5) * SPAN / bins) for i in range(bins)]
+        ouhst.write("## Ranked compositional bias histogram\n")
+        ouhst.write("## Source: %s\n" % source)
+        ouhst.write("## Bins number: %d\n" % bins)
+        ouhst.write("## Rank number cutoff: %d\n" % self.cutoff)
+        ouhst.write("## Total: %d\n" % total)
+        ouhst.write("#:Bin\tPercent\n")
+        if not total:
+            total = 1
+        for label, value in zip(labs, self.counts.tolist()):
+            ouhst.write("%s\t%.2f\n" % (label, value * 100.0 / total))
+
+
+def get_rank_scale(title):
+    """Get the multiplier of ranks to get them from 0 to 1.
+
+    Ranks are percents if the column title ends with '%', as get_ranks.py
+    writes them, and they should be scaled to fall into their bins:
+
+    >>> ranks = [12.5, 37.5, 62.5, 87.5]
+    >>> hist = RankHistogram(4)
+    >>> scale = get_rank_scale("Normalized ranks, %")
+    >>> hist.update(4, [rank * scale for rank in ranks])
+    >>> hist.counts.tolist()
+    [1, 1, 1, 1]
+    >>> get_rank_scale("Normalized ranks")
+    1.0
+    """
+    return 0.01 if title.endswith("%") else 1.0
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Make histrogram of compositional bias ranks."
     )
     parser.add_argument(
-        "intab", metavar="IN.tsv", type=argparse.FileType("r"),
+        "intab", metavar="IN.tsv", type=FileType("r"),
         help="""input TSV file with compositional bias ranks, use '-'
         for STDIN"""
     )
     parser.add_argument(
-        "ouhst", metavar="OUT.hst", type=argparse.FileType("w"),
+        "ouhst", metavar="OUT.hst", type=FileType("w"),
         help="output file"
     )
     parser.add_argument(
@@ -30,46 +90,34 @@ def main(argv=None):
     )
     parser.add_argument(
         "-R", "--rank-index", metavar="N", type=int, default=-1,
-        help="index of normalized ranks column, default -1"
+        help="""index of normalized ranks column, default -1; ranks are
+        percents if the column title ends with '%%'"""
     )
     parser.add_argument(
         "-T", "--total-index", metavar="N", type=int, default=1,
         help="index of the column with total number of ranks, default 1"
     )
+    add_profile_arguments(parser)
     args = parser.parse_args(argv)
-    bins = args.bins_number
+    profiler = get_profiler(args)
     rank_index = args.rank_index
     total_index = args.total_index
-    cutoff = args.cutoff
-    hist = [0] * bins
-    span = 1.0 - 0.0
-    labs = ["%.2f" % ((i+0.5) * span / bins) for i in range(bins)]
-    with args.intab as intab:
-        _title = intab.readline()
-        for line in intab:
+    hist = RankHistogram(args.bins_number, args.cutoff)
+    with profiler.phase("parse"), args.intab as intab:
+        title = intab.readline().rstrip("\n").split("\t")
+        scale = 1.0
+        try:
+            scale = get_rank_scale(title[rank_index])
+        except IndexError:
+            pass
+        for line in profiler.lines(intab):
             vals = line.strip().split("\t")
-            total = int(vals[total_index])
-            if total <= cutoff:
-                continue
-            ranks = [float(i) for i in vals[rank_index].split(",")]
-            for rank in ranks:
-                bin_index = min(int(rank * bins / span), bins - 1)
-                hist[bin_index] += 1
-    total = sum(hist)
-    sys.stderr.write("The histogram was build by %d values.\n" % total)
-    with args.ouhst as ouhst:
-        ouhst.write("## Ranked compositional bias histogram\n")
-        ouhst.write("## Source: %s\n" % args.intab.name)
-        ouhst.write("## Bins number: %d\n" % bins)
-        ouhst.write("## Rank number cutoff: %d\n" % cutoff)
-        ouhst.write("## Total: %d\n" % total)
-        ouhst.write("#:Bin\tPercent\n")
-        if not total:
-            total = 1
-        for label, value in zip(labs, hist):
-            ouhst.write("%s\t%.2f\n" % (label, value * 100.0 / total))
+            ranks = [float(i) * scale for i in vals[rank_index].split(",")]
+            hist.update(int(vals[total_index]), ranks)
+    with profiler.phase("write"), args.ouhst as ouhst:
+        hist.write(ouhst, args.intab.name)
+    profiler.report()
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
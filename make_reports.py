@@ -0,0 +1,126 @@
+#! /usr/bin/env python2
+
+"""Make several reports on CB table reading it only once."""
+
+import argparse
+import importlib
+import shlex
+import signal
+import sys
+
+from cbtable import open_cbtable
+from compressed import CompressedFile, FileType
+from profiling import add_profile_arguments, get_profiler
+
+
+REPORTS = {
+    "get_stat": "StatReport",
+    "get_group": "GroupReport",
+    "count_decreased": "DecreasedReport",
+    "get_cutoff": "CutoffReport",
+    "make_histogram": "HistogramReport",
+}
+
+INDEX_NAMES = ["sequence ID", "site", "observed number", "expected number"]
+
+
+def merge_indices(indices, report_indices):
+    """Merge column indices of reports, None stands for any index."""
+    merged = []
+    for name, index, report_index in zip(INDEX_NAMES, indices,
+                                         report_indices):
+        if index is None:
+            merged.append(report_index)
+        elif report_index is None or report_index == index:
+            merged.append(index)
+        else:
+            raise ValueError("reports use different %s columns" % name)
+    return tuple(merged)
+
+
+def close_inputs(args, path):
+    """Close input files opened by argparse for a report."""
+    for value in vars(args).values():
+        for infile in value if isinstance(value, list) else [value]:
+            if (isinstance(infile, (file, CompressedFile))
+                    and infile.name == path):
+                infile.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="""Make several reports on CB table reading it only
+        once. Every report is given as a command line of one of the tools
+        (get_stat, get_group, count_decreased, get_cutoff or
+        make_histogram) without the input file, e.g. 'get_stat -o
+        out.stat --cb-stat both'. Each report writes its usual output.""",
+    )
+    parser.add_argument(
+        "intsv", metavar="INPUT", type=FileType("r"),
+        help="input file with observed and expected numbers"
+    )
+    parser.add_argument(
+        "-r", "--report", dest="reports", metavar="COMMAND",
+        action="append", required=True, help="""report command line,
+        the tool name and its arguments; could be repeated"""
+    )
+    parser.add_argument(
+        "--no-title", dest="has_title", action="store_false",
+        help="""input table has no title line, the first line is read
+        as a data line unless it starts with '#'"""
+    )
+    parser.add_argument(
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (INPUT.cbc directory next to it)"""
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    tools = []
+    for command in args.reports:
+        words = shlex.split(command)
+        name = words[0].split(".")[0] if words else None
+        if name not in REPORTS:
+            parser.error("unknown report tool: %r" % command)
+        module = importlib.import_module(name)
+        report_args = module.parse_args(
+            [args.intsv.name] + words[1:], prog=name + ".py"
+        )
+        close_inputs(report_args, args.intsv.name)
+        tools.append((module, report_args))
+    indices = (None,) * len(INDEX_NAMES)
+    try:
+        for module, report_args in tools:
+            indices = merge_indices(indices, module.get_indices(report_args))
+    except ValueError as error:
+        parser.error(str(error))
+    if indices[2] is None or indices[3] is None:
+        parser.error("no observed or expected number column")
+    profiler = get_profiler(args)
+    with args.intsv as intsv:
+        reader = open_cbtable(
+            intsv, indices, has_title=args.has_title,
+            use_cache=args.use_cache
+        )
+        reports = [
+            getattr(module, REPORTS[module.__name__])(
+                report_args, reader, profiler
+            ) for module, report_args in tools
+        ]
+        try:
+            for chunk in profiler.chunks(reader):
+                for report in reports:
+                    report.update(chunk)
+        except ValueError as error: # e.g. the table is not grouped by IDs
+            sys.exit("make_reports.py: error: %s" % error)
+    for report in reports:
+        report.finish()
+    profiler.report()
+
+
+if __name__ == "__main__":
+    try:
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    except AttributeError:
+        pass # no signal.SIGPIPE on Windows
+    sys.exit(main())
@@ -12,6 +12,8 @@ import re
 import signal
 import sys
 
+from compressed import FileType
+
 
 def mask_type(value):
     """Site template type."""
@@ -32,7 +34,7 @@ def main(argv=None):
         description="Make list of all sites of the given length or mask."
     )
     parser.add_argument(
-        "-o", dest="oustl", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="oustl", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output file, default STDOUT"
     )
     parser.add_argument(
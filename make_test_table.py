@@ -0,0 +1,174 @@
+#! /usr/bin/env python2
+
+"""Generate a synthetic CB table for tests and benchmarks."""
+
+import argparse
+import numpy as np
+import signal
+import sys
+
+from compressed import FileType
+
+
+NUCLS = "ACGT"
+
+COMPLS = {"A": "T", "C": "G", "G": "C", "T": "A", "N": "N"}
+
+TITLE = "#:Sequence ID\tSite\tObserved\tExpected\tRatio\tTotal\n"
+
+
+def reverse_complement(site):
+    return "".join(COMPLS[nucl] for nucl in site[::-1])
+
+
+def make_sites(rng, length, number, pal_fraction):
+    """Make a sorted list of sites and their palindrome flags.
+
+    Palindromes of odd length have 'N' in the middle, asymmetric sites
+    are made in complementary pairs.
+    """
+    pal_number = int(round(number * pal_fraction))
+    pair_number = (number - pal_number) // 2
+    half = length // 2
+    asym_number = 4 ** length - (0 if length % 2 else 4 ** half)
+    if pal_number > 4 ** half or pair_number * 2 > asym_number:
+        raise ValueError("too many sites of length %d" % length)
+    sites = set()
+    pals = set()
+    while len(pals) < pal_number:
+        word = "".join(rng.choice(list(NUCLS), half))
+        pal = word + "N" * (length % 2) + reverse_complement(word)
+        pals.add(pal)
+        sites.add(pal)
+    while len(sites) < pal_number + pair_number * 2:
+        site = "".join(rng.choice(list(NUCLS), length))
+        rsite = reverse_complement(site)
+        if site != rsite and site not in sites:
+            sites.update([site, rsite])
+    sites = sorted(sites)
+    return sites, np.array([site in pals for site in sites])
+
+
+def make_rows(rng, sid, sites, is_pal, order, args):
+    """Make table lines of a sequence, in the order of site indices."""
+    size = len(sites)
+    keep = np.ones(size, dtype=bool)
+    # drop one of two complementary rows
+    keep[~is_pal & (rng.random_sample(size) < args.missing / 2.0)] = False
+    kinds = rng.random_sample(size)
+    exp = rng.uniform(15.0, 500.0, size)
+    is_low = kinds < args.nan + args.low
+    exp[is_low] = rng.uniform(0.0, 15.0, is_low.sum())
+    exp[kinds < args.nan] = np.nan
+    bias = rng.lognormal(0.0, args.bias, size)
+    obs = np.where(
+        np.isnan(exp), rng.randint(0, 4, size),
+        np.maximum(0, rng.normal(exp * bias, np.sqrt(exp)))
+    ).astype(np.int64)
+    totals = rng.randint(1, 5000, size)
+    lines = []
+    for index in order[keep[order]].tolist():
+        exp_value = exp[index]
+        obs_value = obs[index]
+        lines.append("%s\t%s\t%d\t%.2f\t%.3f\t%d\n" % (
+            sid, sites[index], obs_value, exp_value,
+            obs_value / exp_value if exp_value else np.nan, totals[index]
+        ))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic CB table for tests and benchmarks."
+    )
+    parser.add_argument(
+        "-o", "--out", metavar="FILE", type=FileType("w"),
+        default=sys.stdout, help="output table, default STDOUT"
+    )
+    parser.add_argument(
+        "-n", "--ids", metavar="N", type=int, default=1000,
+        help="number of sequence IDs, default 1000"
+    )
+    parser.add_argument(
+        "-l", "--site-length", metavar="N", type=int, default=4,
+        help="site length, default 4"
+    )
+    parser.add_argument(
+        "-s", "--sites", metavar="N", type=int,
+        help="number of different sites, default 4^L, but not over 256"
+    )
+    parser.add_argument(
+        "-p", "--palindromes", metavar="F", type=float,
+        help="""fraction of palindromic sites, default is the fraction
+        among all sites of the length (1/4^(L/2) for even L, 0 for odd
+        L)"""
+    )
+    parser.add_argument(
+        "-m", "--missing", metavar="F", type=float, default=0.05,
+        help="""fraction of asymmetric rows without complementary rows,
+        default 0.05"""
+    )
+    parser.add_argument(
+        "--nan", metavar="F", type=float, default=0.03,
+        help="fraction of rows with NaN expected numbers, default 0.03"
+    )
+    parser.add_argument(
+        "--low", metavar="F", type=float, default=0.05,
+        help="""fraction of rows with low (under 15) expected numbers,
+        default 0.05"""
+    )
+    parser.add_argument(
+        "--bias", metavar="F", type=float, default=0.3,
+        help="""standard deviation of log ratios of observed to
+        expected numbers, default 0.3"""
+    )
+    parser.add_argument(
+        "--order", choices=["sorted", "strands", "shuffled"],
+        default="sorted", help="""row order: 'sorted' by IDs and sites,
+        default; 'strands' - by IDs, complementary rows are adjacent;
+        'shuffled' - random order of all the rows"""
+    )
+    parser.add_argument(
+        "--seed", metavar="N", type=int, default=1,
+        help="random seed, default 1"
+    )
+    args = parser.parse_args(argv)
+    rng = np.random.RandomState(args.seed)
+    length = args.site_length
+    site_number = args.sites or min(4 ** length, 256)
+    pal_fraction = args.palindromes
+    if pal_fraction is None:
+        pal_fraction = 0.0 if length % 2 else 4.0 ** (-length // 2)
+    try:
+        sites, is_pal = make_sites(rng, length, site_number, pal_fraction)
+    except ValueError as error:
+        parser.error(str(error))
+    site_order = np.arange(len(sites))
+    if args.order == "strands":
+        site_order = np.array(sorted(
+            site_order.tolist(),
+            key=lambda index: min(
+                sites[index], reverse_complement(sites[index])
+            )
+        ))
+    with args.out as outsv:
+        outsv.write(TITLE)
+        rows = []
+        for index in range(args.ids):
+            sid = "NC_%06d.%d" % (index, index % 3 + 1)
+            lines = make_rows(rng, sid, sites, is_pal, site_order, args)
+            if args.order == "shuffled":
+                rows.extend(lines)
+            else:
+                outsv.writelines(lines)
+        if rows:
+            order = rng.permutation(len(rows))
+            outsv.writelines(rows[index] for index in order)
+
+
+if __name__ == "__main__":
+    try:
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    except AttributeError:
+        pass # no signal.SIGPIPE on Windows
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#! /usr/bin/env python2
+
+"""Time processing phases of the tools and report throughput.
+
+A profiler is created by every tool from its --profile and
+--profile-dump options. Disabled profiler does nothing, so the tools
+call it unconditionally. Phases could be nested, the time of a phase
+excludes the time of the phases inside it.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import sys
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    resource = None # no resource module on Windows
+
+
+class Profiler(object):
+    def __init__(self, enabled=False, dump=None):
+        self.enabled = enabled or dump is not None
+        self.dump = dump
+        self.phases = [] # names in the order of appearance
+        self.times = dict()
+        self.rows = 0
+        self.stack = [] # [name, start, time of inner phases]
+        self.start = default_timer()
+        self.cprofile = None
+        if dump is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def add_time(self, name, seconds):
+        if name not in self.times:
+            self.phases.append(name)
+            self.times[name] = 0.0
+        self.times[name] += seconds
+
+    def add_rows(self, rows):
+        self.rows += rows
+
+    def enter(self, name):
+        self.stack.append([name, default_timer(), 0.0])
+
+    def exit(self):
+        name, start, inner = self.stack.pop()
+        seconds = default_timer() - start
+        self.add_time(name, seconds - inner)
+        if self.stack:
+            self.stack[-1][2] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed(self, func, name):
+        """Wrap a function to count its calls into the phase."""
+        if not self.enabled:
+            return func
+
+        def timed_func(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def time_method(self, obj, method, name=None):
+        """Count calls of a method of the object into the phase."""
+        if self.enabled:
+            setattr(obj, method, self.timed(
+                getattr(obj, method), name or method
+            ))
+        return obj
+
+    def iterate(self, items, name):
+        """Iterate counting getting of every item into the phase."""
+        if not self.enabled:
+            return iter(items)
+        return self._iterate(iter(items), name)
+
+    def _iterate(self, items, name):
+        while True:
+            self.enter(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def chunks(self, reader, name="parse"):
+        """Iterate over chunks of a table counting their rows.
+
+        Reading of the chunks is counted into the phase.
+        """
+        if not self.enabled:
+            return iter(reader)
+        return self._count_chunks(self._iterate(iter(reader), name))
+
+    def _count_chunks(self, chunks):
+        for chunk in chunks:
+            self.rows += len(chunk.obs)
+            yield chunk
+
+    def lines(self, lines):
+        """Iterate over lines counting them, the time is not counted."""
+        if not self.enabled:
+            return lines
+        return self._lines(lines)
+
+    def _lines(self, lines):
+        for line in lines:
+            self.rows += 1
+            yield line
+
+    def report(self, out=sys.stderr):
+        """Write the profile, save cProfile statistics if asked."""
+        if not self.enabled:
+            return
+        total = default_timer() - self.start
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+        out.write("## Profile\n#:Phase\tSeconds\tShare, %\n")
+        other = total
+        for name in self.phases:
+            seconds = self.times[name]
+            other -= seconds
+            out.write("%s\t%.3f\t%.1f\n" % (
+                name, seconds, seconds * 100.0 / (total or 1)
+            ))
+        out.write("other\t%.3f\t%.1f\n" % (
+            other, other * 100.0 / (total or 1)
+        ))
+        out.write("total\t%.3f\t100.0\n" % total)
+        out.write("## Rows: %d\n" % self.rows)
+        out.write("## Rows per second: %.0f\n" % (self.rows / (total or 1)))
+        if resource is not None:
+            # kilobytes on Linux
+            out.write("## Peak RSS, MB: %.1f\n" % (resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss / 1024.0))
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            if children.ru_maxrss:
+                out.write("## Peak RSS of child processes, MB: %.1f\n" % (
+                    children.ru_maxrss / 1024.0
+                ))
+        if self.dump is not None:
+            out.write("## cProfile statistics: %s\n" % self.dump)
+
+
+def add_profile_arguments(parser):
+    """Add --profile and --profile-dump options to a parser or group."""
+    parser.add_argument(
+        "--profile", action="store_true", help="""write wall time of
+        processing phases, number of rows, rows per second and peak
+        memory usage to STDERR"""
+    )
+    parser.add_argument(
+        "--profile-dump", metavar="FILE", help="""also profile function
+        calls with cProfile and save the statistics to FILE (see pstats
+        module), implies --profile"""
+    )
+
+
+def get_profiler(args):
+    return Profiler(args.profile, args.profile_dump)
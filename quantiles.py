@@ -0,0 +1,115 @@
+#! /usr/bin/env python2
+
+"""Mergeable quantile sketch of a stream of values in bounded memory.
+
+The sketch is a stack of compactors (KLL sketch by Karnin, Lang and
+Liberty): values of level h have weight 2^h; a level over its capacity
+is sorted and every second value (with random offset) goes to the next
+level. Capacities decrease by 2/3 to the lower levels, so the sketch
+keeps about 3k values and ranks are found with an error of about
+2.3/k^0.97 of the stream size (the estimate of the DataSketches
+library). Sketches with the same k could be merged, for example
+sketches of table parts.
+"""
+
+import math
+import numpy as np
+
+
+CAPACITY_FACTOR = 2.0 / 3
+
+MIN_CAPACITY = 8
+
+SEED = 1 # fixed, so that the results are reproducible
+
+
+def get_k(error):
+    """Get k of a sketch for the relative rank error."""
+    return max(MIN_CAPACITY, int(math.ceil((2.296 / error) ** (1 / 0.9723))))
+
+
+class QuantileSketch(object):
+    """Sketch of values to find values of the given ranks.
+
+    Without compactions the ranks are exact:
+
+    >>> sketch = QuantileSketch(k=100)
+    >>> sketch.update(np.arange(10.0)[::-1])
+    >>> sketch.get_values([0, 4, 9]).tolist()
+    [0.0, 4.0, 9.0]
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.count = 0
+        self.levels = [np.zeros(0)]
+        self.rng = np.random.RandomState(SEED)
+
+    def get_capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(
+            MIN_CAPACITY, int(math.ceil(self.k * CAPACITY_FACTOR ** depth))
+        )
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.get_capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                values = np.sort(values)
+                odd = len(values) % 2 # the first value is left behind
+                offset = self.rng.randint(2)
+                self.levels[level] = values[:odd]
+                self.levels[level + 1] = np.concatenate([
+                    self.levels[level + 1], values[odd + offset::2]
+                ])
+            level += 1
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError(
+                "sketches with different k: %d and %d" % (self.k, other.k)
+            )
+        self.count += other.count
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.compress()
+
+    def get_values(self, ranks):
+        """Get values of the ranks (positions in the sorted stream)."""
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level_values), 2 ** level, dtype=np.int64)
+            for level, level_values in enumerate(self.levels)
+        ])
+        order = np.argsort(values, kind="mergesort")
+        values = values[order]
+        bounds = np.cumsum(weights[order])
+        indices = np.searchsorted(bounds, ranks, side="right")
+        return values[np.minimum(indices, len(values) - 1)]
+
+    def to_arrays(self):
+        """Get arrays to save the sketch with np.savez()."""
+        return {
+            "sketch_k": self.k, "sketch_count": self.count,
+            "sketch_values": np.concatenate(self.levels),
+            "sketch_sizes": [len(values) for values in self.levels],
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        sketch = cls(int(arrays["sketch_k"]))
+        sketch.count = int(arrays["sketch_count"])
+        bounds = np.cumsum(arrays["sketch_sizes"])[:-1]
+        sketch.levels = np.split(arrays["sketch_values"], bounds)
+        return sketch
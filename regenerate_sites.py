@@ -6,6 +6,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 NUCLS = {
     "N": ["A", "C", "G", "T"],
@@ -37,7 +39,7 @@ def main(argv=None):
         non-degenerate variants."""
     )
     parser.add_argument(
-        "intsv", metavar="FILE", type=argparse.FileType("r"),
+        "intsv", metavar="FILE", type=FileType("r"),
         default=sys.stdin, help="""input TSV file with degenerate sites,
         use '-' for STDIN"""
     )
@@ -54,7 +56,7 @@ def main(argv=None):
         help="keep degenerate sites in the file, default is replacement"
     )
     parser.add_argument(
-        "-o", metavar="FILE", dest="outsv", type=argparse.FileType("w"),
+        "-o", metavar="FILE", dest="outsv", type=FileType("w"),
         default=sys.stdout, help="output TSV file, default STDOUT"
     )
     args = parser.parse_args(argv)
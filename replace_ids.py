@@ -6,17 +6,19 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Replace IDs by dictionary."
     )
     parser.add_argument(
-        "infile", metavar="FILE", type=argparse.FileType("r"),
+        "infile", metavar="FILE", type=FileType("r"),
         help="input file with IDs column, which could be delimited"
     )
     parser.add_argument(
-        "-s", dest="indct", metavar="DICT", type=argparse.FileType("r"),
+        "-s", dest="indct", metavar="DICT", type=FileType("r"),
         required=True, help="""source .dct file with IDs mapping;
         it should be tab-separated untitled file with IDs in the
         first column, line residuals after the first tab will be
@@ -26,7 +28,7 @@ def main(argv=None):
     )
     parser.add_argument(
         "-o", "--out", dest="oufile", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
+        type=FileType("w"), default=sys.stdout,
         help="output file, default STDOUT"
     )
     parser.add_argument(
@@ -0,0 +1,220 @@
+#! /usr/bin/env python2
+
+"""Benchmark the tools on synthetic CB tables of several sizes."""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from compressed import FileType
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# tool: arguments, with {table}, {groups}, {pairs} and {triples} inputs
+BENCHMARKS = [
+    ("get_stat", "{table} -o {null} --cb-stat both --jg-stat both"),
+    ("get_group", "{table} -o {null} -g a+"),
+    ("count_decreased", "{table} -o {null} -c"),
+    ("sum_cbvals", "{table} -g {groups} -o {null}"),
+    ("get_ranks", "{table} -p {pairs} -o {null}"),
+    ("make_histogram", "{table} {null}"),
+    ("make_hist2d", "{table} {table} -i {triples} -o {null}"),
+]
+
+NO_CACHE = set([ # tools without the binary cache
+    "make_hist2d"
+])
+
+GROUP_SIZE = 10 # sequences per group of sum_cbvals
+PAIR_STEP = 7 # every PAIR_STEP-th row goes to the pairs of get_ranks
+
+
+def make_inputs(work_dir, ids, gen_args):
+    """Generate a table and side inputs, return their paths and rows."""
+    paths = dict(
+        (name, os.path.join(work_dir, "%d.%s" % (ids, ext))) for name, ext
+        in [("table", "tsv"), ("groups", "dct"), ("pairs", "prs"),
+            ("triples", "trp")]
+    )
+    subprocess.check_call(
+        [sys.executable, os.path.join(SCRIPT_DIR, "make_test_table.py"),
+         "-n", str(ids), "-o", paths["table"]] + gen_args
+    )
+    sid_sites = dict()
+    pairs = []
+    rows = 0
+    with open(paths["table"]) as intsv:
+        for line in intsv:
+            if line.startswith("#"):
+                continue
+            sid, site = line.split("\t", 2)[:2]
+            sid_sites.setdefault(sid, set()).add(site)
+            if rows % PAIR_STEP == 0:
+                pairs.append((sid, site))
+            rows += 1
+    sids = sorted(sid_sites)
+    with open(paths["groups"], "w") as oudct:
+        for start in range(0, len(sids), GROUP_SIZE):
+            oudct.write("G%d\t%s\n" % (
+                start // GROUP_SIZE, ",".join(sids[start:start+GROUP_SIZE])
+            ))
+    with open(paths["pairs"], "w") as ouprs:
+        ouprs.writelines("%s\t%s\n" % pair for pair in pairs)
+    other_sids = dict(zip(sids, sids[1:] + sids[:1]))
+    with open(paths["triples"], "w") as outrp:
+        outrp.writelines(
+            "%s\t%s\t%s\n" % (sid, other_sids[sid], site)
+            for sid, site in pairs if site in sid_sites[other_sids[sid]]
+        )
+    paths["null"] = os.devnull
+    return paths, rows
+
+
+def run_tool(command):
+    """Run a command, return wall time and peak RSS in MB, or None."""
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        _pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if status:
+        return None
+    return seconds, usage.ru_maxrss / 1024.0 # KB on Linux
+
+
+def get_commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "-C", SCRIPT_DIR, "rev-parse", "HEAD"],
+                stderr=devnull
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new, outxt):
+    old_results = dict(
+        ((result["tool"], result["ids"]), result)
+        for result in old["results"]
+    )
+    outxt.write("#Tool\tIDs\tRows/s old\tRows/s new\tSpeedup\t"
+                "RSS old, MB\tRSS new, MB\n")
+    for result in new["results"]:
+        old_result = old_results.get((result["tool"], result["ids"]))
+        if old_result is None:
+            continue
+        outxt.write("%s\t%d\t%.0f\t%.0f\t%.2f\t%.1f\t%.1f\n" % (
+            result["tool"], result["ids"], old_result["rows_per_sec"],
+            result["rows_per_sec"],
+            result["rows_per_sec"] / old_result["rows_per_sec"],
+            old_result["max_rss_mb"], result["max_rss_mb"]
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="""Benchmark the tools on synthetic CB tables of
+        several sizes, made by make_test_table.py. Every run is timed,
+        the best time and the peak RSS are saved to a JSON file."""
+    )
+    parser.add_argument(
+        "-o", "--out", metavar="JSON", type=FileType("w"),
+        default=sys.stdout, help="output results file, default STDOUT"
+    )
+    parser.add_argument(
+        "-n", "--sizes", metavar="N,N,...", default="1000,10000",
+        help="""numbers of sequence IDs of the tables, default
+        1000,10000"""
+    )
+    parser.add_argument(
+        "-t", "--tools", metavar="NAME,NAME,...", help="""tools to run,
+        default all: %s""" % ",".join(tool for tool, _args in BENCHMARKS)
+    )
+    parser.add_argument(
+        "-g", "--gen-args", metavar="ARGS", default="", help="""extra
+        arguments of make_test_table.py, e.g. '--order shuffled'"""
+    )
+    parser.add_argument(
+        "-r", "--repeat", metavar="N", type=int, default=3,
+        help="number of runs of every tool, default 3"
+    )
+    parser.add_argument(
+        "--cache", action="store_true", help="""let the tools use the
+        binary cache of the table (it is written beforehand), by default
+        the tools parse the table every run"""
+    )
+    parser.add_argument(
+        "-w", "--work-dir", metavar="DIR", help="""directory to keep
+        the generated inputs in, default is a temporary one"""
+    )
+    parser.add_argument(
+        "-c", "--compare", metavar="JSON", type=FileType("r"),
+        help="""results of a previous run to compare with, the comparison
+        is written to STDERR"""
+    )
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    benchmarks = BENCHMARKS
+    if args.tools:
+        tools = args.tools.split(",")
+        unknown = set(tools) - set(tool for tool, _args in BENCHMARKS)
+        if unknown:
+            parser.error("unknown tools: %s" % ", ".join(sorted(unknown)))
+        benchmarks = [bench for bench in BENCHMARKS if bench[0] in tools]
+    gen_args = shlex.split(args.gen_args)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="cbbench")
+    results = []
+    try:
+        for ids in sizes:
+            paths, rows = make_inputs(work_dir, ids, gen_args)
+            for tool, tool_args in benchmarks:
+                command = [
+                    sys.executable, os.path.join(SCRIPT_DIR, tool + ".py")
+                ] + tool_args.format(**paths).split()
+                if tool not in NO_CACHE:
+                    if args.cache:
+                        run_tool(command) # write the cache
+                    else:
+                        command.append("--no-cache")
+                runs = [run_tool(command) for _run in range(args.repeat)]
+                if None in runs:
+                    sys.stderr.write("%s failed on %d IDs\n" % (tool, ids))
+                    continue
+                seconds = min(seconds for seconds, _rss in runs)
+                results.append({
+                    "tool": tool, "ids": ids, "rows": rows,
+                    "seconds": round(seconds, 4),
+                    "rows_per_sec": round(rows / seconds, 1),
+                    "max_rss_mb": round(max(rss for _sec, rss in runs), 1)
+                })
+                sys.stderr.write("%s\t%d\t%.2f s\t%.0f rows/s\n" % (
+                    tool, ids, seconds, rows / seconds
+                ))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": get_commit(), "python": platform.python_version(),
+        "host": platform.node(), "gen_args": args.gen_args,
+        "cache": args.cache, "repeat": args.repeat, "results": results
+    }
+    with args.out as oujsn:
+        json.dump(report, oujsn, indent=2, sort_keys=True)
+        oujsn.write("\n")
+    if args.compare:
+        with args.compare as injsn:
+            compare_results(json.load(injsn), report, sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
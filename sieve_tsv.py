@@ -10,6 +10,8 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def float_perc(float_str):
     if float_str.endswith("%"):
@@ -29,12 +31,12 @@ def main(argv=None):
         in the case."""
     )
     parser.add_argument(
-        "intsv", metavar="TSV", type=argparse.FileType("r"), nargs="?",
+        "intsv", metavar="TSV", type=FileType("r"), nargs="?",
         default=sys.stdin, help="input TSV file, default is STDIN"
     )
     parser.add_argument(
         "-o", "--out", dest="outsv", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
+        type=FileType("w"), default=sys.stdout,
         help="output TSV file, default is STDOUT"
     )
     parser.add_argument(
@@ -56,7 +58,7 @@ def main(argv=None):
     )
     set_group.add_argument(
         "-l", "--list", dest="inlist", metavar="LIST",
-        type=argparse.FileType("r"), default=sys.stdin,
+        type=FileType("r"), default=sys.stdin,
         help="input file with a list of values"
     )
     set_group.add_argument(
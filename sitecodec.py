@@ -0,0 +1,144 @@
+#! /usr/bin/env python2
+
+"""Encode IUPAC sites as packed 4-bit integer codes.
+
+A site of up to 16 letters is packed into uint64, the first letter goes
+to the highest 4 bits and the unused low bits are zeros. Letters are
+coded in alphabetical order starting with 1, so the order of the codes
+is the alphabetical order of the sites. Reverse complement, Watson and
+Crick versions and palindrome tests are integer operations on arrays
+of the codes with precomputed per-byte lookup tables. Sites the codec
+could not encode are complemented letter by letter (see
+get_complements).
+"""
+
+import numpy as np
+
+
+LETTERS = "ABCDGHKMNRSTVWY"
+
+COMPLS = {
+    "A": "T", "T": "A", "C": "G", "G": "C",
+    "B": "V", "V": "B", "D": "H", "H": "D", "N": "N",
+    "M": "K", "K": "M", "R": "Y", "Y": "R", "W": "W", "S": "S"
+}
+
+MAX_LENGTH = 16
+
+_BAD = 0xFF
+
+
+def _make_tables():
+    letter_codes = np.full(256, _BAD, dtype=np.uint8)
+    code_letters = np.zeros(16, dtype=np.uint8)
+    nibble_compls = np.zeros(16, dtype=np.uint8)
+    for code, letter in enumerate(LETTERS, 1):
+        letter_codes[ord(letter)] = code
+        code_letters[code] = ord(letter)
+    letter_codes[0] = 0 # padding
+    for code, letter in enumerate(LETTERS, 1):
+        nibble_compls[code] = letter_codes[ord(COMPLS[letter])]
+    values = np.arange(256, dtype=np.uint8)
+    high = values >> 4
+    low = values & 0xF
+    # complement both letters of a byte and swap them
+    byte_compls = (nibble_compls[low] << 4) | nibble_compls[high]
+    byte_lengths = (high != 0).astype(np.uint8) + (low != 0)
+    return letter_codes, code_letters, byte_compls, byte_lengths
+
+
+LETTER_CODES, CODE_LETTERS, BYTE_COMPLS, BYTE_LENGTHS = _make_tables()
+
+
+def encode_sites(sites):
+    """Encode a sequence of site strings, return an array of codes."""
+    sites = np.ascontiguousarray(sites, dtype=str)
+    if sites.dtype.itemsize > MAX_LENGTH:
+        raise ValueError(
+            "sites longer than %d letters are not supported" % MAX_LENGTH
+        )
+    letters = np.zeros((len(sites), MAX_LENGTH), dtype=np.uint8)
+    if len(sites):
+        width = sites.dtype.itemsize
+        letters[:, :width] = sites.view(np.uint8).reshape(-1, width)
+    nibbles = LETTER_CODES[letters]
+    if (nibbles == _BAD).any():
+        bad = sites[(nibbles == _BAD).any(axis=1)][0]
+        raise ValueError("bad site: %r" % bad)
+    codes = np.zeros(len(sites), dtype=np.uint64)
+    for nibble in nibbles.T.astype(np.uint64):
+        codes = (codes << np.uint64(4)) | nibble
+    return codes
+
+
+def get_codable(sites):
+    """Check which sites could be encoded, return a boolean array."""
+    sites = np.ascontiguousarray(sites, dtype=str)
+    if not len(sites) or not sites.dtype.itemsize:
+        return np.ones(len(sites), dtype=bool)
+    letters = sites.view(np.uint8).reshape(len(sites), -1)
+    return (
+        (LETTER_CODES[letters] != _BAD).all(axis=1) &
+        ((letters != 0).sum(axis=1) <= MAX_LENGTH)
+    )
+
+
+def get_complement(site):
+    """Get reverse complement of a site string, unknown letters are '?'."""
+    return "".join(COMPLS.get(nucl, "?") for nucl in site[::-1])
+
+
+def get_complements(sites):
+    """Get reverse complements of site strings, return a list of them.
+
+    Sites the codec could not encode (longer than MAX_LENGTH letters or
+    with unknown letters) are complemented by get_complement():
+
+    >>> get_complements(["GATC", "GAXC", "ACGTACGTACGTACGTAA"])
+    ['GATC', 'G?TC', 'TTACGTACGTACGTACGT']
+    """
+    sites = np.ascontiguousarray(sites, dtype=str)
+    is_codable = get_codable(sites)
+    compls = np.array(sites, dtype=object)
+    codable = sites[is_codable].astype("S%d" % MAX_LENGTH)
+    compls[is_codable] = decode_sites(
+        reverse_complement(encode_sites(codable))
+    )
+    compls[~is_codable] = [
+        get_complement(site) for site in sites[~is_codable].tolist()
+    ]
+    return compls.tolist()
+
+
+def decode_sites(codes):
+    """Decode an array of codes, return a list of site strings."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    letters = np.zeros((len(codes), MAX_LENGTH), dtype=np.uint8)
+    for index in range(MAX_LENGTH):
+        shift = np.uint64(4 * (MAX_LENGTH - 1 - index))
+        letters[:, index] = CODE_LETTERS[(codes >> shift) & np.uint64(0xF)]
+    return letters.view("S%d" % MAX_LENGTH).ravel().tolist()
+
+
+def get_lengths(codes):
+    """Get site lengths of an array of codes."""
+    codes = np.ascontiguousarray(codes, dtype=np.uint64)
+    return BYTE_LENGTHS[codes.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def reverse_complement(codes):
+    """Get codes of reverse complementary sites."""
+    codes = np.ascontiguousarray(codes, dtype=np.uint64)
+    # complement letters within bytes, then reverse the order of bytes;
+    # the reversed sites are right-aligned, so shift them back
+    compls = BYTE_COMPLS[codes.view(np.uint8)].view(np.uint64).byteswap()
+    shifts = (4 * (MAX_LENGTH - get_lengths(codes))).astype(np.uint64)
+    return np.where(shifts < 64, compls << (shifts % np.uint64(64)), 0)
+
+
+def get_versions(codes):
+    """Get Watson and Crick versions and palindrome flags of sites."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    compls = reverse_complement(codes)
+    return (np.minimum(codes, compls), np.maximum(codes, compls),
+            codes == compls)
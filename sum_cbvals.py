@@ -3,29 +3,182 @@
 """Sum CB values for groups of sequences."""
 
 import argparse
-from collections import Counter
-import math
+import multiprocessing
+import numpy as np
+import os
 import sys
 
+from cbtable import Coder, get_pair_keys, open_cbtable
+from compressed import FileType, open_file
+from profiling import Profiler, add_profile_arguments, get_profiler
 
-class LineParser(object):
-    def __init__(self, indices):
-        id_index, site_index, obs_index, exp_index = indices
-        self.id_index = id_index
-        self.site_index = site_index
-        self.obs_index = obs_index
-        self.exp_index = exp_index
 
-    def __call__(self, line):
-        vals = line.strip().split("\t")
-        sid = vals[self.id_index]
-        site = vals[self.site_index]
-        obs = float(vals[self.obs_index])
-        exp = float(vals[self.exp_index])
-        total = int(vals[-1])
-        if math.isnan(exp) or math.isinf(exp):
-            exp = 0
-        return sid, site, obs, exp, total
+SITE_MASK = (1 << 32) - 1 # site codes in the low bits of pair keys
+
+WORKER_ARGS = dict() # arguments of sum_table() in worker processes
+
+
+class GroupMapper(object):
+    """Map coded sequence IDs to codes of their groups."""
+
+    def __init__(self, coder, group_codes):
+        self.coder = coder
+        self.group_codes = group_codes # by sequence IDs
+        self.table = np.zeros(0, dtype=np.int64)
+
+    def __call__(self, codes):
+        values = self.coder.values
+        if len(self.table) < len(values):
+            self.table = np.append(self.table, [
+                self.group_codes[value]
+                for value in values[len(self.table):]
+            ])
+        return self.table[codes]
+
+
+class GroupSums(object):
+    """Sums of columns by int64 keys, accumulated by chunks of rows."""
+
+    def __init__(self, dtypes):
+        self.dtypes = dtypes
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.sums = [np.zeros(0, dtype=dtype) for dtype in dtypes]
+
+    def add(self, keys, columns):
+        # the chunk is summed on its own and then merged into the sorted
+        # keys, so a chunk costs no sorting of all the groups seen
+        keys, inverse = np.unique(keys, return_inverse=True)
+        chunk_sums = [
+            np.bincount(
+                inverse, weights=column, minlength=len(keys)
+            ).astype(dtype)
+            for column, dtype in zip(columns, self.dtypes)
+        ]
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        for sums, column in zip(self.sums, chunk_sums):
+            sums[positions[found]] += column[found]
+        new = ~found
+        if new.any():
+            positions = positions[new]
+            self.keys = np.insert(self.keys, positions, keys[new])
+            self.sums = [
+                np.insert(sums, positions, column[new])
+                for sums, column in zip(self.sums, chunk_sums)
+            ]
+
+
+def sum_table(intsv, indices, group_codes, use_cache=True, profiler=None):
+    """Sum CB values of a table by (group code, site code) keys.
+
+    Group codes are given by sequence IDs. Return the sums, the site
+    names of the site codes and the number of rows.
+    """
+    profiler = profiler or Profiler()
+    sums = GroupSums([np.float64, np.float64, np.int64])
+    reader = open_cbtable(
+        intsv, indices, total_index=-1, has_title=False,
+        use_cache=use_cache
+    )
+    get_group_codes = GroupMapper(reader.id_coder, group_codes)
+    for chunk in profiler.chunks(reader):
+        with profiler.phase("aggregate"):
+            exp = np.where(np.isfinite(chunk.exp), chunk.exp, 0)
+            keys = get_pair_keys(get_group_codes(chunk.ids), chunk.sites)
+            sums.add(keys, [chunk.obs, exp, chunk.totals])
+    return sums, reader.site_coder.values, reader.rows
+
+
+def init_worker(indices, group_codes, use_cache):
+    WORKER_ARGS.update(
+        indices=indices, group_codes=group_codes, use_cache=use_cache
+    )
+
+
+def sum_table_file(path):
+    with open_file(path) as intsv:
+        return sum_table(intsv, **WORKER_ARGS)
+
+
+def sum_tables_parallel(paths, indices, group_codes, jobs, use_cache=True):
+    """Sum CB values of every table in worker processes."""
+    pool = multiprocessing.Pool(
+        jobs, init_worker, (indices, group_codes, use_cache)
+    )
+    try:
+        return pool.map(sum_table_file, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge_sums(sums, site_coder, table_sums, site_names):
+    """Add sums of a table to the sums, recoding sites by site_coder."""
+    site_codes = site_coder.encode(np.array(site_names, dtype=str))
+    keys = table_sums.keys
+    sums.add(
+        get_pair_keys(keys >> 32, site_codes[keys & SITE_MASK]),
+        table_sums.sums
+    )
+
+
+def read_groups(indct):
+    """Read a dict of 'group ID': 'member IDs', return groups by members."""
+    groups = dict()
+    for line in indct:
+        if line.startswith("#"):
+            continue
+        group_id, member_list = line.strip().split("\t")
+        for member_id in member_list.split(","):
+            groups[member_id] = group_id
+    return groups
+
+
+def read_taxonomy(intax):
+    """Read a table of sequence IDs and their groups of every level.
+
+    Return a list of dicts of groups by members, from the lowest level.
+    """
+    levels = []
+    for line in intax:
+        if line.startswith("#"):
+            continue
+        vals = line.rstrip("\r\n").split("\t")
+        if not levels:
+            levels = [dict() for _val in vals[1:]]
+        if len(vals) != len(levels) + 1:
+            raise ValueError(
+                "%s: inconsistent number of columns near line: %r" % (
+                    intax.name, line
+                )
+            )
+        for groups, member_id, group_id in zip(levels, vals, vals[1:]):
+            if groups.setdefault(member_id, group_id) != group_id:
+                raise ValueError(
+                    "%s: %s belongs to several groups: %s, %s" % (
+                        intax.name, member_id, groups[member_id], group_id
+                    )
+                )
+    return levels
+
+
+def write_sums(outsv, gids, site_names, sums):
+    """Write sums sorted by group IDs and sites."""
+    gid_codes = sums.keys >> 32
+    site_codes = sums.keys & SITE_MASK
+    site_ranks = np.argsort(np.argsort(site_names, kind="mergesort"))
+    order = np.lexsort((site_ranks[site_codes], gid_codes))
+    outsv.write("#:Sequence ID\tSite\tObserved\tExpected\tRatio\tTotal\n")
+    for gid_code, site, obs, exp, total in zip(
+            gid_codes[order].tolist(),
+            site_names[site_codes[order]].tolist(),
+            *[column[order].tolist() for column in sums.sums]
+    ):
+        ratio = obs / (exp or float("nan"))
+        outsv.write("%s\t%s\t%d\t%.2f\t%.3f\t%d\n" % (
+            gids[gid_code], site, obs, exp, ratio, total
+        ))
 
 
 def main(argv=None):
@@ -33,19 +186,42 @@ def main(argv=None):
         description="Sum CB values for groups of sequences."
     )
     parser.add_argument(
-        "intsv", metavar="TSV", type=argparse.FileType("r"),
-        help="input table of CB values"
+        "intsv", metavar="TSV", type=FileType("r"), nargs="+",
+        help="""input tables of CB values, summed as one concatenated
+        table"""
     )
     parser.add_argument(
-        "-g", "--groups", metavar="DICT", type=argparse.FileType("r"),
-        default=sys.stdin, help="""input dict of 'group ID': 'sequence
-        IDs', default is STDIN"""
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="""number of worker processes to sum the input tables in,
+        one table per process at a time, default 1; the inputs should be
+        regular files"""
+    )
+    group_group = parser.add_mutually_exclusive_group()
+    group_group.add_argument(
+        "-g", "--groups", dest="group_dicts", metavar="DICT",
+        type=FileType("r"), action="append", help="""input dict of
+        'group ID': 'sequence IDs', default is STDIN; could be repeated
+        for the next levels of groups, with 'group ID': 'group IDs of
+        the previous level' dicts"""
+    )
+    group_group.add_argument(
+        "-t", "--taxonomy", metavar="TSV", type=FileType("r"),
+        help="""input table of sequence IDs (the first column) and their
+        groups of every level (the next columns, from the lowest one),
+        instead of the dicts"""
+    )
+    parser.add_argument(
+        "-o", "--out", dest="outsvs", metavar="FILE",
+        type=FileType("w"), action="append", help="""output file,
+        default is STDOUT; with several levels of groups, it should be
+        repeated for every level in the same order"""
     )
     parser.add_argument(
-        "-o", "--out", dest="outsv", metavar="FILE",
-        type=argparse.FileType("w"), default=sys.stdout,
-        help="output file, default is STDOUT"
+        "--no-cache", dest="use_cache", action="store_false",
+        help="""do not use or write the binary cache of the input table
+        (TSV.cbc directory next to it)"""
     )
+    add_profile_arguments(parser)
     index_group_desc = (
         "All column indices are counted from 0 and could be negative\n"
         "(-1 means the last column)."
@@ -70,37 +246,83 @@ def main(argv=None):
         help="expected number column index, default -3"
     )
     args = parser.parse_args(argv)
+    profiler = get_profiler(args)
     indices = (args.id_index, args.site_index,
                args.obs_index, args.exp_index)
-    line_parser = LineParser(indices)
-    sid_to_gid = dict()
-    with args.groups as indct:
-        for line in indct:
-            if line.startswith("#"):
-                continue
-            group_id, sid_list = line.strip().split("\t")
-            for sid in sid_list.split(","):
-                sid_to_gid[sid] = group_id
-    cbvals = dict()
-    with args.intsv as intsv:
-        for line in intsv:
-            if line.startswith("#"):
-                continue
-            sid, site, obs, exp, total = line_parser(line)
-            gid = sid_to_gid[sid]
-            pair = (gid, site)
-            obs_, exp_, total_ = cbvals.get(pair, (0, 0, 0))
-            cbvals[pair] = (obs+obs_, exp+exp_, total+total_)
-
-    with args.outsv as outsv:
-        outsv.write(
-            "#:Sequence ID\tSite\tObserved\tExpected\tRatio\tTotal\n"
+    with profiler.phase("parse"):
+        try:
+            if args.taxonomy:
+                with args.taxonomy as intax:
+                    levels = read_taxonomy(intax)
+            else:
+                levels = []
+                for indct in args.group_dicts or [sys.stdin]:
+                    with indct:
+                        levels.append(read_groups(indct))
+        except ValueError as error:
+            parser.error(str(error))
+    outsvs = args.outsvs or [sys.stdout]
+    if len(outsvs) != len(levels):
+        parser.error(
+            "number of output files (%d) differs from number of group "
+            "levels (%d)" % (len(outsvs), len(levels))
         )
-        for (gid, site), (obs, exp, total) in sorted(cbvals.items()):
-            ratio = obs / (exp or float("nan"))
-            outsv.write("%s\t%s\t%d\t%.2f\t%.3f\t%d\n" % (
-                gid, site, obs, exp, ratio, total
-            ))
+    # group codes follow the sorted group IDs, as the output does
+    level_gids = [sorted(set(groups.values())) for groups in levels]
+    level_codes = [
+        dict((gid, code) for code, gid in enumerate(gids))
+        for gids in level_gids
+    ]
+    # codes of the groups of the next level by group codes
+    parent_codes = []
+    for gids, groups, codes in zip(level_gids, levels[1:], level_codes[1:]):
+        missing = [gid for gid in gids if gid not in groups]
+        if missing:
+            parser.error("no group of the next level for %s" % missing[0])
+        parent_codes.append(np.array(
+            [codes[groups[gid]] for gid in gids], dtype=np.int64
+        ))
+    group_codes = dict(
+        (sid, level_codes[0][gid]) for sid, gid in levels[0].items()
+    )
+    sums = GroupSums([np.float64, np.float64, np.int64])
+    site_coder = Coder()
+    # partial sums of the tables are merged in the order of the tables
+    if (args.jobs > 1 and len(args.intsv) > 1
+            and all(os.path.isfile(intsv.name) for intsv in args.intsv)):
+        for intsv in args.intsv:
+            intsv.close()
+        with profiler.phase("collect"):
+            table_sums = sum_tables_parallel(
+                [intsv.name for intsv in args.intsv], indices,
+                group_codes, args.jobs, args.use_cache
+            )
+        for part_sums, site_names, rows in table_sums:
+            profiler.add_rows(rows)
+            with profiler.phase("aggregate"):
+                merge_sums(sums, site_coder, part_sums, site_names)
+    else:
+        for intsv in args.intsv:
+            with intsv:
+                part_sums, site_names, _rows = sum_table(
+                    intsv, indices, group_codes, args.use_cache, profiler
+                )
+            with profiler.phase("aggregate"):
+                merge_sums(sums, site_coder, part_sums, site_names)
+    site_names = np.array(site_coder.values, dtype=str)
+    for level, (gids, outsv) in enumerate(zip(level_gids, outsvs)):
+        if level:
+            # higher levels are summed from the partial sums
+            with profiler.phase("aggregate"):
+                upper_sums = GroupSums(sums.dtypes)
+                upper_sums.add(get_pair_keys(
+                    parent_codes[level-1][sums.keys >> 32],
+                    sums.keys & SITE_MASK
+                ), sums.sums)
+                sums = upper_sums
+        with profiler.phase("write"), outsv:
+            write_sums(outsv, gids, site_names, sums)
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -3,15 +3,24 @@
 """Transform TSV by compressing/uncompressing a certain column."""
 
 import argparse
-from itertools import chain
+import heapq
+from itertools import chain, groupby, islice
+import marshal
+from operator import itemgetter
 import signal
 import sys
+import tempfile
+
+from compressed import FileType
+from profiling import add_profile_arguments, get_profiler
 
 
 FIRST_PLACE = 0
 NATIVE_PLACE = 1
 LAST_PLACE = 2
 
+MARSHAL_BATCH = 10000 # records per marshal.dump() of a sorted run
+
 
 class LineParser(object):
     def __init__(self, before_indices, after_indices, target_index):
@@ -66,6 +75,80 @@ def parse_index_set(set_str, target_index, max_index):
     return (tuple(sorted(before)), tuple(sorted(after)))
 
 
+def read_records(lines, line_parser, skip_value, metadata):
+    """Parse data lines to (key, target value) records.
+
+    Comment lines are skipped, metadata lines are collected to the list.
+    """
+    for line in lines:
+        if line.startswith("#"):
+            if line.startswith("##"):
+                metadata.append(line)
+            continue
+        key, value = line_parser(line.rstrip("\n"))
+        if value != skip_value:
+            yield key, value
+
+
+def compress_in_memory(records, delimiter):
+    compressed = dict()
+    for key, value in records:
+        compressed.setdefault(key, set()).add(value)
+    return sorted(
+        (key, delimiter.join(sorted(values)))
+        for key, values in compressed.items()
+    )
+
+
+def compress_sorted(records, delimiter):
+    """Compress records sorted by keys, yield every group once it ends."""
+    last_key = None
+    for key, group in groupby(records, itemgetter(0)):
+        if last_key is not None and key <= last_key:
+            raise ValueError(
+                "input is not sorted by the kept columns, "
+                "use --external-sort"
+            )
+        last_key = key
+        yield key, delimiter.join(sorted(set(value for _key, value in group)))
+
+
+def read_run(run):
+    run.seek(0)
+    with run:
+        while True:
+            try:
+                batch = marshal.load(run)
+            except EOFError:
+                return
+            for record in batch:
+                yield record
+
+
+def sort_externally(records, buffer_size, tmp_dir=None):
+    """Sort records by runs of buffer_size in temporary files.
+
+    Return an iterator over merged runs.
+    """
+    runs = []
+    while True:
+        run = sorted(islice(records, buffer_size))
+        if not run:
+            break
+        runfile = tempfile.TemporaryFile(dir=tmp_dir)
+        for start in range(0, len(run), MARSHAL_BATCH):
+            marshal.dump(run[start:start+MARSHAL_BATCH], runfile)
+        runs.append(runfile)
+    return heapq.merge(*[read_run(runfile) for runfile in runs])
+
+
+def format_line(record, target_place):
+    vals, target_val = record
+    vals = list(vals)
+    vals.insert(target_place, (target_val, ))
+    return "\t".join(chain(*vals)) + "\n"
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Transform TSV by [un]compressing a certain column.",
@@ -73,11 +156,11 @@ def main(argv=None):
     )
     io_group = parser.add_argument_group("Input/output arguments")
     io_group.add_argument(
-        "intsv", metavar="TSV", type=argparse.FileType("r"),
+        "intsv", metavar="TSV", type=FileType("r"),
         help="input TSV file"
     )
     io_group.add_argument(
-        "-o", dest="outsv", metavar="TSV", type=argparse.FileType("w"),
+        "-o", dest="outsv", metavar="TSV", type=FileType("w"),
         default=sys.stdout, help="output TSV file, default STDOUT"
     )
     io_group.add_argument(
@@ -110,11 +193,42 @@ def main(argv=None):
         "-s", "--skip-value", metavar="STR",
         help="which target column values to skip"
     )
+    sort_group = parser.add_argument_group(
+        "Compression modes", description="""By default, the input is
+        compressed in memory. Compressed lines are sorted by the kept
+        columns in any mode. Decompression keeps the order of the input.
+        Metadata lines ('##') are written before the data, except the
+        ones met among data lines with --presorted: they are written
+        after the data."""
+    )
+    sort_mode_group = sort_group.add_mutually_exclusive_group()
+    sort_mode_group.add_argument(
+        "--presorted", action="store_true", help="""the input is sorted
+        by the kept columns (as strings, in the column order), write
+        every group as soon as it ends; unsorted input is an error; with
+        -r, lines are decompressed as they are read"""
+    )
+    sort_mode_group.add_argument(
+        "--external-sort", action="store_true", help="""sort the input
+        by runs in temporary files and merge them, for input that does
+        not fit in memory"""
+    )
+    sort_group.add_argument(
+        "--sort-buffer", metavar="N", type=int, default=200000,
+        help="""lines per sorted run of --external-sort, default
+        200000"""
+    )
+    sort_group.add_argument(
+        "--tmp-dir", metavar="DIR", help="""directory for the runs of
+        --external-sort, default is the system one"""
+    )
+    add_profile_arguments(parser.add_argument_group("Profiling"))
     parser.add_argument(
         "-?", "-h", "-help", "--help", action="help",
         help=argparse.SUPPRESS
     )
     args = parser.parse_args(argv)
+    profiler = get_profiler(args)
     target_place = {
         "F": FIRST_PLACE, "first": FIRST_PLACE,
         "N": NATIVE_PLACE, "native": NATIVE_PLACE,
@@ -126,58 +240,82 @@ def main(argv=None):
     target_index = args.target_index
     index_set = args.kept_indices
     metadata = []
-    data = []
     title = None
     with args.intsv as intsv:
-        for line in intsv:
-            if line.startswith("#"):
-                if line.startswith("##"):
-                    metadata.append(line)
-                elif line.startswith("#:") and title is None:
-                    title = line[2:].rstrip("\n")
-            else:
-                data.append(line.rstrip("\n"))
-    sample_line = data[0] if data else title
-    if not sample_line:
-        return 1
-    max_index = len(sample_line.split("\t")) - 1
-    if target_index < 0:
-        target_index += max_index + 1
-    if target_index < 0 or target_index > max_index:
-        parser.error("Target index is out of range.")
-    try:
-        before_indices, after_indices = parse_index_set(
-            index_set, target_index, max_index
-        )
-    except ValueError:
-        parser.error("An error in the set of kept column indices.")
-    line_parser = LineParser(before_indices, after_indices, target_index)
-    compressed = dict()
-    oudata = []
-    while data:
-        line = data.pop(0)
-        key, value = line_parser(line)
-        if value == skip_value:
-            continue
-        if to_compress:
-            compressed.setdefault(key, set()).add(value)
+        lines = profiler.lines(intsv)
+        first_line = None
+        for line in lines:
+            if not line.startswith("#"):
+                first_line = line.rstrip("\n")
+                break
+            if line.startswith("##"):
+                metadata.append(line)
+            elif line.startswith("#:") and title is None:
+                title = line[2:].rstrip("\n")
+        sample_line = title if first_line is None else first_line
+        if not sample_line:
+            return 1
+        max_index = len(sample_line.split("\t")) - 1
+        if target_index < 0:
+            target_index += max_index + 1
+        if target_index < 0 or target_index > max_index:
+            parser.error("Target index is out of range.")
+        try:
+            before_indices, after_indices = parse_index_set(
+                index_set, target_index, max_index
+            )
+        except ValueError:
+            parser.error("An error in the set of kept column indices.")
+        line_parser = LineParser(before_indices, after_indices, target_index)
+        late_metadata = [] # metadata lines met among data lines
+        records = []
+        if first_line is not None:
+            records = read_records(
+                chain([first_line], lines), line_parser, skip_value,
+                late_metadata
+            )
+        # the whole input is read before writing, unless it is streamed
+        # with --presorted
+        phase = "compress"
+        if not to_compress:
+            phase = "decompress"
+            records = (
+                (key, item) for key, value in records
+                for item in value.split(delimiter)
+            )
+            if not args.presorted:
+                with profiler.phase(phase):
+                    records = list(records)
+                phase = "write"
+        elif args.presorted:
+            records = compress_sorted(records, delimiter)
+        elif args.external_sort:
+            with profiler.phase("sort"):
+                records = compress_sorted(sort_externally(
+                    records, args.sort_buffer, args.tmp_dir
+                ), delimiter)
+            phase = "merge"
         else:
-            for item in value.split(delimiter):
-                oudata.append((key, item))
-    if compressed:
-        oudata = sorted(
-            (k, delimiter.join(sorted(v))) for k, v in compressed.items()
-        )
-    if title:
-        oudata.insert(0, line_parser(title))
-    with args.outsv as outsv:
-        outsv.writelines(metadata)
-        if title:
-            outsv.write("#:")
-        for vals, target_val in oudata:
-            vals = list(vals)
-            vals.insert(target_place, (target_val, ))
-            outsv.write("\t".join(chain(*vals)) + "\n")
+            with profiler.phase("compress"):
+                records = compress_in_memory(records, delimiter)
+            phase = "write"
+        if not args.presorted:
+            metadata.extend(late_metadata)
+            del late_metadata[:]
+        with args.outsv as outsv:
+            outsv.writelines(metadata)
+            if title:
+                outsv.write("#:" + format_line(
+                    line_parser(title), target_place
+                ))
+            try:
+                with profiler.phase(phase):
+                    for record in records:
+                        outsv.write(format_line(record, target_place))
+            except ValueError as error:
+                parser.exit(1, "%s: error: %s\n" % (parser.prog, error))
+            outsv.writelines(late_metadata)
+    profiler.report()
 
 
 if __name__ == "__main__":
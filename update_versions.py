@@ -6,11 +6,13 @@ import argparse
 import signal
 import sys
 
+from compressed import FileType
+
 
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Add/update AC version.")
     parser.add_argument(
-        "infile", metavar="FILE", type=argparse.FileType("r"),
+        "infile", metavar="FILE", type=FileType("r"),
         help="input AC(v) containing file, use '-' for STDIN"
     )
     parser.add_argument(
@@ -22,7 +24,7 @@ def main(argv=None):
         help="index of AC(v) column in the input file, default 0"
     )
     parser.add_argument(
-        "-s", dest="source", metavar="LIST", type=argparse.FileType("r"),
+        "-s", dest="source", metavar="LIST", type=FileType("r"),
         required=True, help="ACv list to get versions from"
     )
     parser.add_argument(
@@ -36,7 +38,7 @@ def main(argv=None):
         help="Add/update AC versions in-place"
     )
     ougroup.add_argument(
-        "-o", dest="oufile", metavar="FILE", type=argparse.FileType("w"),
+        "-o", dest="oufile", metavar="FILE", type=FileType("w"),
         default=sys.stdout, help="output file, default STDOUT"
     )
     args = parser.parse_args(argv)